@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Ponto de entrada ASGI, com as chamadas ao OpenRouteService assíncronas
+
+Com WSGI (wsgi.py), cada pedido de isócronas ocupa uma thread enquanto espera
+pelo ORS: se o serviço estiver lento, todos os workers ficam parados à espera.
+Aqui, POST /api/isochrones e /api/isochrones/batch correm num ciclo de
+eventos: a espera pelo ORS não ocupa threads, e só o trabalho de CPU
+(reprojeção, círculos, motor local) passa para threads. Os restantes
+endpoints são a aplicação Flask, servida num conjunto de ASGI_WSGI_THREADS
+threads. Os dados são carregados antes do fork, como em wsgi.py.
+
+Uso: uvicorn asgi:app --port 5000
+     gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+"""
+import asyncio
+import gc
+import os
+import time
+import traceback
+
+from a2wsgi import WSGIMiddleware
+
+import server
+from metrics import server_timing, stage, start_timings
+from ors_client import httpx
+
+if httpx is None:
+    raise RuntimeError("O ponto de entrada ASGI precisa do httpx (pip install httpx)")
+
+print("Carregando dados de censos (antes de criar os workers)...")
+server.ensure_census_loaded()
+if server.ISOCHRONE_BACKEND == 'local':
+    server.get_walking_graph()
+gc.freeze()
+
+flask_app = WSGIMiddleware(server.app, workers=int(os.getenv('ASGI_WSGI_THREADS', '8')))
+
+# Chamadas ao ORS em curso por chave de cache: pedidos iguais em simultâneo esperam pela mesma
+ORS_INFLIGHT = {}
+
+
+async def fetch_ors_isochrones(key, lat, lng, ranges, profile):
+    with stage('ors'):
+        features = await server.ORS_CLIENT.request_isochrones_async([[lng, lat]], ranges, profile)
+    if features and features[0]:
+        await asyncio.to_thread(server.ISOCHRONE_CACHE.set, key, features[0])
+        return features[0]
+    print("OpenRouteService não retornou isócronas, usando fallback")
+    return None
+
+
+async def cached_ors_isochrones(key, lat, lng, ranges, profile):
+    """Isócronas do ORS pela cache, partilhando a chamada com pedidos iguais em curso"""
+    isochrones = await asyncio.to_thread(server.ISOCHRONE_CACHE.get, key)
+    if isochrones is not None:
+        return isochrones
+    task = ORS_INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch_ors_isochrones(key, lat, lng, ranges, profile))
+        ORS_INFLIGHT[key] = task
+        task.add_done_callback(lambda _: ORS_INFLIGHT.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def isochrones(data):
+    """POST /api/isochrones (ver server.get_isochrones)"""
+    params, error = server.parse_isochrone_request(data)
+    if error:
+        return 400, {"error": error}
+    lat, lng, ranges, profile, backend = params
+
+    isochrones = None
+    if backend == 'ors':
+        snapped_lat, snapped_lng, key = server.snap_location(lat, lng, ranges, profile)
+        isochrones = await cached_ors_isochrones(key, snapped_lat, snapped_lng, ranges, profile)
+    elif backend == 'local':
+        isochrones = await asyncio.to_thread(server.create_local_isochrones, lat, lng, ranges)
+    return 200, await asyncio.to_thread(server.isochrone_result, lat, lng, ranges, backend, isochrones)
+
+
+async def isochrones_batch(data):
+    """POST /api/isochrones/batch (ver server.get_isochrones_batch)"""
+    params, error = server.parse_batch_request(data)
+    if error:
+        return 400, {"error": error}
+    locations, ranges, profile, backend = params
+
+    if backend != 'ors':
+        return 200, {"results": await asyncio.to_thread(server.local_batch_results, locations, ranges, backend)}
+
+    results, missing = await asyncio.to_thread(server.cached_batch_results, locations, ranges, profile)
+    features = []
+    if missing:
+        with stage('ors'):
+            features = await server.ORS_CLIENT.request_isochrones_batch_async(
+                [[lng, lat] for lat, lng in missing.values()], ranges, profile
+            )
+    results = await asyncio.to_thread(server.finish_batch_results, results, missing, features, ranges)
+    return 200, {"results": results}
+
+
+ASYNC_ROUTES = {
+    '/api/isochrones': isochrones,
+    '/api/isochrones/batch': isochrones_batch
+}
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def handle(handler, scope, receive, send):
+    """Corre um endpoint assíncrono: corpo JSON, métricas, Server-Timing e CORS como no Flask"""
+    timings = start_timings()
+    start_time = time.perf_counter()
+    body = await read_body(receive)
+    if body is None:
+        return
+
+    try:
+        data = server.app.json.loads(body) if body else None
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        status, result = 400, {"error": "Corpo do pedido deve ser um objeto JSON"}
+    else:
+        try:
+            status, result = await handler(data)
+        except Exception as e:
+            traceback.print_exc()
+            status, result = 500, {"error": str(e)}
+    with stage('serialize'):
+        payload = server.app.json.dumps(result).encode()
+
+    elapsed = time.perf_counter() - start_time
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(payload)).encode()),
+            (b'access-control-allow-origin', b'*'),
+            (b'server-timing', server_timing(timings, elapsed).encode())
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+    server.REQUESTS.inc(endpoint=scope['path'], method='POST', status=status)
+    server.REQUEST_SECONDS.observe(elapsed, endpoint=scope['path'])
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await server.ORS_CLIENT.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    handler = ASYNC_ROUTES.get(scope['path']) if scope['type'] == 'http' and scope['method'] == 'POST' else None
+    if handler is None:
+        return await flask_app(scope, receive, send)
+    return await handle(handler, scope, receive, send)
@@ -0,0 +1 @@
+"""Benchmarks do servidor e do processamento com dados sintéticos (ver run.py)"""
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Servidor local que imita o endpoint de isócronas do OpenRouteService
+
+Responde a POST /v2/isochrones/{perfil} com um polígono por localização e
+intervalo (um círculo ligeiramente irregular, à velocidade a pé), no mesmo
+formato do ORS, com uma latência fixa opcional para simular a rede.
+"""
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from local_isochrones import WALKING_SPEED
+
+VERTICES = 64
+
+
+def isochrone_feature(lng, lat, range_seconds, group_index):
+    """Feature GeoJSON de uma isócrona sintética centrada em (lng, lat)"""
+    radius = range_seconds * WALKING_SPEED
+    coords = []
+    for k in range(VERTICES):
+        angle = 2 * math.pi * k / VERTICES
+        r = radius * (0.85 + 0.15 * math.cos(5 * angle))  # contorno irregular, como numa rede de ruas
+        coords.append([
+            lng + r * math.cos(angle) / (111320 * math.cos(math.radians(lat))),
+            lat + r * math.sin(angle) / 110540
+        ])
+    coords.append(coords[0])
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Polygon", "coordinates": [coords]},
+        "properties": {"group_index": group_index, "value": range_seconds, "center": [lng, lat]}
+    }
+
+
+class MockORSHandler(BaseHTTPRequestHandler):
+    latency = 0.0  # segundos por chamada
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.latency:
+            time.sleep(self.latency)
+        features = [
+            isochrone_feature(lng, lat, range_seconds, group)
+            for group, (lng, lat) in enumerate(body.get('locations', []))
+            for range_seconds in body.get('range', [])
+        ]
+        payload = json.dumps({"type": "FeatureCollection", "features": features}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/geo+json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_mock_ors(latency=0.0, port=0):
+    """Arranca o servidor numa thread; devolve (servidor, URL base para ORS_BASE_URL)"""
+    handler = type('Handler', (MockORSHandler,), {"latency": latency})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='mock-ors').start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
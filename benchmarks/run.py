@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Benchmarks com dados sintéticos: processamento, carregamento e endpoints
+
+Para cada dimensão, gera subsecções sintéticas num diretório temporário, mede
+process_data.py (construção completa e execução sem alterações) e
+load_census_data e, para cada disposição das estações (da dispersa à muito
+sobreposta), os pedidos a /api/isochrones (contra um ORS local) e a
+/api/population-in-isochrones através do cliente de testes do Flask, além
+dos mosaicos das subsecções (/tiles/census). As caches de resultados ficam
+desligadas para que cada pedido faça o trabalho todo. Cada medição regista percentis da latência e o pico de memória
+(tracemalloc, numa execução à parte para não distorcer os tempos).
+
+Os resultados são gravados em JSON e podem ser comparados com uma referência
+(benchmarks/baseline.json), assinalando as regressões.
+
+Uso:
+    python3 -m benchmarks.run                                  # 1 000 e 10 000 subsecções
+    python3 -m benchmarks.run --sizes 1000,50000,500000 --repeat 30
+    python3 -m benchmarks.run --shards                         # dados em partições por município
+    python3 -m benchmarks.run --save-baseline                  # gravar a referência
+    python3 -m benchmarks.run --compare                        # comparar (código 1 se houver regressões)
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.mock_ors import start_mock_ors
+from benchmarks.synthetic import LAYOUTS, census_blocks, station_layout
+
+BASELINE_FILE = os.path.join(REPO_ROOT, "benchmarks", "baseline.json")
+RESULTS_FILE = os.path.join(REPO_ROOT, "benchmarks", "results.json")
+
+# Configuração do servidor durante os benchmarks: sem caches de resultados nem ficheiros no repositório
+SERVER_ENV = {
+    "ORS_API_KEY": "benchmark",
+    "ISOCHRONE_BACKEND": "ors",
+    "ORS_RATE_LIMIT": "0",  # o ORS simulado não tem quota
+    "ISOCHRONE_CACHE_SIZE": "0",
+    "ISOCHRONE_CACHE_DISK": "",
+    "POPULATION_CACHE_SIZE": "0",
+    "POPULATION_CACHE_DISK": "",
+    "TILE_CACHE_SIZE": "0",
+    "TILE_CACHE_DISK": "",
+    "CENSUS_VARIABLES_FILE": os.path.join(REPO_ROOT, "BGRI2021_0705", "C2021_FSINTESE_VARIAVEIS.csv")
+}
+
+# Variações abaixo destes valores absolutos não contam como regressão (ruído de medição)
+MIN_DELTA_MS = 1.0
+MIN_DELTA_MB = 1.0
+
+# Estado global do servidor preenchido por load_census_data
+CENSUS_GLOBALS = ("CENSUS_DATA", "POP_COLUMN", "METADATA", "CENSUS_VIEW", "CENSUS_GEOMS", "CENSUS_AREAS",
+                  "CENSUS_TREE", "CENSUS_SHARDS", "POPULATION_GRID")
+
+
+def measure(fn, repeat, warmup=0, memory=True, quiet=True):
+    """Executa `fn` `repeat` vezes; devolve percentis da latência (ms) e o pico de memória (MB)"""
+    output = contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext()
+    with output:
+        for _ in range(warmup):
+            fn()
+        samples = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            fn()
+            samples.append((time.perf_counter() - start_time) * 1000)
+        peak = None
+        if memory:
+            tracemalloc.start()
+            try:
+                fn()
+                peak = tracemalloc.get_traced_memory()[1] / 2**20
+            finally:
+                tracemalloc.stop()
+
+    samples = np.array(samples)
+    return {
+        "samples": len(samples),
+        "mean_ms": round(float(samples.mean()), 3),
+        "p50_ms": round(float(np.percentile(samples, 50)), 3),
+        "p90_ms": round(float(np.percentile(samples, 90)), 3),
+        "p99_ms": round(float(np.percentile(samples, 99)), 3),
+        "max_ms": round(float(samples.max()), 3),
+        "peak_mb": round(peak, 2) if peak is not None else None
+    }
+
+
+def post_json(client, url, body):
+    """POST pelo cliente de testes; falha se a resposta não for 200"""
+    response = client.post(url, json=body)
+    if response.status_code != 200:
+        raise RuntimeError(f"{url} devolveu {response.status_code}: {response.get_data(as_text=True)[:200]}")
+    return response.get_json()
+
+
+def reset_census(server):
+    """Esquece os dados carregados, como num processo novo"""
+    for name in CENSUS_GLOBALS:
+        setattr(server, name, None)
+
+
+def benchmark_size(server, n_blocks, args, results):
+    """Mede o processamento, o carregamento e os endpoints com `n_blocks` subsecções"""
+    import process_data
+
+    tag = f"{n_blocks}" + ("/shards" if args.shards else "")
+    workdir = os.path.join(args.workdir, f"blocks_{n_blocks}")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+
+    print(f"\n== {n_blocks:,} subsecções ==")
+    input_file = "census.gpkg"
+    census_blocks(n_blocks, seed=args.seed).to_file(input_file, driver="GPKG")
+
+    def record(name, stats):
+        results[f"{name}/{tag}"] = stats
+        print(f"  {name:<24} p50 {stats['p50_ms']:>10.1f} ms   p90 {stats['p90_ms']:>10.1f} ms   "
+              f"p99 {stats['p99_ms']:>10.1f} ms   pico {stats['peak_mb'] if stats['peak_mb'] is not None else '-':>8} MB")
+
+    def process(force):
+        process_data.process_census_data([input_file], shards=args.shards, workers=args.workers, force=force)
+
+    record("process_data", measure(lambda: process(True), 1, memory=args.memory, quiet=not args.verbose))
+    record("process_data_noop", measure(lambda: process(False), 3, memory=args.memory, quiet=not args.verbose))
+
+    def load(rebuild_grid):
+        reset_census(server)
+        if rebuild_grid and os.path.exists(server.POPULATION_GRID_FILE):
+            os.remove(server.POPULATION_GRID_FILE)
+        server.load_census_data()
+
+    record("load_census_data", measure(lambda: load(True), args.load_repeat, memory=args.memory,
+                                       quiet=not args.verbose))
+    if not args.shards:
+        record("load_census_data_cached", measure(lambda: load(False), args.load_repeat, memory=args.memory,
+                                                  quiet=not args.verbose))
+
+    client = server.app.test_client()
+
+    # Mosaicos das subsecções no zoom 14, percorrendo os que cobrem os dados
+    from tiles import tile_range
+    bounds = server.METADATA["bounds"]
+    x0, y0, x1, y1 = tile_range((bounds["minx"], bounds["miny"], bounds["maxx"], bounds["maxy"]), 14)
+    tile_cycle = itertools.cycle([(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)])
+
+    def request_tile():
+        x, y = next(tile_cycle)
+        response = client.get(f"/tiles/census/14/{x}/{y}.mvt")
+        if response.status_code != 200:
+            raise RuntimeError(f"/tiles/census/14/{x}/{y}.mvt: {response.status_code}")
+
+    record("census_tile", measure(request_tile, args.repeat, warmup=1, memory=args.memory, quiet=not args.verbose))
+
+    for layout in args.layouts:
+        stations = station_layout(args.stations, layout, args.ranges, seed=args.seed)
+        print(f"  -- {layout}: {len(stations)} estações")
+
+        # Isócronas (uma estação por pedido), guardando as referências para o cálculo de população
+        isochrone_ids = {}
+        turns = itertools.count()
+
+        def request_isochrones():
+            station = stations[next(turns) % len(stations)]
+            body = {"lat": station["lat"], "lng": station["lng"], "ranges": args.ranges}
+            isochrone_ids[station["id"]] = post_json(client, "/api/isochrones", body)["isochrone_id"]
+
+        record(f"isochrones/{layout}", measure(request_isochrones, max(args.repeat, len(stations)),
+                                               memory=args.memory, quiet=not args.verbose))
+
+        points = [dict(station, isochrone_id=isochrone_ids[station["id"]]) for station in stations]
+        for mode, precision in (("exact", "exact"), ("exact", "preview"), ("grid", "exact")):
+            body = {"points": points, "ranges": args.ranges, "mode": mode, "precision": precision}
+            name = mode if precision == "exact" else precision
+            record(f"population_{name}/{layout}", measure(
+                lambda: post_json(client, "/api/population-in-isochrones", body), args.repeat,
+                warmup=1, memory=args.memory, quiet=not args.verbose
+            ))
+
+
+def compare(results, baseline, threshold):
+    """Medições piores que a referência em mais de `threshold` (fração) na mediana ou no pico de memória"""
+    regressions = []
+    for key, current in results.items():
+        reference = baseline.get(key)
+        if not reference:
+            continue
+        for metric, min_delta in (("p50_ms", MIN_DELTA_MS), ("peak_mb", MIN_DELTA_MB)):
+            old, new = reference.get(metric), current.get(metric)
+            if old is None or new is None:
+                continue
+            if new > old * (1 + threshold) and new - old > min_delta:
+                regressions.append((key, metric, old, new))
+    return regressions
+
+
+def slower_grid(results):
+    """Medições em que o modo grelha não é mais rápido do que o exato na disposição densa"""
+    failures = []
+    for key, grid in results.items():
+        if not key.startswith("population_grid/dense/"):
+            continue
+        exact = results.get(key.replace("population_grid/", "population_exact/", 1))
+        if exact and grid["p50_ms"] >= exact["p50_ms"]:
+            failures.append((key, exact["p50_ms"], grid["p50_ms"]))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks com subsecções e estações sintéticas")
+    parser.add_argument("--sizes", default="1000,10000",
+                        help="Números de subsecções, separados por vírgulas (ex.: 1000,50000,500000)")
+    parser.add_argument("--layouts", default=",".join(LAYOUTS),
+                        help=f"Disposições das estações ({', '.join(LAYOUTS)})")
+    parser.add_argument("--stations", type=int, default=20, help="Estações por disposição")
+    parser.add_argument("--ranges", default="300,600", help="Bandas de tempo (segundos)")
+    parser.add_argument("--repeat", type=int, default=20, help="Repetições de cada pedido")
+    parser.add_argument("--load-repeat", type=int, default=3, help="Repetições do carregamento dos dados")
+    parser.add_argument("--shards", action="store_true", help="Processar e servir os dados em partições")
+    parser.add_argument("--workers", type=int, help="Processos de process_data.py")
+    parser.add_argument("--ors-latency", type=float, default=0.0, help="Latência simulada do ORS (segundos)")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="Não medir o pico de memória")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=RESULTS_FILE, help="Ficheiro JSON dos resultados")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="Ficheiro JSON de referência")
+    parser.add_argument("--save-baseline", action="store_true", help="Gravar os resultados como referência")
+    parser.add_argument("--compare", action="store_true", help="Comparar com a referência")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Regressão a partir de (fração, ex.: 0.2)")
+    parser.add_argument("--workdir", help="Diretório de trabalho (por omissão, temporário e apagado no fim)")
+    parser.add_argument("--verbose", action="store_true", help="Mostrar a saída do servidor e do processamento")
+    args = parser.parse_args()
+    args.sizes = [int(size) for size in args.sizes.split(",")]
+    args.layouts = args.layouts.split(",")
+    args.ranges = [int(r) for r in args.ranges.split(",")]
+    unknown = [layout for layout in args.layouts if layout not in LAYOUTS]
+    if unknown:
+        parser.error(f"Disposições desconhecidas: {', '.join(unknown)}")
+
+    keep_workdir = bool(args.workdir)
+    args.workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="benchmarks-"))
+    original_cwd = os.getcwd()
+
+    # O servidor lê a configuração ao ser importado: o ORS local tem de estar a correr antes
+    mock_server, ors_url = start_mock_ors(args.ors_latency)
+    os.environ.update(SERVER_ENV, ORS_BASE_URL=ors_url)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import server
+
+    results = {}
+    try:
+        for n_blocks in args.sizes:
+            benchmark_size(server, n_blocks, args, results)
+    finally:
+        os.chdir(original_cwd)
+        mock_server.shutdown()
+        if not keep_workdir:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "sizes": args.sizes,
+            "layouts": args.layouts,
+            "stations": args.stations,
+            "ranges": args.ranges,
+            "repeat": args.repeat,
+            "shards": args.shards
+        },
+        "results": results
+    }
+    for path in [args.output] + ([args.baseline] if args.save_baseline else []):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResultados gravados em {path}")
+
+    failures = slower_grid(results)
+    for key, exact, grid in failures:
+        print(f"GRELHA MAIS LENTA {key}: {grid} ms (exato {exact} ms)")
+
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f"Referência não encontrada: {args.baseline} (gravar com --save-baseline)")
+            return 1
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["meta"].get("platform") != report["meta"]["platform"] or baseline["meta"].get("cpus") != report["meta"]["cpus"]:
+            print("AVISO: a referência foi medida noutra máquina; as diferenças podem não ser regressões")
+        regressions = compare(results, baseline["results"], args.threshold)
+        for key, metric, old, new in regressions:
+            print(f"REGRESSÃO {key} {metric}: {old} -> {new} (+{(new / old - 1) * 100:.0f}%)")
+        if regressions:
+            return 1
+        print(f"Sem regressões acima de {args.threshold:.0%}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Geradores de dados sintéticos para os benchmarks
+
+Subsecções: uma grelha de quadriláteros com os vértices deslocados ao acaso
+(cobre o plano sem buracos nem sobreposições, como a BGRI), com a população
+a decrescer do centro para a periferia e as mesmas colunas principais da
+BGRI, incluindo o município (DTMN21) para as partições. Estações: uma grelha
+à volta do centro cujo espaçamento, relativo ao alcance da maior banda,
+define a sobreposição entre as zonas.
+"""
+import numpy as np
+import geopandas as gpd
+import shapely
+
+from local_isochrones import WALKING_SPEED
+from projection import DEFAULT_METRIC_CRS, WGS84, transform_points
+
+# Centro de Évora (lat, lng), como no frontend
+CENTER = (38.5667, -7.9075)
+
+# Espaçamento entre estações, em múltiplos do raio da maior banda:
+# sem sobreposição, vizinhas sobrepostas, e muito sobrepostas
+LAYOUTS = {
+    "sparse": 2.5,
+    "moderate": 1.0,
+    "dense": 0.25
+}
+
+
+def census_blocks(n_blocks, block_size=80.0, blocks_per_municipality=2000, center=CENTER, seed=0):
+    """GeoDataFrame (CRS métrico) com `n_blocks` subsecções sintéticas de cerca de `block_size` metros"""
+    rng = np.random.default_rng(seed)
+    nx = int(np.ceil(np.sqrt(n_blocks)))
+    ny = int(np.ceil(n_blocks / nx))
+    cx, cy = transform_points([center[1]], [center[0]], src_crs=WGS84, dst_crs=DEFAULT_METRIC_CRS)[0]
+
+    # Vértices partilhados entre subsecções vizinhas, deslocados até 1/4 do lado (quadriláteros simples)
+    vx, vy = np.meshgrid(np.arange(nx + 1, dtype=float), np.arange(ny + 1, dtype=float))
+    vx = cx + (vx - nx / 2 + rng.uniform(-0.25, 0.25, vx.shape)) * block_size
+    vy = cy + (vy - ny / 2 + rng.uniform(-0.25, 0.25, vy.shape)) * block_size
+    row, col = np.divmod(np.arange(n_blocks), nx)
+    corners = [(row, col), (row, col + 1), (row + 1, col + 1), (row + 1, col), (row, col)]
+    rings = np.stack([np.column_stack([vx[r, c], vy[r, c]]) for r, c in corners], axis=1)
+    geoms = shapely.polygons(rings)
+
+    # População mais densa no centro (como numa cidade), com subsecções vazias na periferia
+    distance = np.hypot(col - nx / 2, row - ny / 2) * block_size
+    people = rng.poisson(60 * np.exp(-distance / max(nx, ny) / block_size * 3))
+
+    # Municípios em faixas de blocos contíguos (uma partição cada com --shards)
+    municipality = row * nx // blocks_per_municipality
+    return gpd.GeoDataFrame({
+        "BGRI2021": [f"{m:04d}{i:07d}" for m, i in zip(municipality + 1, range(n_blocks))],
+        "DTMN21": [f"{m:04d}" for m in municipality + 1],
+        "N_EDIFICIOS_CLASSICOS": rng.poisson(np.maximum(people / 3, 0.5)),
+        "N_ALOJAMENTOS_TOTAL": rng.poisson(people / 2),
+        "N_INDIVIDUOS_0_14": rng.binomial(people, 0.13),
+        "N_INDIVIDUOS_65_OU_MAIS": rng.binomial(people, 0.25),
+        "N_INDIVIDUOS": people
+    }, geometry=geoms, crs=DEFAULT_METRIC_CRS)
+
+
+def station_layout(n_stations, layout="moderate", ranges=(300, 600), center=CENTER, seed=0):
+    """Lista de estações ({id, lat, lng}) numa grelha à volta do centro com a sobreposição de `layout`"""
+    rng = np.random.default_rng(seed)
+    spacing = LAYOUTS[layout] * max(ranges) * WALKING_SPEED
+    side = int(np.ceil(np.sqrt(n_stations)))
+    row, col = np.divmod(np.arange(n_stations), side)
+    cx, cy = transform_points([center[1]], [center[0]], src_crs=WGS84, dst_crs=DEFAULT_METRIC_CRS)[0]
+    x = cx + (col - (side - 1) / 2 + rng.uniform(-0.2, 0.2, n_stations)) * spacing
+    y = cy + (row - (side - 1) / 2 + rng.uniform(-0.2, 0.2, n_stations)) * spacing
+    lnglat = transform_points(x, y, src_crs=DEFAULT_METRIC_CRS, dst_crs=WGS84)
+    return [{"id": i + 1, "lat": float(lat), "lng": float(lng)} for i, (lng, lat) in enumerate(lnglat)]
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Script para pré-gerar os mosaicos das subsecções (camada census) na cache em disco do servidor
+
+Percorre, em cada nível de zoom, os mosaicos que cobrem o retângulo dos dados
+(`bounds` de data/metadata.json) e grava-os em TILE_CACHE_DISK, com a mesma
+chave que o servidor usa em /tiles/census/<z>/<x>/<y>.<formato>. Os mosaicos
+da cobertura dependem de cada sessão e não são pré-gerados.
+"""
+import argparse
+import time
+
+import shapely
+
+import server
+from projection import WGS84, transform_geometries
+from tiles import tile_range
+
+
+def data_bounds():
+    """Retângulo dos dados em WGS84: o dos metadados, ou o das subsecções do ficheiro único"""
+    bounds = (server.METADATA or {}).get("bounds")
+    if bounds:
+        return bounds["minx"], bounds["miny"], bounds["maxx"], bounds["maxy"]
+    box = shapely.box(*shapely.total_bounds(server.CENSUS_VIEW.geoms))
+    return tuple(shapely.bounds(transform_geometries([box], src_crs=server.METRIC_CRS, dst_crs=WGS84)[0]))
+
+
+def build_tiles(min_zoom, max_zoom, formats=('mvt',), attributes=None):
+    """Gera (ou confirma na cache) os mosaicos dos níveis min_zoom..max_zoom"""
+    if not server.TILE_CACHE_DISK:
+        raise SystemExit("TILE_CACHE_DISK não definido: os mosaicos não teriam onde ficar")
+    if not server.ensure_census_loaded():
+        raise SystemExit(server.CENSUS_STATUS["error"])
+    attributes, error = server.parse_attributes(server.TILE_ATTRIBUTES if attributes is None else attributes)
+    if error:
+        raise SystemExit(error)
+
+    bounds = data_bounds()
+    print(f"Retângulo dos dados: {', '.join(f'{v:.5f}' for v in bounds)}")
+    for z in range(max(min_zoom, server.TILE_MIN_ZOOM), min(max_zoom, server.TILE_MAX_ZOOM) + 1):
+        start_time = time.perf_counter()
+        x0, y0, x1, y1 = tile_range(bounds, z)
+        count = empty = size = 0
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                for fmt in formats:
+                    tile, _ = server.cached_census_tile(z, x, y, fmt, attributes)
+                    count += 1
+                    empty += not tile
+                    size += len(tile)
+        print(f"Zoom {z}: {count:,} mosaicos ({empty:,} vazios, {size / 1e6:.1f} MB) em {time.perf_counter() - start_time:.1f} s")
+    print(f"Cache: {server.TILE_CACHE_DISK}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pré-gera os mosaicos vetoriais das subsecções")
+    parser.add_argument("--min-zoom", type=int, default=server.TILE_MIN_ZOOM)
+    parser.add_argument("--max-zoom", type=int, default=16)
+    parser.add_argument("--format", nargs="+", default=["mvt"], choices=sorted(server.TILE_FORMATS))
+    parser.add_argument("--attributes", help="Variáveis dos censos separadas por vírgulas (por omissão TILE_ATTRIBUTES)")
+    args = parser.parse_args()
+    attributes = [name.strip() for name in args.attributes.split(',') if name.strip()] if args.attributes is not None else None
+    build_tiles(args.min_zoom, args.max_zoom, args.format, attributes)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Script para compilar a rede pedonal (extrato OSM) para o motor local de isócronas
+
+Aceita um extrato OSM (.osm.pbf, lido pelo GDAL) ou qualquer ficheiro vetorial
+com linhas (GeoPackage, GeoJSON...) e grava em data/walking_graph.npz uma
+matriz de adjacência CSR com os nós no CRS métrico.
+"""
+import argparse
+import os
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from local_isochrones import WalkingGraph
+from projection import DEFAULT_METRIC_CRS
+
+# Vias OSM onde não se anda a pé
+EXCLUDED_HIGHWAYS = {'motorway', 'motorway_link', 'trunk', 'trunk_link', 'construction', 'proposed', 'raceway'}
+
+
+def read_walkable_lines(input_file, layer=None):
+    """Lê as linhas da rede, filtrando vias OSM não pedonais quando a coluna `highway` existe"""
+    if input_file.endswith('.pbf') and layer is None:
+        layer = 'lines'
+    gdf = gpd.read_file(input_file, layer=layer)
+
+    if 'highway' in gdf.columns:
+        gdf = gdf[gdf['highway'].notna() & ~gdf['highway'].isin(EXCLUDED_HIGHWAYS)]
+    return gdf
+
+
+def build_csr(lines, precision=0.01):
+    """Constrói a rede não dirigida (CSR) a partir de um array de LineStrings no CRS métrico
+
+    Vértices a menos de `precision` metros são fundidos no mesmo nó.
+    """
+    coords, line_idx = shapely.get_coordinates(lines, return_index=True)
+
+    # Identificar nós únicos pelas coordenadas arredondadas
+    keys = np.round(coords / precision).astype(np.int64)
+    _, first, node_of = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    node_of = node_of.ravel()
+    node_xy = coords[first]
+
+    # Troços entre vértices consecutivos da mesma linha
+    same_line = line_idx[1:] == line_idx[:-1]
+    u = node_of[:-1][same_line]
+    v = node_of[1:][same_line]
+    keep = u != v
+    u, v = u[keep], v[keep]
+    lengths = np.hypot(*(node_xy[u] - node_xy[v]).T)
+
+    # Ambos os sentidos, sem troços repetidos (fica o mais curto)
+    src = np.concatenate([u, v])
+    dst = np.concatenate([v, u])
+    lengths = np.concatenate([lengths, lengths])
+    order = np.lexsort((lengths, dst, src))
+    src, dst, lengths = src[order], dst[order], lengths[order]
+    unique = np.r_[True, (src[1:] != src[:-1]) | (dst[1:] != dst[:-1])]
+    src, dst, lengths = src[unique], dst[unique], lengths[unique]
+
+    indptr = np.zeros(len(node_xy) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=len(node_xy)), out=indptr[1:])
+    return node_xy, indptr, dst, lengths
+
+
+def build_walking_graph(input_file, output_file="data/walking_graph.npz", layer=None, crs=DEFAULT_METRIC_CRS):
+    """Compila a rede pedonal e grava-a em `output_file`"""
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+
+    print(f"Lendo arquivo: {input_file}")
+    gdf = read_walkable_lines(input_file, layer)
+    print(f"Linhas pedonais: {len(gdf)}")
+
+    if gdf.crs != crs:
+        print(f"Convertendo de {gdf.crs} para {crs}...")
+        gdf = gdf.to_crs(crs)
+
+    lines = shapely.get_parts(np.asarray(gdf.geometry.values))
+    lines = lines[shapely.get_type_id(lines) == 1]  # apenas LineStrings
+    node_xy, indptr, indices, lengths = build_csr(lines)
+
+    graph = WalkingGraph(node_xy, indptr, indices, lengths, crs=crs)
+    graph.save(output_file)
+
+    print(f"\nSalvando em: {output_file}")
+    print(f"Nós: {graph.num_nodes:,}  Troços (ambos os sentidos): {len(indices):,}")
+    return graph
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compila a rede pedonal para o motor local de isócronas")
+    parser.add_argument("input", help="Extrato OSM (.osm.pbf) ou ficheiro vetorial com a rede")
+    parser.add_argument("--layer", help="Camada a ler (por omissão 'lines' nos extratos OSM)")
+    parser.add_argument("--output", default="data/walking_graph.npz")
+    args = parser.parse_args()
+    build_walking_graph(args.input, args.output, layer=args.layer)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Caches em memória (LRU) e em disco (SQLite) com TTL, limite de tamanho e contadores
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Cache em memória com despejo LRU e expiração por TTL (em segundos)
+
+    Com `max_weight`, o total dos pesos das entradas (`weight(valor)`, por
+    exemplo o número de subsecções) também é limitado; a entrada mais
+    recente fica sempre, mesmo que sozinha passe o limite.
+    """
+
+    def __init__(self, max_entries=1024, ttl=None, max_weight=None, weight=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weight = weight or (lambda value: 1)
+        self._data = OrderedDict()  # chave -> (instante de expiração, valor)
+        self._weights = {}          # chave -> peso (com max_weight)
+        self._total_weight = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Devolve o valor em cache (e marca-o como usado recentemente) ou `default`"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.time():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Guarda um valor, despejando as entradas menos usadas se o limite for excedido"""
+        expires_at = time.time() + self.ttl if self.ttl else None
+        weight = self.weight(value) if self.max_weight is not None else 0
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (expires_at, value)
+            self._weights[key] = weight
+            self._total_weight += weight
+            while len(self._data) > self.max_entries or (
+                    self.max_weight is not None and self._total_weight > self.max_weight and len(self._data) > 1):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        if self._data.pop(key, None) is not None:
+            self._total_weight -= self._weights.pop(key)
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._weights.clear()
+            self._total_weight = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        stats = {
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+        if self.max_weight is not None:
+            stats.update(weight=self._total_weight, max_weight=self.max_weight)
+        return stats
+
+
+class DiskCache:
+    """Cache persistente em SQLite com TTL e limite de número de entradas (despejo LRU)"""
+
+    # Verificar o limite de tamanho apenas a cada N escritas
+    EVICTION_INTERVAL = 100
+
+    def __init__(self, path, max_entries=50000, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    def _connection(self):
+        # Uma ligação por thread e por processo (as ligações sqlite3 não podem ser
+        # partilhadas entre threads nem herdadas pelos workers após o fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key, default=None):
+        now = time.time()
+        conn = self._connection()
+        row = conn.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return default
+        value, created = row
+        with conn:
+            if self.ttl and created + self.ttl < now:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.misses += 1
+                return default
+            conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+        self._writes += 1
+        if self._writes % self.EVICTION_INTERVAL == 0:
+            self.evict()
+
+    def evict(self):
+        """Remove entradas expiradas e as menos usadas acima do limite"""
+        conn = self._connection()
+        with conn:
+            if self.ttl:
+                conn.execute("DELETE FROM cache WHERE created < ?", (time.time() - self.ttl,))
+            count = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            excess = count - self.max_entries
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)",
+                    (excess,)
+                )
+                self.evictions += excess
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+class _Flight:
+    """Cálculo em curso para uma chave, partilhado pelos pedidos concorrentes"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None  # exceção do cálculo, relançada em todos os pedidos que o esperavam
+
+
+class TieredCache:
+    """Cache em dois níveis (memória + disco opcional) com agregação de pedidos concorrentes"""
+
+    def __init__(self, memory, disk=None, dumps=json.dumps, loads=json.loads):
+        self.memory = memory
+        self.disk = disk
+        self.dumps = dumps
+        self.loads = loads
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        if self.disk is not None:
+            raw = self.disk.get(key)
+            if raw is not None:
+                value = self.loads(raw)
+                # Promover para o nível em memória
+                self.memory.set(key, value)
+                return value
+        return None
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, self.dumps(value))
+
+    def get_or_compute(self, key, compute):
+        """Devolve o valor em cache ou calcula-o; pedidos idênticos em simultâneo partilham um só cálculo
+
+        Resultados `None` (por exemplo, falhas do serviço externo) não são guardados.
+        Se o cálculo falhar, a exceção chega a todos os pedidos que o partilhavam.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = compute()
+            if flight.result is not None:
+                self.set(key, flight.result)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+        return flight.result
+
+    def stats(self):
+        stats = {
+            "memory": self.memory.stats(),
+            "coalesced": self.coalesced,
+            "in_flight": len(self._inflight)
+        }
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        return stats
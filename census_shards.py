@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Subsecções de censos em partições espaciais carregadas a pedido
+
+process_data.py (com --shards) grava uma partição Arrow por município e
+guarda nos metadados o retângulo envolvente de cada uma. O servidor mantém
+apenas esse índice: cada pedido carrega as partições cujo retângulo
+intersecta as zonas das estações, e as mais usadas ficam numa cache LRU
+limitada. Uma instalação pode assim servir várias cidades (ou o país) sem
+que cada processo tenha todas as subsecções em memória.
+"""
+import os
+import threading
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from cache import LRUCache, TieredCache
+from census_store import read_census_store
+from projection import transform_geometries
+
+
+def simplify_coverage(geoms, tolerance):
+    """Simplifica as subsecções mantendo as fronteiras partilhadas (sem buracos nem sobreposições novas)
+
+    Com GEOS >= 3.12 (shapely >= 2.1) cada aresta comum é simplificada uma só
+    vez para as duas subsecções; caso contrário, ou se o resultado não for
+    válido (subsecções que não formam uma cobertura), cada polígono é
+    simplificado sozinho, preservando a sua topologia.
+    """
+    if hasattr(shapely, 'coverage_simplify') and len(geoms):
+        simplified = shapely.coverage_simplify(geoms, tolerance)
+        if shapely.is_valid(simplified).all():
+            return simplified
+    return shapely.simplify(geoms, tolerance, preserve_topology=True)
+
+
+class CensusLevel:
+    """Subsecções simplificadas a uma tolerância (metros), com índice espacial e áreas próprios"""
+
+    def __init__(self, geoms, tolerance):
+        self.tolerance = tolerance
+        self.geoms = simplify_coverage(geoms, tolerance)
+        # Subsecções que deixariam de ter área mantêm a geometria original
+        self.areas = shapely.area(self.geoms)
+        collapsed = self.areas <= 0
+        if collapsed.any():
+            self.geoms[collapsed] = geoms[collapsed]
+            self.areas[collapsed] = shapely.area(geoms[collapsed])
+        shapely.prepare(self.geoms)
+        self.tree = shapely.STRtree(self.geoms)
+        self.vertices = int(shapely.get_num_coordinates(self.geoms).sum())
+
+
+class CensusView:
+    """Conjunto de subsecções (uma ou mais partições) com índice espacial e áreas no CRS métrico"""
+
+    def __init__(self, data, areas=None, key=()):
+        self.data = data
+        self.key = key  # partições incluídas (vazio no ficheiro único)
+        self.geoms = np.asarray(data.geometry.values)
+        shapely.prepare(self.geoms)
+        self.areas = np.asarray(areas, dtype=float) if areas is not None else shapely.area(self.geoms)
+        self.tree = shapely.STRtree(self.geoms)
+        self._derived = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.geoms)
+
+    def values(self, columns):
+        """Valores das colunas indicadas como array (subsecções, ou subsecções x colunas)"""
+        return self.data[columns].to_numpy(dtype=float)
+
+    def derived(self, name, build):
+        """Objeto calculado a partir destas subsecções (grelha, avaliador...), construído uma única vez"""
+        with self._lock:
+            if name not in self._derived:
+                self._derived[name] = build(self)
+            return self._derived[name]
+
+    def lod(self, tolerance):
+        """Nível de detalhe com as subsecções simplificadas à tolerância indicada (metros)"""
+        return self.derived(f"lod:{tolerance:g}", lambda view: CensusLevel(view.geoms, tolerance))
+
+
+class ShardedCensus:
+    """Índice das partições (retângulos no CRS métrico) e cache LRU das partições carregadas"""
+
+    def __init__(self, directory, shards, crs, columns=(), max_shards=16, max_views=8, max_view_features=None):
+        self.directory = directory
+        self.crs = crs
+        self.ids = [shard['id'] for shard in shards]
+        self.files = [shard['file'] for shard in shards]
+        self.features = [shard.get('features', 0) for shard in shards]
+        self.bounds = np.array([shard['bbox'] for shard in shards], dtype=float).reshape(-1, 4)
+        self.columns = [col for col in columns if col != 'geometry']
+        # Partições lidas (dados e áreas) e conjuntos de partições com índice espacial. As vistas de
+        # várias partições têm cópias dos seus dados (e todas têm índice e níveis de detalhe próprios),
+        # por isso a sua cache também é limitada pelo total de subsecções
+        self.shards = TieredCache(LRUCache(max_shards))
+        self.views = TieredCache(LRUCache(max_views, max_weight=max_view_features, weight=len))
+
+    @classmethod
+    def from_metadata(cls, metadata, directory, crs, **kwargs):
+        """Cria o índice a partir de metadata.json, convertendo os retângulos se o CRS for outro"""
+        shards = [dict(shard) for shard in metadata['shards']]
+        store_crs = metadata.get('store', {}).get('crs', crs)
+        if shards and store_crs != crs:
+            # Densificar os lados antes de reprojetar para o retângulo continuar a envolver a partição
+            boxes = shapely.box(*np.array([shard['bbox'] for shard in shards], dtype=float).T)
+            boxes = shapely.segmentize(boxes, max_segment_length=1000)
+            bounds = shapely.bounds(transform_geometries(boxes, src_crs=store_crs, dst_crs=crs))
+            for shard, bbox in zip(shards, bounds):
+                shard['bbox'] = bbox.tolist()
+        return cls(directory, shards, crs, metadata.get('columns', ()), **kwargs)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def shards_for(self, bounds):
+        """Índices das partições cujo retângulo intersecta `bounds` (minx, miny, maxx, maxy)"""
+        if bounds is None or np.any(np.isnan(bounds)):
+            return np.empty(0, dtype=np.int64)
+        minx, miny, maxx, maxy = bounds
+        b = self.bounds
+        return np.flatnonzero((b[:, 0] <= maxx) & (b[:, 2] >= minx) & (b[:, 1] <= maxy) & (b[:, 3] >= miny))
+
+    def view(self, bounds):
+        """Subsecções de todas as partições que intersectam o retângulo"""
+        return self.view_of(self.shards_for(bounds).tolist())
+
+    def view_of(self, key):
+        """Subsecções das partições indicadas (índices), partilhadas entre pedidos com as mesmas partições"""
+        key = tuple(sorted(set(key)))
+        return self.views.get_or_compute(key, lambda: self._build_view(key))
+
+    def _build_view(self, key):
+        """Vista das partições indicadas: a própria partição, ou uma cópia das várias juntas (pd.concat)"""
+        parts = [self.shards.get_or_compute(index, lambda index=index: self._load_shard(index)) for index in key]
+        if not parts:
+            empty = gpd.GeoDataFrame({col: pd.Series(dtype=float) for col in self.columns},
+                                     geometry=gpd.GeoSeries([], crs=self.crs))
+            return CensusView(empty, np.empty(0), key)
+        if len(parts) == 1:
+            data, areas = parts[0]
+        else:
+            data = pd.concat([data for data, _ in parts], ignore_index=True)
+            areas = np.concatenate([areas for _, areas in parts])
+        return CensusView(data, areas, key)
+
+    def _load_shard(self, index):
+        """Lê uma partição (memória mapeada) e garante que está no CRS métrico"""
+        data, areas, _ = read_census_store(os.path.join(self.directory, self.files[index]))
+        if data.crs != self.crs:
+            data = data.to_crs(self.crs)
+            areas = None
+        if areas is None:
+            areas = shapely.area(np.asarray(data.geometry.values))
+        print(f"Partição {self.ids[index]} carregada: {len(data):,} subsecções")
+        return data, areas
+
+    def stats(self):
+        return {
+            "shards": len(self.ids),
+            "features": int(sum(self.features)),
+            "loaded": self.shards.stats()["memory"],
+            "views": self.views.stats()["memory"]
+        }
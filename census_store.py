@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Leitura do ficheiro binário colunar (Arrow IPC / Feather v2) com as subsecções de censos
+
+O ficheiro é gerado por process_data.py, com as geometrias em WKB já no CRS
+métrico e colunas pré-calculadas de área e limites. É lido com memória
+mapeada: as colunas numéricas ficam a apontar para as páginas do ficheiro,
+partilhadas entre processos pelo sistema operativo.
+"""
+import json
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from pyproj import CRS
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:  # pyarrow é opcional: sem ele o servidor lê o GeoJSON
+    pa = None
+
+# Colunas pré-calculadas por process_data.py
+DERIVED_COLUMNS = ['area_m2', 'minx', 'miny', 'maxx', 'maxy']
+
+
+def store_available():
+    """Indica se o pyarrow está instalado (necessário para ler o ficheiro binário)"""
+    return pa is not None
+
+
+def column_array(table, name):
+    """Coluna numérica como array numpy (sem cópia quando possível)"""
+    return table.column(name).to_numpy()
+
+
+def read_census_store(path):
+    """Lê o ficheiro Arrow das subsecções com memória mapeada
+
+    Devolve o GeoDataFrame, as áreas (m²) e os limites (n x 4) pré-calculados.
+    """
+    source = pa.memory_map(path, 'r')
+    table = pa.ipc.open_file(source).read_all()
+
+    # Metadados GeoArrow/GeoParquet escritos pelo GeoPandas
+    geo = json.loads(table.schema.metadata[b'geo'])
+    geometry_column = geo['primary_column']
+    crs = geo['columns'][geometry_column].get('crs')
+    crs = CRS.from_user_input(crs) if crs is not None else None
+
+    geometry = shapely.from_wkb(table.column(geometry_column).to_numpy(zero_copy_only=False))
+
+    areas = None
+    bounds = None
+    derived = [name for name in DERIVED_COLUMNS if name in table.column_names]
+    if len(derived) == len(DERIVED_COLUMNS):
+        areas = column_array(table, 'area_m2')
+        bounds = np.column_stack([column_array(table, name) for name in DERIVED_COLUMNS[1:]])
+
+    attributes = table.drop_columns([geometry_column] + derived).to_pandas()
+    gdf = gpd.GeoDataFrame(attributes, geometry=geometry, crs=crs)
+    return gdf, areas, bounds
@@ -0,0 +1,18 @@
+"""
+Configuração do gunicorn para produção
+
+Uso: gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import multiprocessing
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+
+# Carregar a aplicação (e os dados) no processo principal, antes do fork
+preload_app = True
+
+# O carregamento dos dados acontece antes de os workers existirem,
+# por isso o timeout só precisa de cobrir os pedidos
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
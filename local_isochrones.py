@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Motor local de isócronas sobre uma rede pedonal pré-compilada
+
+A rede (gerada por build_walking_graph.py) é guardada como uma matriz de
+adjacência em formato CSR: para o nó `u`, os vizinhos são
+`indices[indptr[u]:indptr[u + 1]]` e os comprimentos dos troços (em metros)
+estão em `lengths` nas mesmas posições. As coordenadas dos nós estão no CRS
+métrico. As isócronas resultam de um Dijkstra multi-origem limitado ao maior
+tempo pedido (scipy.sparse.csgraph sobre a mesma matriz, ou um ciclo em Python
+sem o scipy), seguido de um contorno côncavo dos pontos alcançados.
+"""
+import heapq
+
+import numpy as np
+import shapely
+
+try:
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import dijkstra
+except ImportError:  # Dijkstra em Python puro
+    csr_matrix = dijkstra = None
+
+from projection import DEFAULT_METRIC_CRS, WGS84, transform_geometries, transform_points
+
+# Velocidade a pé: ~5 km/h = ~1.39 m/s
+WALKING_SPEED = 1.39
+
+
+def polygon_to_geojson(polygon):
+    """Geometria GeoJSON de um polígono (ou multipolígono), sem iterar coordenada a coordenada"""
+    def rings(part):
+        return [shapely.get_coordinates(part.exterior).tolist()] + [
+            shapely.get_coordinates(interior).tolist() for interior in part.interiors
+        ]
+
+    if polygon.geom_type == 'MultiPolygon':
+        return {"type": "MultiPolygon", "coordinates": [rings(part) for part in polygon.geoms]}
+    return {"type": "Polygon", "coordinates": rings(polygon)}
+
+
+class WalkingGraph:
+    """Rede pedonal em formato CSR com cálculo de isócronas em memória"""
+
+    def __init__(self, node_xy, indptr, indices, lengths, crs=DEFAULT_METRIC_CRS,
+                 speed=WALKING_SPEED, snap_distance=100.0, hull_ratio=0.3, edge_buffer=15.0):
+        self.node_xy = np.asarray(node_xy, dtype=float)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=float)
+        self.crs = crs
+        self.speed = speed
+        self.snap_distance = snap_distance  # distância máxima do ponto à rede (m)
+        self.hull_ratio = hull_ratio        # parâmetro do contorno côncavo (0 = mais justo)
+        self.edge_buffer = edge_buffer      # margem à volta dos pontos alcançados (m)
+
+        self.costs = self.lengths / speed  # tempo (s) de cada troço
+        if dijkstra is None:
+            # Listas Python para o ciclo do Dijkstra (indexação muito mais rápida que numpy escalar)
+            self._indptr = self.indptr.tolist()
+            self._indices = self.indices.tolist()
+            self._costs = self.costs.tolist()
+
+        self._node_points = shapely.points(self.node_xy)
+        self._node_tree = shapely.STRtree(self._node_points)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """Carrega uma rede guardada por build_walking_graph.py"""
+        with np.load(path, allow_pickle=False) as data:
+            crs = str(data['crs']) if 'crs' in data else DEFAULT_METRIC_CRS
+            return cls(data['node_xy'], data['indptr'], data['indices'], data['lengths'], crs=crs, **kwargs)
+
+    def save(self, path):
+        np.savez(
+            path,
+            node_xy=self.node_xy,
+            indptr=self.indptr,
+            indices=self.indices.astype(np.int32),
+            lengths=self.lengths.astype(np.float32),
+            crs=np.array(self.crs)
+        )
+
+    @property
+    def num_nodes(self):
+        return len(self.node_xy)
+
+    def snap(self, x, y):
+        """Nós da rede próximos do ponto, com o tempo (s) até cada um"""
+        point = shapely.Point(x, y)
+        nodes = self._node_tree.query(point, predicate='dwithin', distance=self.snap_distance)
+        if len(nodes) == 0:
+            return {}
+        distances = np.hypot(self.node_xy[nodes, 0] - x, self.node_xy[nodes, 1] - y)
+        return dict(zip(nodes.tolist(), (distances / self.speed).tolist()))
+
+    def travel_times(self, sources, max_time):
+        """Dijkstra multi-origem limitado: tempo mínimo (s) até cada nó alcançável em `max_time`"""
+        sources = {node: t for node, t in sources.items() if t <= max_time}
+        if not sources:
+            return {}
+        if dijkstra is None:
+            return self._travel_times_python(sources, max_time)
+
+        # Origem virtual (um nó a mais) ligada aos nós de partida pelo tempo até cada um
+        n = self.num_nodes
+        nodes = np.fromiter(sources.keys(), dtype=np.int64, count=len(sources))
+        offsets = np.fromiter(sources.values(), dtype=float, count=len(sources))
+        graph = csr_matrix(
+            (np.r_[self.costs, offsets], np.r_[self.indices, nodes], np.r_[self.indptr, self.indptr[-1] + len(nodes)]),
+            shape=(n + 1, n + 1)
+        )
+        times = dijkstra(graph, indices=n, limit=max_time)[:n]
+        reached = np.flatnonzero(np.isfinite(times))
+        return dict(zip(reached.tolist(), times[reached].tolist()))
+
+    def _travel_times_python(self, sources, max_time):
+        """Como travel_times, com heapq (sem o scipy)"""
+        indptr, indices, costs = self._indptr, self._indices, self._costs
+        best = {}
+        heap = [(t, node) for node, t in sources.items()]
+        heapq.heapify(heap)
+        while heap:
+            t, node = heapq.heappop(heap)
+            if node in best:
+                continue
+            best[node] = t
+            for k in range(indptr[node], indptr[node + 1]):
+                neighbour = indices[k]
+                if neighbour in best:
+                    continue
+                nt = t + costs[k]
+                if nt <= max_time:
+                    heapq.heappush(heap, (nt, neighbour))
+        return best
+
+    def reached_points(self, times, max_time):
+        """Pontos alcançados em `max_time`: nós e extremos parciais dos troços que saem deles"""
+        nodes = np.fromiter((n for n, t in times.items() if t <= max_time), dtype=np.int64)
+        if len(nodes) == 0:
+            return np.empty((0, 2))
+        node_times = np.fromiter((times[n] for n in nodes.tolist()), dtype=float, count=len(nodes))
+
+        # Troços que saem dos nós alcançados, percorridos até onde o tempo restante permite
+        degree = self.indptr[nodes + 1] - self.indptr[nodes]
+        edge_pos = np.repeat(self.indptr[nodes] - np.cumsum(np.r_[0, degree[:-1]]), degree) + np.arange(degree.sum())
+        start = np.repeat(nodes, degree)
+        remaining = np.repeat(max_time - node_times, degree) * self.speed
+        fraction = remaining / np.maximum(self.lengths[edge_pos], 1e-9)
+
+        # Troços percorridos por inteiro terminam num nó já alcançado: só os parciais acrescentam pontos
+        partial = fraction < 1.0
+        origin = self.node_xy[start[partial]]
+        target = self.node_xy[self.indices[edge_pos[partial]]]
+        ends = origin + (target - origin) * fraction[partial, None]
+        return np.vstack([self.node_xy[nodes], ends])
+
+    def isochrone_polygons(self, x, y, ranges):
+        """Polígonos (CRS métrico) das áreas alcançáveis a partir de (x, y) para cada tempo em `ranges`
+
+        Devolve None se o ponto estiver longe da rede.
+        """
+        sources = self.snap(x, y)
+        if not sources:
+            return None
+        times = self.travel_times(sources, max(ranges))
+
+        polygons = []
+        for range_seconds in ranges:
+            points = self.reached_points(times, range_seconds)
+            hull = shapely.concave_hull(shapely.multipoints(points), ratio=self.hull_ratio)
+            hull = shapely.simplify(hull, self.edge_buffer / 3)
+            polygons.append(shapely.buffer(hull, self.edge_buffer, quad_segs=2))
+        return polygons
+
+    def isochrones(self, lat, lng, ranges):
+        """Isócronas no formato GeoJSON do OpenRouteService (WGS84), ou None se o ponto estiver fora da rede"""
+        (x, y), = transform_points([lng], [lat], dst_crs=self.crs)
+        polygons = self.isochrone_polygons(x, y, ranges)
+        if polygons is None:
+            return None
+
+        polygons_wgs84 = transform_geometries(polygons, src_crs=self.crs, dst_crs=WGS84)
+        return [
+            {
+                "type": "Feature",
+                "geometry": polygon_to_geojson(polygon),
+                "properties": {
+                    "group_index": 0,
+                    "value": range_seconds,
+                    "center": [lng, lat]
+                }
+            }
+            for range_seconds, polygon in zip(ranges, polygons_wgs84)
+        ]
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Métricas (formato Prometheus), tempos por etapa e perfis por pedido
+
+Cada pedido tem o seu registo de tempos (numa ContextVar): `stage(nome)` mede
+uma etapa do caminho crítico (chamada ao ORS, reprojeção, procura de
+subsecções candidatas, interseções, ...). O servidor devolve essas etapas no
+cabeçalho Server-Timing e acumula-as em histogramas expostos em /metrics.
+As métricas são de cada processo: com vários workers, cada um tem as suas.
+"""
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Limites (segundos) dos histogramas de latência
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Contador crescente, com etiquetas opcionais"""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Histograma cumulativo (contagens por limite, soma e total), com etiquetas opcionais"""
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # etiquetas -> [contagens por intervalo, soma, total]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labels, key, [("le", _format_value(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    """Conjunto de métricas de um processo, exportadas no formato de texto do Prometheus
+
+    Além dos contadores e histogramas, aceita funções (`collector`) chamadas a
+    cada leitura, que devolvem famílias `(nome, tipo, ajuda, [(etiquetas, valor)])`
+    com valores lidos de outros objetos (ex.: estatísticas das caches).
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help_text, labels=()):
+        metric = Counter(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, collect):
+        self._collectors.append(collect)
+        return collect
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            for name, kind, help_text, samples in collect():
+                lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"])
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels, labels.values())} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram('stage_duration_seconds', 'Duração das etapas dos pedidos', ('stage',))
+
+# Tempos (segundos) das etapas do pedido em curso, por nome
+_TIMINGS = ContextVar('stage_timings', default=None)
+
+
+def start_timings():
+    """Começa o registo de tempos de um pedido; devolve o dicionário das etapas"""
+    timings = {}
+    _TIMINGS.set(timings)
+    return timings
+
+
+@contextmanager
+def stage(name):
+    """Mede uma etapa: soma-a aos tempos do pedido em curso (se houver) e ao histograma"""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start_time
+        timings = _TIMINGS.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed
+        STAGE_SECONDS.observe(elapsed, stage=name)
+
+
+def server_timing(timings, total=None):
+    """Valor do cabeçalho Server-Timing (durações em milissegundos)"""
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+class SamplingProfiler:
+    """Perfil estatístico de uma thread (por exemplo, a de um pedido)
+
+    Uma thread auxiliar regista a pilha da thread observada a cada `interval`
+    segundos. O resultado fica no formato "folded" (uma linha por pilha
+    distinta, com o número de amostras), que flamegraph.pl e speedscope abrem.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = _Tally()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, thread_id=None):
+        self.thread_id = thread_id or threading.get_ident()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='profiler')
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.samples
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def dump(self, path):
+        """Grava as pilhas amostradas (formato folded)"""
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+Cliente do OpenRouteService com ligações reutilizadas e pedidos de isócronas em lote
+
+As chamadas passam por três proteções, partilhadas pelos caminhos síncrono
+(Flask) e assíncrono (asgi.py): um limite de chamadas simultâneas, um limite
+de chamadas por minuto para cada chave de API (a quota do ORS) e um disjuntor
+que, depois de falhas seguidas, deixa de chamar o serviço até uma sonda em
+segundo plano o encontrar de novo disponível. Quando uma chamada não pode ser
+feita a tempo (`queue_timeout`), o cliente devolve None e o servidor usa o
+fallback, em vez de ter os workers parados à espera de um serviço em baixo.
+"""
+import asyncio
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:  # httpx é opcional: só o caminho assíncrono (asgi.py) o usa
+    httpx = None
+
+
+class CircuitBreaker:
+    """Disjuntor: abre depois de `failure_threshold` falhas seguidas (erros, timeouts, 429, 5xx)
+
+    Aberto, recusa as chamadas de imediato. Uma thread em segundo plano chama
+    `probe()` a cada `probe_interval` segundos e fecha-o no primeiro sucesso.
+    """
+
+    def __init__(self, failure_threshold=5, probe_interval=30.0, probe=None):
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.probe = probe
+        self.state = 'closed'
+        self.failures = 0  # falhas seguidas
+        self.trips = 0     # vezes que abriu
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        return self.failure_threshold <= 0 or self.state == 'closed'
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            if self.state == 'open':
+                print(f"OpenRouteService disponível de novo (disjuntor aberto durante {time.monotonic() - self.opened_at:.0f} s)")
+                self.state = 'closed'
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failure_threshold <= 0 or self.state == 'open' or self.failures < self.failure_threshold:
+                return
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self.trips += 1
+        print(f"OpenRouteService: {self.failures} falhas seguidas, a usar o fallback até voltar a responder")
+        threading.Thread(target=self._probe_until_closed, daemon=True, name='ors-probe').start()
+
+    def _probe_until_closed(self):
+        while self.state == 'open':
+            time.sleep(self.probe_interval)
+            try:
+                ok = self.probe() if self.probe else True
+            except Exception as e:
+                print(f"Sonda do OpenRouteService falhou: {e}")
+                ok = False
+            if ok:
+                self.record_success()
+
+    def stats(self):
+        return {"state": self.state, "failures": self.failures, "trips": self.trips}
+
+
+class RateLimiter:
+    """Limite de chamadas por chave (token bucket): `rate` chamadas por `period` segundos, em rajadas até `burst`"""
+
+    def __init__(self, rate, period=60.0, burst=None):
+        self.rate = rate
+        self.period = period
+        self.burst = burst or rate
+        self._buckets = {}  # chave -> (tokens, instante da última atualização)
+        self._lock = threading.Lock()
+
+    def try_acquire(self, key):
+        """Gasta uma chamada da chave; devolve 0 ou, se não houver, os segundos até haver uma"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate / self.period)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0.0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) * self.period / self.rate
+
+
+class ORSClient:
+    """Cliente de isócronas do OpenRouteService
+
+    Usa uma única `requests.Session` (ligações HTTP reutilizadas) e limita o
+    número de chamadas simultâneas ao serviço, partilhado por todos os pedidos.
+    Com várias chaves de API, cada chamada usa a primeira que ainda tem quota.
+    """
+
+    def __init__(self, base_url, api_key=None, timeout=15, max_locations=5, max_concurrency=4,
+                 rate_limit=0, queue_timeout=5.0, failure_threshold=5, probe_interval=30.0, probe_location=None):
+        self.base_url = base_url.rstrip('/')
+        self.api_keys = [key.strip() for key in (api_key or '').split(',') if key.strip()] or [None]
+        self.timeout = timeout
+        self.max_locations = max_locations  # limite de localizações por chamada do ORS
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout  # espera máxima por quota ou por uma vaga antes do fallback
+        self.probe_location = probe_location  # [lng, lat] usada pela sonda do disjuntor
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update(self.headers())
+
+        self.limiter = RateLimiter(rate_limit)
+        self.breaker = CircuitBreaker(failure_threshold, probe_interval, self.probe if probe_location else None)
+        self.outcomes = Counter()  # chamadas por resultado (ok, error, client_error, circuit_open, rate_limited, busy)
+        self._outcomes_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='ors')
+        # Caminho assíncrono: cliente httpx e semáforo criados no ciclo de eventos que os usa
+        self._async_client = None
+        self._async_slots = None
+
+    def headers(self, key=None):
+        headers = {
+            "Accept": "application/json, application/geo+json",
+            "Content-Type": "application/json"
+        }
+        # Adicionar API key se disponível
+        if key:
+            headers["Authorization"] = f"Bearer {key}"
+        return headers
+
+    def count(self, outcome):
+        with self._outcomes_lock:
+            self.outcomes[outcome] += 1
+
+    def stats(self):
+        with self._outcomes_lock:
+            outcomes = dict(self.outcomes)
+        return {**self.breaker.stats(), "keys": len(self.api_keys), "calls": outcomes}
+
+    def _request_body(self, locations, ranges):
+        return {
+            "locations": locations,  # OpenRouteService usa [lng, lat]
+            "range": ranges,  # em segundos
+            "range_type": "time"
+        }
+
+    def _next_key(self):
+        """Chave com quota disponível: (chave, 0), ou (None, segundos até a primeira ter)"""
+        waits = []
+        for key in self.api_keys:
+            wait = self.limiter.try_acquire(key)
+            if wait == 0:
+                return key, 0.0
+            waits.append(wait)
+        return None, min(waits)
+
+    def _acquire_key(self, deadline):
+        while True:
+            key, wait = self._next_key()
+            if wait == 0:
+                return key, True
+            if time.monotonic() + wait > deadline:
+                return None, False
+            time.sleep(wait)
+
+    def _parse_response(self, status_code, read_json, locations):
+        """Features por localização de uma resposta do ORS, registando o resultado no disjuntor"""
+        if status_code != 200:
+            print(f"OpenRouteService retornou status {status_code}")
+            # Quota esgotada e erros do serviço contam como falhas; pedidos inválidos não
+            if status_code == 429 or status_code >= 500:
+                self.breaker.record_failure()
+                self.count('error')
+            else:
+                self.count('client_error')
+            return None
+
+        try:
+            features = read_json().get('features', [])
+        except ValueError as e:
+            print(f"Resposta inválida do OpenRouteService: {e}")
+            self.breaker.record_failure()
+            self.count('error')
+            return None
+        self.breaker.record_success()
+        self.count('ok')
+
+        # Separar as features por localização (group_index indica a localização de origem)
+        per_location = [[] for _ in locations]
+        for feature in features:
+            group = feature.get('properties', {}).get('group_index', 0)
+            if 0 <= group < len(locations):
+                per_location[group].append(feature)
+        return per_location
+
+    def request_isochrones(self, locations, ranges, profile='foot-walking'):
+        """Pede isócronas para até `max_locations` localizações ([lng, lat]) numa única chamada
+
+        Devolve uma lista com as features de cada localização, ou None se a
+        chamada falhar ou não puder ser feita (disjuntor aberto, sem quota ou
+        sem vaga dentro de `queue_timeout`).
+        """
+        if not self.breaker.allow():
+            self.count('circuit_open')
+            return None
+        deadline = time.monotonic() + self.queue_timeout
+        key, acquired = self._acquire_key(deadline)
+        if not acquired:
+            self.count('rate_limited')
+            return None
+        if not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            self.count('busy')
+            return None
+
+        url = f"{self.base_url}/v2/isochrones/{profile}"
+        try:
+            response = self.session.post(
+                url, json=self._request_body(locations, ranges), timeout=self.timeout, headers=self.headers(key)
+            )
+        except requests.exceptions.RequestException as e:
+            print(f"Erro de conexão com OpenRouteService: {e}")
+            self.breaker.record_failure()
+            self.count('error')
+            return None
+        finally:
+            self._slots.release()
+        return self._parse_response(response.status_code, response.json, locations)
+
+    def _chunks(self, locations):
+        return [locations[i:i + self.max_locations] for i in range(0, len(locations), self.max_locations)]
+
+    @staticmethod
+    def _flatten(chunks, chunk_results):
+        results = []
+        for chunk, chunk_result in zip(chunks, chunk_results):
+            if chunk_result is None:
+                results.extend([None] * len(chunk))
+            else:
+                results.extend(features or None for features in chunk_result)
+        return results
+
+    def request_isochrones_batch(self, locations, ranges, profile='foot-walking'):
+        """Pede isócronas para qualquer número de localizações, em chamadas paralelas de `max_locations`
+
+        Devolve uma lista alinhada com `locations`: as features de cada
+        localização, ou None quando a chamada do respetivo bloco falhou.
+        """
+        chunks = self._chunks(locations)
+        futures = [
+            self._executor.submit(self.request_isochrones, chunk, ranges, profile)
+            for chunk in chunks
+        ]
+        return self._flatten(chunks, [future.result() for future in futures])
+
+    def probe(self):
+        """Chamada mínima (uma localização, um minuto) para saber se o serviço já responde"""
+        key, _ = self._next_key()
+        try:
+            response = self.session.post(
+                f"{self.base_url}/v2/isochrones/foot-walking",
+                json=self._request_body([self.probe_location], [60]),
+                timeout=self.timeout, headers=self.headers(key or self.api_keys[0])
+            )
+        except requests.exceptions.RequestException:
+            return False
+        return response.status_code == 200
+
+    # Caminho assíncrono (asyncio + httpx): as chamadas não ocupam threads enquanto esperam
+
+    async def request_isochrones_async(self, locations, ranges, profile='foot-walking'):
+        """Versão assíncrona de `request_isochrones`, com as mesmas proteções"""
+        if not self.breaker.allow():
+            self.count('circuit_open')
+            return None
+        if httpx is None:
+            raise RuntimeError("O caminho assíncrono precisa do httpx (pip install httpx)")
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(
+                timeout=self.timeout, limits=httpx.Limits(max_connections=self.max_concurrency)
+            )
+            self._async_slots = asyncio.Semaphore(self.max_concurrency)
+
+        deadline = time.monotonic() + self.queue_timeout
+        while True:
+            key, wait = self._next_key()
+            if wait == 0:
+                break
+            if time.monotonic() + wait > deadline:
+                self.count('rate_limited')
+                return None
+            await asyncio.sleep(wait)
+        try:
+            await asyncio.wait_for(self._async_slots.acquire(), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            self.count('busy')
+            return None
+
+        url = f"{self.base_url}/v2/isochrones/{profile}"
+        try:
+            response = await self._async_client.post(
+                url, json=self._request_body(locations, ranges), headers=self.headers(key)
+            )
+        except httpx.HTTPError as e:
+            print(f"Erro de conexão com OpenRouteService: {e!r}")
+            self.breaker.record_failure()
+            self.count('error')
+            return None
+        finally:
+            self._async_slots.release()
+        return self._parse_response(response.status_code, response.json, locations)
+
+    async def request_isochrones_batch_async(self, locations, ranges, profile='foot-walking'):
+        """Versão assíncrona de `request_isochrones_batch` (blocos em simultâneo no ciclo de eventos)"""
+        chunks = self._chunks(locations)
+        chunk_results = await asyncio.gather(
+            *(self.request_isochrones_async(chunk, ranges, profile) for chunk in chunks)
+        )
+        return self._flatten(chunks, chunk_results)
+
+    async def aclose(self):
+        """Fecha as ligações do caminho assíncrono (no fim do ciclo de eventos)"""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
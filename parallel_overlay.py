@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Sobreposição em paralelo, por partições espaciais, com o resultado do cálculo em série
+
+Em redes grandes (centenas de estações), as duas etapas pesadas de
+allocate_population são repartidas por um conjunto de processos:
+
+- a partição pela estação mais próxima: as estações são agrupadas por
+  posição, e cada grupo segue com as zonas das estações vizinhas;
+- as interseções região x subsecção: as subsecções candidatas são divididas
+  por cortes k-d dos seus centros em partes de trabalho semelhante (estimado
+  pelo número de vértices), e cada parte segue com as regiões que a tocam.
+  As subsecções não são enviadas: os processos herdam-nas no fork.
+
+Cada processo faz as mesmas operações geométricas, elemento a elemento, que o
+cálculo em série. As áreas de cada par voltam à posição original e as somas
+são feitas no processo principal, pela mesma ordem: o resultado é idêntico.
+"""
+import numpy as np
+import shapely
+
+from population_engine import pair_areas, station_regions
+
+# Função que devolve as geometrias das subsecções com uma dada chave, usada pelos
+# processos do conjunto (herdada no fork, ver init_worker)
+_WORKER_BLOCKS_FOR = None
+
+
+def init_worker(blocks_for):
+    global _WORKER_BLOCKS_FOR
+    _WORKER_BLOCKS_FOR = blocks_for
+
+
+def regions_task(station_xy, zones, i_idx, j_idx, extent):
+    """Tarefa executada nos processos do conjunto: regiões de um grupo de estações"""
+    return station_regions(station_xy, zones, i_idx, j_idx, extent)
+
+
+def areas_task(blocks_key, regions, region_idx, block_idx):
+    """Tarefa executada nos processos do conjunto: áreas dos pares de uma parte das subsecções"""
+    return pair_areas(regions, _WORKER_BLOCKS_FOR(blocks_key), region_idx, block_idx)
+
+
+def kd_split(points, work, target):
+    """Grupos de índices de `points` (n x 2) com trabalho até `target`
+
+    Cada corte é feito no eixo mais comprido do grupo, a meio do seu trabalho.
+    """
+    groups = []
+    pending = [np.arange(len(points))]
+    while pending:
+        idx = pending.pop()
+        if len(idx) < 2 or work[idx].sum() <= target:
+            groups.append(idx)
+            continue
+        xy = points[idx]
+        axis = int(np.ptp(xy[:, 1]) > np.ptp(xy[:, 0]))
+        ordered = idx[np.argsort(xy[:, axis], kind='stable')]
+        cumulative = np.cumsum(work[ordered])
+        cut = min(max(int(np.searchsorted(cumulative, cumulative[-1] / 2)) + 1, 1), len(ordered) - 1)
+        pending.extend([ordered[:cut], ordered[cut:]])
+    return groups
+
+
+class ParallelOverlay:
+    """Executa as etapas pesadas da sobreposição num conjunto de processos
+
+    `blocks_key` identifica as subsecções nos processos (ver init_worker).
+    Com trabalho estimado abaixo de `min_work` (vértices dos pares), os
+    métodos devolvem None e o cálculo continua em série, sem custo de envio.
+    """
+
+    def __init__(self, executor, workers, blocks_key, min_work=2_000_000, shards_per_worker=4):
+        self.executor = executor
+        self.workers = workers
+        self.blocks_key = blocks_key
+        self.min_work = min_work
+        self.shards_per_worker = shards_per_worker  # partes por processo (equilibra partes mais lentas)
+
+    def _target(self, total_work):
+        if total_work < self.min_work or self.workers < 2:
+            return None
+        return total_work / (self.workers * self.shards_per_worker)
+
+    def station_regions(self, station_xy, zones, i_idx, j_idx, extent):
+        """Como population_engine.station_regions, por grupos de estações; lista de (estações, regiões)"""
+        vertices = shapely.get_num_coordinates(zones)
+        pair_work = vertices[i_idx] + vertices[j_idx]
+        target = self._target(pair_work.sum())
+        if target is None:
+            return None
+
+        work = np.bincount(i_idx, weights=pair_work, minlength=len(zones))
+        futures = []
+        for group in kd_split(station_xy, work, target):
+            selected = np.isin(i_idx, group)
+            if not selected.any():
+                continue
+            # As zonas do grupo e das vizinhas, com índices locais pela mesma ordem (desempates iguais)
+            needed = np.unique(np.concatenate([i_idx[selected], j_idx[selected]]))
+            futures.append((needed, self.executor.submit(
+                regions_task, station_xy[needed], zones[needed],
+                np.searchsorted(needed, i_idx[selected]), np.searchsorted(needed, j_idx[selected]), extent
+            )))
+        parts = []
+        for needed, future in futures:
+            stations, regions = future.result()
+            parts.append((needed[stations], regions))
+        return parts
+
+    def pair_areas(self, regions, block_geoms, region_idx, block_idx):
+        """Como population_engine.pair_areas, por partes espaciais das subsecções (None: em série)"""
+        blocks, pair_block = np.unique(block_idx, return_inverse=True)
+        block_vertices = shapely.get_num_coordinates(block_geoms[blocks])
+        pair_work = shapely.get_num_coordinates(regions)[region_idx] + block_vertices[pair_block]
+        target = self._target(pair_work.sum())
+        if target is None:
+            return None
+
+        bounds = shapely.bounds(block_geoms[blocks])
+        centers = (bounds[:, :2] + bounds[:, 2:]) / 2
+        shard_of_block = np.empty(len(blocks), dtype=np.int64)
+        for shard, members in enumerate(kd_split(centers, np.bincount(pair_block, weights=pair_work), target)):
+            shard_of_block[members] = shard
+
+        # Pares agrupados por parte, guardando a posição original de cada um
+        pair_shard = shard_of_block[pair_block]
+        order = np.argsort(pair_shard, kind='stable')
+        starts = np.flatnonzero(np.r_[True, np.diff(pair_shard[order]) != 0])
+        futures = []
+        for positions in np.split(order, starts[1:]):
+            used, local_region = np.unique(region_idx[positions], return_inverse=True)
+            futures.append((positions, self.executor.submit(
+                areas_task, self.blocks_key, regions[used], local_region, block_idx[positions]
+            )))
+
+        areas = np.empty(len(region_idx))
+        for positions, future in futures:
+            areas[positions] = future.result()
+        return areas
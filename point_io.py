@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+Leitura e escrita incrementais de conjuntos de estações (CSV, GeoJSON e GeoParquet)
+
+Os leitores percorrem o ficheiro aos poucos e devolvem uma linha de cada vez,
+válida ou com o erro dessa linha, sem nunca ter o ficheiro inteiro em
+memória: o CSV é lido linha a linha, o GeoJSON feature a feature (numa
+FeatureCollection ou numa sequência de features) e o GeoParquet por grupos
+de linhas. Os escritores produzem a resposta em blocos, à medida que as
+linhas são geradas.
+"""
+import codecs
+import csv
+import io
+import itertools
+import json
+import math
+import os
+
+import numpy as np
+import shapely
+
+from projection import WGS84, transform_points
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow é opcional: sem ele não há GeoParquet
+    pa = None
+
+FORMATS = ('csv', 'geojson', 'parquet')
+EXTENSIONS = {
+    '.csv': 'csv', '.txt': 'csv',
+    '.geojson': 'geojson', '.json': 'geojson', '.geojsonl': 'geojson', '.geojsons': 'geojson',
+    '.parquet': 'parquet', '.geoparquet': 'parquet'
+}
+CONTENT_TYPES = {
+    'text/csv': 'csv',
+    'application/geo+json': 'geojson', 'application/json': 'geojson', 'application/geo+json-seq': 'geojson',
+    'application/vnd.apache.parquet': 'parquet', 'application/x-parquet': 'parquet'
+}
+MEDIA_TYPES = {'csv': 'text/csv', 'geojson': 'application/geo+json', 'parquet': 'application/vnd.apache.parquet'}
+
+# Nomes aceites para as colunas de coordenadas
+LAT_COLUMNS = ('lat', 'latitude', 'y')
+LNG_COLUMNS = ('lng', 'lon', 'long', 'longitude', 'x')
+
+READ_CHUNK_BYTES = 64 * 1024
+PARQUET_BATCH_ROWS = 5000
+
+
+def parquet_available():
+    return pa is not None
+
+
+def detect_format(requested=None, filename=None, content_type=None):
+    """Formato pedido explicitamente, pela extensão do ficheiro ou pelo tipo de conteúdo (ou None)"""
+    if requested:
+        requested = requested.lower()
+        return 'parquet' if requested == 'geoparquet' else requested if requested in FORMATS else None
+    if filename:
+        fmt = EXTENSIONS.get(os.path.splitext(filename.lower())[1])
+        if fmt:
+            return fmt
+    if content_type:
+        return CONTENT_TYPES.get(content_type.split(';')[0].strip().lower())
+    return None
+
+
+def make_point(raw_id, lat, lng, default_id):
+    """Valida uma linha e devolve o ponto {id, lat, lng}; lança ValueError com o motivo"""
+    if lat in (None, '') or lng in (None, ''):
+        raise ValueError("coordenadas em falta")
+    try:
+        lat, lng = float(lat), float(lng)
+    except (TypeError, ValueError):
+        raise ValueError(f"coordenadas inválidas: {lat!r}, {lng!r}")
+    if not (math.isfinite(lat) and math.isfinite(lng)) or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError(f"coordenadas fora dos limites: {lat}, {lng}")
+
+    # IDs numéricos são preservados; os restantes (ou em falta) são gerados
+    if isinstance(raw_id, (int, np.integer)) and not isinstance(raw_id, bool):
+        point_id = int(raw_id)
+    elif isinstance(raw_id, str) and raw_id.strip().isdigit():
+        point_id = int(raw_id.strip())
+    else:
+        point_id = default_id
+    return {'id': point_id, 'lat': lat, 'lng': lng}
+
+
+def read_points(stream, fmt, first_id=0):
+    """Percorre os pontos de um ficheiro (stream binário)
+
+    Gera `(linha, ponto, erro)`: para cada linha, o ponto válido ou a mensagem
+    de erro. As linhas contam a partir de 1 (registos de dados, sem cabeçalho).
+    """
+    readers = {'csv': _read_csv, 'geojson': _read_geojson, 'parquet': _read_parquet}
+    for row, raw_id, lat, lng, error in readers[fmt](stream):
+        if error is None:
+            try:
+                yield row, make_point(raw_id, lat, lng, first_id + row), None
+                continue
+            except ValueError as e:
+                error = str(e)
+        yield row, None, error
+
+
+def _column(fieldnames, candidates):
+    lower = {name.strip().lower(): name for name in fieldnames or []}
+    return next((lower[name] for name in candidates if name in lower), None)
+
+
+def _read_csv(stream):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        # Aceitar também ';' como separador (Excel em português)
+        sample = text.readline()
+        delimiter = ';' if sample.count(';') > sample.count(',') else ','
+        reader = csv.DictReader(itertools.chain([sample], text), delimiter=delimiter)
+        lat_col = _column(reader.fieldnames, LAT_COLUMNS)
+        lng_col = _column(reader.fieldnames, LNG_COLUMNS)
+        id_col = _column(reader.fieldnames, ('id',))
+        if lat_col is None or lng_col is None:
+            raise ValueError("O CSV tem de ter colunas lat e lng")
+        for row, record in enumerate(reader, start=1):
+            lat, lng = record.get(lat_col), record.get(lng_col)
+            if delimiter == ';' and lat and lng:
+                # Vírgula decimal
+                lat, lng = lat.replace(',', '.'), lng.replace(',', '.')
+            yield row, record.get(id_col) if id_col else None, lat, lng, None
+    finally:
+        text.detach()
+
+
+def _read_geojson(stream):
+    row = 0
+    for feature in iter_geojson_features(stream):
+        row += 1
+        if not isinstance(feature, dict):
+            yield row, None, None, None, "feature inválida"
+            continue
+        properties = feature.get('properties') or {}
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type') != 'Point':
+            yield row, None, None, None, f"geometria {geometry.get('type')} (só são aceites pontos)"
+            continue
+        coordinates = geometry.get('coordinates') or []
+        if len(coordinates) < 2:
+            yield row, None, None, None, "ponto sem coordenadas"
+            continue
+        raw_id = properties.get('id', feature.get('id'))
+        yield row, raw_id, coordinates[1], coordinates[0], None
+
+
+def iter_geojson_features(stream):
+    """Features de uma FeatureCollection, de uma Feature ou de uma sequência de features (uma por linha)
+
+    Só o objeto em leitura fica em memória: o texto é lido em blocos e cada
+    feature é descodificada assim que está completa.
+    """
+    reader = _JSONReader(stream)
+    first = reader.peek()
+    if first == '':
+        return
+    if first != '{':
+        raise ValueError("GeoJSON inválido: esperado um objeto")
+
+    # Pode ser uma FeatureCollection (percorrida campo a campo) ou uma sequência de Features
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    key = reader.value()
+    reader.expect(':')
+    members = {}
+    while True:
+        if key == 'features':
+            yield from reader.array_items()
+        else:
+            members[key] = reader.value()
+        if reader.peek() == ',':
+            reader.expect(',')
+            key = reader.value()
+            reader.expect(':')
+            continue
+        reader.expect('}')
+        break
+
+    if members.get('type') == 'Feature':
+        # Uma única feature, possivelmente seguida de outras (GeoJSON Text Sequences)
+        yield members
+        while reader.peek() == '{':
+            yield reader.value()
+
+
+class _JSONReader:
+    """Leitor JSON incremental sobre um stream binário (texto UTF-8 lido em blocos)"""
+
+    WHITESPACE = ' \t\r\n\x1e'  # \x1e: separador das GeoJSON Text Sequences
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8-sig')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        data = self.stream.read(READ_CHUNK_BYTES)
+        if not data:
+            self.eof = True
+            self.buffer = self.buffer[self.pos:] + self.utf8.decode(b'', final=True)
+        else:
+            self.buffer = self.buffer[self.pos:] + self.utf8.decode(data)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Próximo carácter que não é espaço ('' no fim)"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"GeoJSON inválido: esperado '{char}'")
+        self.pos += 1
+
+    def value(self):
+        """Descodifica o próximo valor JSON completo, lendo mais texto se necessário"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise ValueError("GeoJSON inválido ou incompleto")
+                continue
+            # Um número no fim do bloco pode continuar no seguinte
+            if end == len(self.buffer) and not self.eof and not isinstance(value, (dict, list, str)):
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+    def array_items(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ',':
+                self.pos += 1
+                continue
+            self.expect(']')
+            return
+
+
+def _read_parquet(stream):
+    if pa is None:
+        raise ValueError("GeoParquet requer o pyarrow (pip install pyarrow)")
+    parquet = pq.ParquetFile(stream)
+    metadata = parquet.schema_arrow.metadata or {}
+    geo = json.loads(metadata[b'geo']) if b'geo' in metadata else None
+    names = parquet.schema_arrow.names
+    id_col = _column(names, ('id',))
+
+    if geo is not None:
+        geometry_col = geo['primary_column']
+        column_meta = geo['columns'][geometry_col]
+        if column_meta.get('encoding', 'WKB').upper() != 'WKB':
+            raise ValueError(f"Codificação de geometria não suportada: {column_meta['encoding']}")
+        crs = column_meta.get('crs')  # omisso = OGC:CRS84 (lng, lat)
+        columns = [geometry_col] + ([id_col] if id_col else [])
+    else:
+        lat_col, lng_col = _column(names, LAT_COLUMNS), _column(names, LNG_COLUMNS)
+        if lat_col is None or lng_col is None:
+            raise ValueError("O Parquet tem de ser GeoParquet ou ter colunas lat e lng")
+        columns = [lat_col, lng_col] + ([id_col] if id_col else [])
+
+    row = 0
+    for batch in parquet.iter_batches(batch_size=PARQUET_BATCH_ROWS, columns=columns):
+        ids = batch.column(id_col).to_pylist() if id_col else [None] * batch.num_rows
+        errors = [None] * batch.num_rows
+        if geo is not None:
+            geoms = shapely.from_wkb(batch.column(geometry_col).to_numpy(zero_copy_only=False), on_invalid='ignore')
+            is_point = shapely.get_type_id(geoms) == 0
+            empty = shapely.is_empty(geoms) | ~is_point
+            xy = np.full((batch.num_rows, 2), np.nan)
+            xy[~empty] = shapely.get_coordinates(geoms[~empty])
+            if crs is not None and (~empty).any():
+                xy[~empty] = transform_points(xy[~empty, 0], xy[~empty, 1],
+                                              src_crs=_crs_string(crs), dst_crs=WGS84)
+            lngs, lats = xy[:, 0].tolist(), xy[:, 1].tolist()
+            for k in np.flatnonzero(empty):
+                errors[k] = "geometria em falta ou não pontual"
+        else:
+            lats, lngs = batch.column(lat_col).to_pylist(), batch.column(lng_col).to_pylist()
+        for raw_id, lat, lng, error in zip(ids, lats, lngs, errors):
+            row += 1
+            yield row, raw_id, lat, lng, error
+
+
+def _crs_string(crs):
+    """CRS do GeoParquet (PROJJSON ou texto) num formato aceite pelo pyproj"""
+    from pyproj import CRS
+    return CRS.from_user_input(crs).to_string()
+
+
+def csv_chunks(rows, columns, chunk_rows=1000):
+    """CSV em blocos de `chunk_rows` linhas (texto)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for k, row in enumerate(rows, start=1):
+        writer.writerow([row.get(col, '') for col in columns])
+        if k % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def geojson_chunks(rows, properties, chunk_rows=1000):
+    """FeatureCollection de pontos em blocos de `chunk_rows` features (texto)"""
+    parts = ['{"type": "FeatureCollection", "features": [']
+    for k, row in enumerate(rows):
+        feature = {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [row['lng'], row['lat']]},
+            "properties": {col: row.get(col) for col in properties}
+        }
+        parts.append(("," if k else "") + json.dumps(feature, ensure_ascii=False))
+        if len(parts) >= chunk_rows:
+            yield "".join(parts)
+            parts = []
+    parts.append("]}")
+    yield "".join(parts)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Destino de escrita que acumula os bytes até serem recolhidos"""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def parquet_chunks(rows, columns, chunk_rows=5000):
+    """GeoParquet (geometria WKB em WGS84) com um grupo de linhas por bloco (bytes)
+
+    A coluna `id` é gravada como texto e as restantes como reais, com o esquema
+    fixado antes da primeira linha (um bloco só com nulos não muda os tipos).
+    """
+    if pa is None:
+        raise ValueError("GeoParquet requer o pyarrow (pip install pyarrow)")
+    geo = {
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        "columns": {"geometry": {"encoding": "WKB", "geometry_types": ["Point"]}}
+    }
+    schema = pa.schema(
+        [pa.field(col, pa.string() if col == 'id' else pa.float64()) for col in columns]
+        + [pa.field("geometry", pa.binary())],
+        metadata={"geo": json.dumps(geo)}
+    )
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    batch = []
+
+    def write_batch():
+        points = shapely.points(
+            np.array([row['lng'] for row in batch], dtype=float), np.array([row['lat'] for row in batch], dtype=float)
+        )
+        data = {col: [row.get(col) for row in batch] for col in columns}
+        if 'id' in data:
+            # IDs podem ser números ou texto: gravados como texto para a coluna ser homogénea
+            data['id'] = [str(value) if value is not None else None for value in data['id']]
+        data["geometry"] = shapely.to_wkb(points).tolist()
+        writer.write_table(pa.Table.from_pydict(data, schema=schema))
+
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= chunk_rows:
+            write_batch()
+            batch = []
+            yield sink.drain()
+    if batch:
+        write_batch()
+    writer.close()
+    yield sink.drain()
+
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Motor de alocação de população às estações
+
+Cada banda de tempo (5 min, 10 min, ...) é dividida entre as estações que a
+cobrem: cada parte fica com a estação mais próxima. A partição é calculada uma
+vez por pedido e depois intersectada com as subsecções de censos através de
+operações vetorizadas do Shapely 2.
+"""
+import numpy as np
+import scipy.sparse as sp
+import shapely
+
+from metrics import stage
+
+
+def polygonal(geoms):
+    """Mantém só a parte poligonal das geometrias
+
+    As diferenças entre polígonos podem devolver coleções com linhas ou pontos
+    soltos, e as interseções com coleções são muito mais lentas no GEOS.
+    """
+    geoms = np.array(geoms, dtype=object)
+    for k in np.flatnonzero(shapely.get_type_id(geoms) == 7):
+        parts = shapely.get_parts(geoms[k])
+        parts = shapely.get_parts(parts[np.isin(shapely.get_type_id(parts), [3, 6])])
+        geoms[k] = shapely.multipolygons(parts) if len(parts) else shapely.Polygon()
+    return geoms
+
+
+def band_rings(band_zones):
+    """Converte isócronas cumulativas (estações x bandas) em anéis disjuntos por banda"""
+    band_zones = np.asarray(band_zones, dtype=object)
+    rings = band_zones.copy()
+    if rings.shape[1] > 1:
+        # Cada banda exclui a área da banda anterior da mesma estação
+        rings[:, 1:] = polygonal(shapely.difference(band_zones[:, 1:], band_zones[:, :-1]))
+    return rings
+
+
+def closer_halfplanes(station_xy, i_idx, j_idx, extent):
+    """Polígonos dos pontos mais próximos da estação j do que da estação i, para cada par (i, j)"""
+    p_i = station_xy[i_idx]
+    p_j = station_xy[j_idx]
+    direction = p_j - p_i
+    length = np.hypot(direction[:, 0], direction[:, 1])
+
+    # Estações coincidentes: não há bissetriz, o empate é resolvido pelo menor índice
+    coincident = length == 0
+    direction[coincident] = (1.0, 0.0)
+    length[coincident] = 1.0
+    unit = direction / length[:, None]
+    normal = np.column_stack([-unit[:, 1], unit[:, 0]])
+
+    # O semiplano começa na bissetriz (ou muito antes dela, se j ganha o empate)
+    origin = (p_i + p_j) / 2
+    origin[coincident] -= unit[coincident] * extent
+    corners = np.stack([
+        origin + normal * extent,
+        origin + normal * extent + unit * 2 * extent,
+        origin - normal * extent + unit * 2 * extent,
+        origin - normal * extent,
+        origin + normal * extent,
+    ], axis=1)
+
+    halfplanes = shapely.polygons(corners)
+    halfplanes[coincident & (j_idx > i_idx)] = None
+    return halfplanes
+
+
+def station_regions(station_xy, zones, i_idx, j_idx, extent):
+    """Zona de cada estação `i` com pares (i, j) menos as partes mais próximas das estações `j`
+
+    Devolve (estações, regiões), pela ordem das estações. O resultado de cada
+    estação só depende dos seus pares, pela ordem em que aparecem.
+    """
+    halfplanes = closer_halfplanes(station_xy, i_idx, j_idx, extent)
+
+    # Parte da zona j que está mais perto de j do que de i: é retirada à zona i
+    claimed = shapely.intersection(zones[j_idx], halfplanes)
+
+    order = np.argsort(i_idx, kind='stable')
+    i_sorted = i_idx[order]
+    starts = np.flatnonzero(np.r_[True, i_sorted[1:] != i_sorted[:-1]])
+    ends = np.r_[starts[1:], len(i_sorted)]
+    regions = np.empty(len(starts), dtype=object)
+    for k, (start, end) in enumerate(zip(starts, ends)):
+        regions[k] = shapely.difference(zones[i_sorted[start]], shapely.union_all(claimed[order[start:end]]))
+    return i_sorted[starts], regions
+
+
+def nearest_station_partition(station_xy, zones, parallel=None):
+    """Divide as zonas das estações de forma que cada ponto fique com a estação mais próxima que o cobre"""
+    zones = np.asarray(zones, dtype=object)
+    regions = zones.copy()
+    if len(zones) < 2:
+        return regions
+
+    # Apenas pares de zonas que se sobrepõem podem disputar área
+    tree = shapely.STRtree(zones)
+    i_idx, j_idx = tree.query(zones, predicate='intersects')
+    distinct = i_idx != j_idx
+    i_idx, j_idx = i_idx[distinct], j_idx[distinct]
+    if len(i_idx) == 0:
+        return regions
+
+    # Dimensão dos semiplanos suficiente para cobrir todas as zonas
+    minx, miny, maxx, maxy = shapely.total_bounds(zones)
+    extent = 2 * max(maxx - minx, maxy - miny, 1.0)
+    parts = parallel.station_regions(station_xy, zones, i_idx, j_idx, extent) if parallel else None
+    for stations, station_parts in parts or [station_regions(station_xy, zones, i_idx, j_idx, extent)]:
+        regions[stations] = station_parts
+
+    return polygonal(regions)
+
+
+def pair_areas(regions, block_geoms, region_idx, block_idx):
+    """Área da interseção de cada par (região, subsecção)"""
+    return shapely.area(shapely.intersection(regions[region_idx], block_geoms[block_idx]))
+
+
+def area_weights(regions, tree, block_geoms, block_areas, parallel=None):
+    """Frações de área de cada subsecção abrangidas por cada região (matriz esparsa em formato COO)"""
+    with stage('candidates'):
+        region_idx, block_idx = tree.query(regions, predicate='intersects')
+    with stage('intersection'):
+        areas = parallel.pair_areas(regions, block_geoms, region_idx, block_idx) if parallel else None
+        if areas is None:
+            areas = pair_areas(regions, block_geoms, region_idx, block_idx)
+
+    keep = areas > 0
+    region_idx, block_idx, areas = region_idx[keep], block_idx[keep], areas[keep]
+    total = block_areas[block_idx]
+    fractions = np.divide(areas, total, out=np.ones_like(areas), where=total > 0)
+    return region_idx, block_idx, fractions
+
+
+def allocation_matrix(station_xy, band_zones, tree, block_geoms, block_areas, parallel=None):
+    """Matriz esparsa ((estações * bandas) x subsecções) com a fração de cada subsecção atribuída a cada região
+
+    A linha `estação * n_bandas + banda` corresponde à região dessa estação e
+    banda na partição pela estação mais próxima. Com `parallel`
+    (parallel_overlay.ParallelOverlay), as etapas pesadas correm num conjunto
+    de processos, com o mesmo resultado.
+    """
+    with stage('overlap'):
+        rings = band_rings(band_zones)
+        regions = np.empty(rings.shape, dtype=object)
+        for band in range(rings.shape[1]):
+            regions[:, band] = nearest_station_partition(station_xy, rings[:, band], parallel)
+
+    # Todas as bandas de todas as estações numa única passagem sobre as subsecções
+    flat_regions = regions.ravel()
+    region_idx, block_idx, fractions = area_weights(flat_regions, tree, block_geoms, block_areas, parallel)
+    return sp.csr_matrix((fractions, (region_idx, block_idx)), shape=(len(flat_regions), len(block_geoms)))
+
+
+def allocate_population(station_xy, band_zones, tree, block_geoms, block_areas, block_values, parallel=None):
+    """Calcula a população de cada estação em cada banda (matriz estações x bandas), sem duplicações
+
+    `block_values` pode ter várias colunas (subsecções x atributos): todos os
+    atributos usam a mesma matriz de pesos e o resultado fica estações x
+    bandas x atributos.
+    """
+    band_zones = np.asarray(band_zones, dtype=object)
+    weights = allocation_matrix(station_xy, band_zones, tree, block_geoms, block_areas, parallel)
+    totals = weights @ np.asarray(block_values, dtype=float)
+    return totals.reshape(band_zones.shape + totals.shape[1:])
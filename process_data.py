@@ -1,33 +1,175 @@
 #!/usr/bin/env python3
 """
-Script para processar dados do GeoPackage e converter para GeoJSON
+Script para processar dados do GeoPackage e converter para GeoJSON e Arrow (Feather)
+
+O processamento é incremental. Cada extração é identificada pelo hash do seu
+conteúdo e dividida em blocos por freguesia (prefixo do código BGRI2021, ou
+município), também identificados pelo hash: acrescentar ou remover uma
+subsecção só altera o bloco da sua freguesia. Só os blocos novos ou alterados
+são reprojetados e validados (num conjunto de processos) e guardados em
+data/build/chunks; os restantes vêm dessa cache. O manifesto
+(data/build/manifest.json) regista cada construção, e uma execução sem
+blocos alterados termina sem reescrever os dados. Com alterações, as
+partições (--shards) só são reescritas se mudaram; no ficheiro único, o
+Arrow e o GeoJSON são sempre reescritos por inteiro a partir de todos os
+blocos.
+
+Uso:
+    python3 process_data.py                      # BGRI2021_0705 (um ficheiro)
+    python3 process_data.py --shards BGRI2021_*/BGRI2021_*.gpkg
+        # várias extrações (até todo o país), em partições por município
+    python3 process_data.py --force              # ignorar a cache e reprocessar tudo
 """
+import argparse
 import geopandas as gpd
+import glob
+import hashlib
 import json
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
 
-def process_census_data():
-    """Processa o GeoPackage e converte para GeoJSON"""
-    input_file = "BGRI2021_0705/BGRI2021_0705.gpkg"
-    output_file = "data/census_data.geojson"
-    
-    # Criar diretório de dados se não existir
-    os.makedirs("data", exist_ok=True)
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import CRS
+
+from census_store import DERIVED_COLUMNS
+from population_engine import polygonal
+from projection import DEFAULT_METRIC_CRS, WGS84, transform_geometries
+
+# CRS métrico do ficheiro binário (o servidor lê-o sem reprojetar)
+METRIC_CRS = os.getenv('METRIC_CRS', DEFAULT_METRIC_CRS)
+
+# Partições: uma por município (DTMN21 = distrito + concelho), num diretório de data/
+SHARD_COLUMN = 'DTMN21'
+SHARDS_DIR = "data/shards"
+
+# Cache da construção incremental: blocos já reprojetados e validados, e o manifesto
+BUILD_DIR = "data/build"
+CHUNKS_DIR = os.path.join(BUILD_DIR, "chunks")
+MANIFEST_FILE = os.path.join(BUILD_DIR, "manifest.json")
+# Alterar quando a preparação dos blocos mudar, para invalidar a cache
+BUILD_VERSION = 1
+CHUNK_SIZE = 5000  # linhas por bloco (no máximo, dentro de cada chave)
+# Chave estável dos blocos: freguesia (DTMN21 + FR21) do código da subsecção
+CHUNK_KEY_COLUMN = 'BGRI2021'
+CHUNK_KEY_LENGTH = 6
+
+@contextmanager
+def stage(name, timings):
+    """Mede e imprime a duração de uma etapa"""
+    start_time = time.perf_counter()
+    yield
+    timings[name] = round(timings.get(name, 0) + time.perf_counter() - start_time, 3)
+    print(f"  [{name}] {time.perf_counter() - start_time:.2f} s")
+
+def file_sha256(path, previous=None):
+    """Hash do conteúdo de um ficheiro; reutiliza o do manifesto se o tamanho e a data não mudaram"""
+    stat = os.stat(path)
+    if previous and previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns:
+        return previous["sha256"]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def chunk_hash(frame, crs_wkt):
+    """Hash do conteúdo de um bloco (atributos, geometrias WKB e CRS) e da configuração da construção"""
+    digest = hashlib.sha256(json.dumps([BUILD_VERSION, METRIC_CRS, crs_wkt, list(frame.columns)]).encode())
+    attributes = frame.drop(columns=frame.geometry.name)
+    digest.update(pd.util.hash_pandas_object(attributes, index=False).to_numpy().tobytes())
+    for wkb in shapely.to_wkb(frame.geometry.values):
+        digest.update(wkb or b"")
+    return digest.hexdigest()
+
+def prepare_chunk(wkb, src_crs, dst_crs):
+    """Reprojeta e valida um bloco de geometrias (executado no conjunto de processos)
+
+    Devolve as geometrias (WKB) no CRS métrico, reparadas quando inválidas e só
+    com as partes poligonais, quantas foram reparadas e o retângulo em WGS84.
+    """
+    geoms = shapely.from_wkb(wkb)
+    if src_crs != dst_crs:
+        geoms = transform_geometries(geoms, src_crs=src_crs, dst_crs=dst_crs)
+    invalid = ~shapely.is_valid(geoms) & ~shapely.is_missing(geoms)
+    if invalid.any():
+        geoms[invalid] = polygonal(shapely.make_valid(geoms[invalid]))
+    present = ~shapely.is_missing(geoms) & ~shapely.is_empty(geoms)
+    envelopes = transform_geometries(shapely.envelope(geoms[present]), src_crs=dst_crs, dst_crs=WGS84)
+    lonlat_bounds = shapely.total_bounds(envelopes) if present.any() else np.full(4, np.nan)
+    return shapely.to_wkb(geoms), int(invalid.sum()), lonlat_bounds.tolist()
+
+def write_census_store(gdf, output_file):
+    """Grava as subsecções em Arrow IPC (Feather v2) não comprimido, com geometrias WKB no CRS métrico
+
+    Inclui colunas pré-calculadas (área em m² e limites) para que o servidor
+    possa mapear o ficheiro em memória sem recalcular nada.
+    """
+    if gdf.crs != METRIC_CRS:
+        gdf = gdf.to_crs(METRIC_CRS)
     
-    print(f"Lendo arquivo: {input_file}")
-    gdf = gpd.read_file(input_file)
+    geoms = gdf.geometry.values
+    bounds = shapely.bounds(geoms)
+    gdf = gdf.assign(
+        area_m2=shapely.area(geoms),
+        minx=bounds[:, 0],
+        miny=bounds[:, 1],
+        maxx=bounds[:, 2],
+        maxy=bounds[:, 3]
+    )
+    # Sem compressão, para permitir leitura com memória mapeada
+    gdf.to_feather(output_file, compression="uncompressed")
+    return gdf
+
+def write_census_shards(gdf, output_dir, pop_column=None, previous=None):
+    """Grava uma partição Arrow por município (coluna SHARD_COLUMN) e devolve o índice das partições
+
+    Cada entrada do índice tem o ficheiro (relativo a data/), o retângulo
+    envolvente no CRS métrico, o número de subsecções, a população e o hash
+    dos blocos de origem. As partições com o mesmo hash na construção
+    anterior (`previous`, id -> entrada) não são reescritas.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    previous = previous or {}
     
-    # Verificar colunas disponíveis
-    print(f"\nColunas disponíveis: {gdf.columns.tolist()}")
-    print(f"CRS: {gdf.crs}")
-    print(f"Shape: {gdf.shape}")
+    keys = gdf[SHARD_COLUMN].astype(str) if SHARD_COLUMN in gdf.columns else gdf["_source"]
+    shards = []
+    written = 0
+    for key, part in gdf.groupby(keys, sort=True):
+        shard_file = os.path.join(output_dir, f"{key}.arrow")
+        content = hashlib.sha256(json.dumps([key, sorted(set(part["_chunk"]))]).encode()).hexdigest()
+        old = previous.get(key)
+        if old and old.get("hash") == content and os.path.exists(shard_file):
+            shards.append(old)
+            continue
     
-    # Converter para WGS84 (EPSG:4326) se necessário
-    if gdf.crs != "EPSG:4326":
-        print(f"Convertendo de {gdf.crs} para EPSG:4326...")
-        gdf = gdf.to_crs("EPSG:4326")
+        part = part.drop(columns=["_source", "_chunk"]).reset_index(drop=True)
+        write_census_store(part, shard_file)
+        written += 1
+        shards.append({
+            "id": key,
+            "file": os.path.relpath(shard_file, os.path.dirname(output_dir)),
+            "bbox": [float(v) for v in part.total_bounds],
+            "features": len(part),
+            "population": float(part[pop_column].sum()) if pop_column else None,
+            "hash": content
+        })
+        print(f"  Partição {key}: {len(part):,} subsecções")
     
-    # Procurar coluna de população
+    # Remover partições que já não existem (ex.: municípios retirados)
+    current = {os.path.basename(shard["file"]) for shard in shards}
+    for old_file in glob.glob(os.path.join(output_dir, "*.arrow")):
+        if os.path.basename(old_file) not in current:
+            os.remove(old_file)
+    print(f"  {written} partições escritas, {len(shards) - written} sem alterações")
+    return shards
+
+def find_pop_column(gdf):
+    """Procura a coluna de população (N_INDIVIDUOS ou semelhante)"""
     # Prioridade: N_INDIVIDUOS (número de indivíduos/residentes)
     if 'N_INDIVIDUOS' in gdf.columns:
         pop_column = 'N_INDIVIDUOS'
@@ -35,7 +177,7 @@ def process_census_data():
     else:
         # Procurar por outras colunas que possam conter população
         pop_columns = [col for col in gdf.columns if 'INDIVIDUOS' in col.upper() or 'POP' in col.upper() or 'HABITANTES' in col.upper() or 'RESIDENTES' in col.upper()]
-        
+    
         if pop_columns:
             pop_column = pop_columns[0]
             print(f"\nColuna de população encontrada: {pop_column}")
@@ -50,35 +192,250 @@ def process_census_data():
             else:
                 pop_column = None
                 print("\nAVISO: Nenhuma coluna de população encontrada!")
+    return pop_column
+
+def load_manifest():
+    if os.path.exists(MANIFEST_FILE):
+        with open(MANIFEST_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+def chunk_file(content_hash):
+    return os.path.join(CHUNKS_DIR, f"{content_hash}.arrow")
+
+def chunk_keys(gdf):
+    """Chave do bloco de cada linha: prefixo do código BGRI2021, município ou, sem nenhum deles, uma só chave"""
+    if CHUNK_KEY_COLUMN in gdf.columns:
+        return CHUNK_KEY_COLUMN, gdf[CHUNK_KEY_COLUMN].astype(str).str[:CHUNK_KEY_LENGTH].to_numpy()
+    if SHARD_COLUMN in gdf.columns:
+        return SHARD_COLUMN, gdf[SHARD_COLUMN].astype(str).to_numpy()
+    return None, np.full(len(gdf), "")
+
+def chunk_rows(keys, chunk_size):
+    """Linhas de cada bloco: as de cada chave (pela ordem em que aparecem), em grupos de até `chunk_size`
+
+    Acrescentar ou remover uma linha só altera os blocos da sua chave.
+    """
+    _, first, inverse, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+    groups = np.split(np.argsort(inverse.ravel(), kind="stable"), np.cumsum(counts)[:-1])
+    blocks = []
+    for group in np.argsort(first, kind="stable"):
+        rows = groups[group]
+        blocks += [(str(keys[rows[0]]), rows[start:start + chunk_size]) for start in range(0, len(rows), chunk_size)]
+    return blocks
+
+def build_chunks(input_files, manifest, workers, chunk_size, force, timings):
+    """Prepara os blocos de todas as extrações, reutilizando os que já estão na cache
+
+    Devolve as entradas do manifesto de cada extração e quantos blocos foram
+    (re)construídos.
+    """
+    inputs = {}
+    pending = []  # (extração, índice do bloco, hash, atributos, CRS de origem, WKB)
+    # Blocos da construção anterior (de qualquer extração), com o retângulo e as reparações
+    known = {chunk["hash"]: chunk for entry in manifest.get("inputs", {}).values() for chunk in entry["chunks"]}
+    
+    for input_file in input_files:
+        previous = manifest.get("inputs", {}).get(input_file)
+        with stage("hash", timings):
+            content = file_sha256(input_file, previous)
+        stat = os.stat(input_file)
+        if (not force and previous and previous["sha256"] == content and previous.get("chunk_size") == chunk_size
+                and "chunk_key" in previous and all(os.path.exists(chunk_file(chunk["hash"])) for chunk in previous["chunks"])):
+            print(f"Sem alterações: {input_file}")
+            inputs[input_file] = dict(previous, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            continue
+    
+        print(f"Lendo arquivo: {input_file}")
+        with stage("leitura", timings):
+            gdf = gpd.read_file(input_file)
+        crs_wkt = CRS.from_user_input(gdf.crs).to_wkt()
+        key_column, keys = chunk_keys(gdf)
+        chunks = []
+        with stage("hash", timings):
+            for index, (key, rows) in enumerate(chunk_rows(keys, chunk_size)):
+                frame = gdf.iloc[rows]
+                chunk = {"key": key, "hash": chunk_hash(frame, crs_wkt), "rows": len(frame)}
+                chunks.append(chunk)
+                if force or chunk["hash"] not in known or not os.path.exists(chunk_file(chunk["hash"])):
+                    pending.append((input_file, index, chunk["hash"], frame.drop(columns=frame.geometry.name),
+                                    crs_wkt, shapely.to_wkb(frame.geometry.values)))
+        inputs[input_file] = {
+            "sha256": content,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "rows": len(gdf),
+            "chunk_size": chunk_size,
+            "chunk_key": key_column,
+            "chunks": [dict(known.get(chunk["hash"], {}), **chunk) for chunk in chunks]
+        }
+        print(f"  {len(chunks)} blocos, {sum(p[0] == input_file for p in pending)} a processar")
+    
+    if pending:
+        os.makedirs(CHUNKS_DIR, exist_ok=True)
+        with stage("reprojeção e validação", timings):
+            args = [(wkb, CRS.from_wkt(crs_wkt).to_string(), METRIC_CRS) for *_, crs_wkt, wkb in pending]
+            if workers > 1 and len(pending) > 1:
+                with ProcessPoolExecutor(min(workers, len(pending))) as executor:
+                    results = list(executor.map(prepare_chunk, *zip(*args)))
+            else:
+                results = [prepare_chunk(*arg) for arg in args]
+    
+        with stage("cache de blocos", timings):
+            for (input_file, index, content, attributes, _, _), (wkb, repaired, lonlat_bounds) in zip(pending, results):
+                frame = gpd.GeoDataFrame(attributes, geometry=shapely.from_wkb(wkb), crs=METRIC_CRS)
+                frame.to_feather(chunk_file(content))
+                inputs[input_file]["chunks"][index].update(repaired=repaired, lonlat_bounds=lonlat_bounds)
+                if repaired:
+                    print(f"  {input_file} bloco {index}: {repaired} geometrias reparadas")
+    
+    return inputs, len(pending)
+
+def assemble(inputs, timings):
+    """Junta os blocos preparados de todas as extrações, pela ordem original, com as colunas derivadas"""
+    with stage("montagem", timings):
+        frames = []
+        for input_file, entry in inputs.items():
+            source = os.path.splitext(os.path.basename(input_file))[0]
+            for chunk in entry["chunks"]:
+                frame = gpd.read_feather(chunk_file(chunk["hash"]))
+                frames.append(frame.assign(_source=source, _chunk=chunk["hash"]))
+        gdf = gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs=METRIC_CRS)
     
-    # Salvar como GeoJSON
-    print(f"\nSalvando em: {output_file}")
-    gdf.to_file(output_file, driver="GeoJSON")
+        # Subsecções sem geometria (ou vazias depois de reparadas) não entram nos dados
+        missing = shapely.is_missing(gdf.geometry.values) | shapely.is_empty(gdf.geometry.values)
+        if missing.any():
+            print(f"  AVISO: {int(missing.sum())} subsecções sem geometria ignoradas")
+            gdf = gdf[~missing].reset_index(drop=True)
+    return gdf
+
+def chunk_hashes(inputs):
+    """Hashes dos blocos de cada extração, pela ordem da montagem"""
+    return [(input_file, [chunk["hash"] for chunk in entry["chunks"]]) for input_file, entry in inputs.items()]
+
+def lonlat_bounds(inputs):
+    """Retângulo (WGS84) de todas as extrações, a partir dos retângulos dos blocos"""
+    bounds = np.array([chunk["lonlat_bounds"] for entry in inputs.values() for chunk in entry["chunks"]], dtype=float)
+    return {
+        "minx": float(np.nanmin(bounds[:, 0])),
+        "miny": float(np.nanmin(bounds[:, 1])),
+        "maxx": float(np.nanmax(bounds[:, 2])),
+        "maxy": float(np.nanmax(bounds[:, 3]))
+    }
+
+def process_census_data(input_files=None, shards=False, workers=None, chunk_size=CHUNK_SIZE, force=False):
+    """Processa o(s) GeoPackage(s) e converte para GeoJSON e Arrow (Feather), ou para partições por município"""
+    input_files = input_files or ["BGRI2021_0705/BGRI2021_0705.gpkg"]
+    output_file = "data/census_data.geojson"
+    store_file = "data/census_data.arrow"
+    workers = workers or os.cpu_count() or 1
+    mode = "shards" if shards else "single"
+    
+    # Criar diretório de dados se não existir
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    
+    start_time = time.perf_counter()
+    timings = {}
+    manifest = load_manifest()
+    inputs, built = build_chunks(input_files, manifest, workers, chunk_size, force, timings)
+    
+    outputs = [os.path.join("data", "metadata.json")] + ([SHARDS_DIR] if shards else [store_file, output_file])
+    # Os mesmos blocos, pela mesma ordem, dão os mesmos dados (mesmo que o ficheiro de entrada tenha mudado)
+    unchanged = (
+        not force and built == 0 and manifest.get("mode") == mode
+        and chunk_hashes(manifest.get("inputs", {})) == chunk_hashes(inputs)
+        and all(os.path.exists(path) for path in outputs)
+    )
+    if unchanged:
+        if inputs != manifest.get("inputs"):
+            with open(MANIFEST_FILE, "w", encoding="utf-8") as f:
+                json.dump(dict(manifest, inputs=inputs, chunks_built=0), f, indent=2, ensure_ascii=False)
+        print(f"\nNada a fazer: dados sem alterações ({time.perf_counter() - start_time:.2f} s)")
+        return manifest.get("pop_column")
+    
+    gdf = assemble(inputs, timings)
+    
+    # Verificar colunas disponíveis
+    columns = [col for col in gdf.columns if col not in ("_source", "_chunk", *DERIVED_COLUMNS)]
+    print(f"\nColunas disponíveis: {columns}")
+    print(f"Shape: {gdf.shape}")
+    
+    # Procurar coluna de população
+    pop_column = find_pop_column(gdf[columns])
     
     # Criar um arquivo de metadados
     metadata = {
         "pop_column": pop_column,
         "total_features": len(gdf),
-        "bounds": {
-            "minx": float(gdf.total_bounds[0]),
-            "miny": float(gdf.total_bounds[1]),
-            "maxx": float(gdf.total_bounds[2]),
-            "maxy": float(gdf.total_bounds[3])
-        },
-        "columns": gdf.columns.tolist()
+        "bounds": lonlat_bounds(inputs),
+        "columns": columns
     }
     
+    if shards:
+        print(f"\nSalvando partições em: {SHARDS_DIR}")
+        with stage("partições", timings):
+            shard_index = write_census_shards(
+                gdf[columns + ["_source", "_chunk"]], SHARDS_DIR, pop_column,
+                {shard["id"]: shard for shard in manifest.get("shards", [])} if not force else None
+            )
+        metadata.update(
+            numeric_columns=gdf[columns].select_dtypes(include="number").columns.tolist(),
+            shards=shard_index,
+            store={"dir": os.path.basename(SHARDS_DIR), "format": "arrow", "crs": METRIC_CRS}
+        )
+    else:
+        gdf = gdf[columns]
+    
+        # Ficheiro binário colunar no CRS métrico (lido preferencialmente pelo servidor)
+        print(f"\nSalvando em: {store_file}")
+        with stage("arrow", timings):
+            write_census_store(gdf, store_file)
+    
+        # Salvar como GeoJSON (WGS84)
+        print(f"Salvando em: {output_file}")
+        with stage("geojson", timings):
+            gdf.to_crs("EPSG:4326").to_file(output_file, driver="GeoJSON")
+        metadata["store"] = {"file": os.path.basename(store_file), "format": "arrow", "crs": METRIC_CRS}
+    
     with open("data/metadata.json", "w", encoding="utf-8") as f:
         json.dump(metadata, f, indent=2, ensure_ascii=False)
     
+    # Manifesto da construção (entradas, blocos, partições e tempos)
+    timings["total"] = round(time.perf_counter() - start_time, 3)
+    referenced = {chunk["hash"] for entry in inputs.values() for chunk in entry["chunks"]}
+    for old_chunk in glob.glob(os.path.join(CHUNKS_DIR, "*.arrow")):
+        if os.path.splitext(os.path.basename(old_chunk))[0] not in referenced:
+            os.remove(old_chunk)
+    with open(MANIFEST_FILE, "w", encoding="utf-8") as f:
+        json.dump({
+            "version": BUILD_VERSION,
+            "built_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "mode": mode,
+            "metric_crs": METRIC_CRS,
+            "pop_column": pop_column,
+            "inputs": inputs,
+            "chunks_built": built,
+            "shards": metadata.get("shards", []),
+            "outputs": outputs,
+            "timings": timings
+        }, f, indent=2, ensure_ascii=False)
+    
     print("\nProcessamento concluído!")
-    print(f"Total de features: {len(gdf)}")
+    print(f"Total de features: {len(gdf)}" + (f" em {len(metadata['shards'])} partições" if shards else ""))
     if pop_column:
-        total_pop = gdf[pop_column].sum() if pop_column in gdf.columns else 0
-        print(f"População total: {total_pop:,.0f}")
+        print(f"População total: {gdf[pop_column].sum():,.0f}")
+    print(f"Tempo total: {timings['total']:.2f} s ({built} blocos processados)")
     
     return pop_column
 
 if __name__ == "__main__":
-    process_census_data()
-
+    parser = argparse.ArgumentParser(description="Processa as extrações da BGRI para o servidor")
+    parser.add_argument("inputs", nargs="*", help="GeoPackages da BGRI (por omissão BGRI2021_0705)")
+    parser.add_argument("--shards", action="store_true",
+                        help="Gravar partições por município carregadas a pedido pelo servidor")
+    parser.add_argument("--workers", type=int, help="Processos para reprojetar e validar (por omissão, um por CPU)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Máximo de subsecções por bloco (em cada freguesia)")
+    parser.add_argument("--force", action="store_true", help="Ignorar a cache e reprocessar tudo")
+    args = parser.parse_args()
+    process_census_data(args.inputs, shards=args.shards, workers=args.workers,
+                        chunk_size=args.chunk_size, force=args.force)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Reprojeção vetorizada de pontos e geometrias com transformadores pyproj em cache
+"""
+from functools import lru_cache
+
+import numpy as np
+import shapely
+from pyproj import Transformer
+
+# CRS métrico por omissão para cálculos de área e distância
+# (PT-TM06/ETRS89, o CRS nativo da BGRI)
+DEFAULT_METRIC_CRS = 'EPSG:3763'
+WGS84 = 'EPSG:4326'
+
+
+@lru_cache(maxsize=None)
+def get_transformer(src_crs, dst_crs):
+    """Devolve o transformador (em cache) para o par de CRS indicado"""
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+def transform_points(xs, ys, src_crs=WGS84, dst_crs=DEFAULT_METRIC_CRS):
+    """Reprojeta arrays de coordenadas numa única chamada, devolvendo um array (n, 2)"""
+    transformer = get_transformer(str(src_crs), str(dst_crs))
+    x, y = transformer.transform(np.asarray(xs, dtype=float), np.asarray(ys, dtype=float))
+    return np.column_stack([x, y])
+
+
+def transform_geometries(geoms, src_crs=WGS84, dst_crs=DEFAULT_METRIC_CRS):
+    """Reprojeta um array de geometrias com uma única chamada vetorizada sobre todas as coordenadas"""
+    transformer = get_transformer(str(src_crs), str(dst_crs))
+
+    def _transform(coords):
+        x, y = transformer.transform(coords[:, 0], coords[:, 1])
+        return np.column_stack([x, y])
+
+    return shapely.transform(np.asarray(geoms, dtype=object), _transform)
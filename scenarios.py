@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Avaliação de vários cenários (conjuntos de estações) num só pedido
+
+A região de uma estação na partição pela estação mais próxima depende apenas
+das estações do cenário cujas zonas se sobrepõem à sua (a vizinhança). Cada
+par (estação, vizinhança) distinto é calculado uma única vez e reutilizado
+por todos os cenários em que aparece: a estação sozinha, ou com os mesmos
+vizinhos em vários cenários, tem sempre a mesma população. As partes
+disputadas entre pares de estações também são calculadas uma só vez. As
+regiões distintas são independentes e podem ser divididas por um conjunto
+de processos.
+"""
+import numpy as np
+import shapely
+
+from population_engine import area_weights, band_rings, closer_halfplanes, polygonal
+
+# Número mínimo de regiões por processo para compensar o envio para o conjunto
+MIN_TASKS_PER_WORKER = 16
+
+# Função que devolve o avaliador das subsecções com uma dada chave, usada pelos
+# processos do conjunto (herdada no fork, ver init_worker)
+_WORKER_EVALUATOR_FOR = None
+
+
+def init_worker(evaluator_for):
+    global _WORKER_EVALUATOR_FOR
+    _WORKER_EVALUATOR_FOR = evaluator_for
+
+
+def neighbourhood_task(census_key, station_xy, rings, extent, tasks):
+    """Tarefa executada nos processos do conjunto"""
+    return _WORKER_EVALUATOR_FOR(census_key).neighbourhood_populations(station_xy, rings, extent, tasks)
+
+
+class ScenarioEvaluator:
+    """Calcula a população de vários cenários reutilizando o trabalho comum entre eles"""
+
+    def __init__(self, tree, block_geoms, block_areas, block_values, census_key=()):
+        self.tree = tree
+        self.block_geoms = block_geoms
+        self.block_areas = block_areas
+        self.block_values = block_values
+        self.census_key = census_key  # identifica as subsecções nos processos do conjunto
+
+    def neighbourhood_populations(self, station_xy, rings, extent, tasks):
+        """População de cada banda da estação `i` de cada tarefa `(i, vizinhos)` (tarefas x bandas)"""
+        n_tasks, n_bands = len(tasks), rings.shape[1]
+
+        # Pares (estação, vizinho) distintos entre todas as tarefas
+        pair_index = {}
+        task_pairs = []
+        for i, neighbours in tasks:
+            task_pairs.append([pair_index.setdefault((i, j), len(pair_index)) for j in neighbours])
+
+        regions = np.empty((n_tasks, n_bands), dtype=object)
+        task_stations = np.array([i for i, _ in tasks], dtype=np.int64)
+        regions[:] = rings[task_stations]
+        if pair_index:
+            i_idx, j_idx = (np.array(side, dtype=np.int64) for side in zip(*pair_index))
+            halfplanes = closer_halfplanes(station_xy, i_idx, j_idx, extent)
+            for band in range(n_bands):
+                # Parte da zona do vizinho j que está mais perto de j do que de i
+                claimed = shapely.intersection(rings[j_idx, band], halfplanes)
+                for task, pairs in enumerate(task_pairs):
+                    if pairs:
+                        regions[task, band] = shapely.difference(
+                            regions[task, band], shapely.union_all(claimed[pairs])
+                        )
+
+        flat_regions = polygonal(regions.ravel())
+        region_idx, block_idx, fractions = area_weights(flat_regions, self.tree, self.block_geoms, self.block_areas)
+        totals = np.bincount(region_idx, weights=self.block_values[block_idx] * fractions, minlength=len(flat_regions))
+        return totals.reshape(n_tasks, n_bands)
+
+    def evaluate(self, station_xy, band_zones, scenarios, executor=None, workers=1):
+        """Calcula os cenários (listas de índices das estações distintas)
+
+        Devolve, para cada cenário, a matriz (estações do cenário x bandas), e
+        quantas regiões foram calculadas e quantas reutilizadas.
+        """
+        band_zones = np.asarray(band_zones, dtype=object)
+        rings = band_rings(band_zones)
+        minx, miny, maxx, maxy = shapely.total_bounds(band_zones)
+        extent = 2 * max(maxx - minx, maxy - miny, 1.0)
+
+        # Estações cujas zonas (todas as bandas) se sobrepõem
+        outer = shapely.union_all(band_zones, axis=1)
+        i_idx, j_idx = shapely.STRtree(outer).query(outer, predicate='intersects')
+        overlapping = [set() for _ in range(len(outer))]
+        for i, j in zip(i_idx.tolist(), j_idx.tolist()):
+            if i != j:
+                overlapping[i].add(j)
+
+        # Uma tarefa por estação e vizinhança distinta
+        task_index = {}
+        scenario_tasks = []
+        for members in scenarios:
+            member_set = set(members)
+            keys = [(i, tuple(sorted(overlapping[i] & member_set))) for i in members]
+            scenario_tasks.append([task_index.setdefault(key, len(task_index)) for key in keys])
+        tasks = list(task_index)
+
+        chunks = min(workers, len(tasks) // MIN_TASKS_PER_WORKER)
+        if executor is not None and chunks > 1:
+            parts = [tasks[k::chunks] for k in range(chunks)]
+            results = executor.map(
+                neighbourhood_task, [self.census_key] * chunks, [station_xy] * chunks, [rings] * chunks,
+                [extent] * chunks, parts
+            )
+            task_populations = np.empty((len(tasks), rings.shape[1]))
+            for k, part_populations in enumerate(results):
+                task_populations[k::chunks] = part_populations
+        else:
+            task_populations = self.neighbourhood_populations(station_xy, rings, extent, tasks)
+
+        populations = [task_populations[np.array(indices, dtype=np.int64)] for indices in scenario_tasks]
+        total_uses = sum(len(indices) for indices in scenario_tasks)
+        return populations, {"computed": len(tasks), "reused": total_uses - len(tasks)}
@@ -2,18 +2,45 @@
 """
 Servidor Flask para servir dados de censos e calcular população em isócronas
 """
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, g, jsonify, make_response, request, send_from_directory, stream_with_context
 from flask_cors import CORS
 import geopandas as gpd
 import json
 import os
-import requests
 import csv
 import io
+import shutil
+import tempfile
+import re
+import unicodedata
+import threading
 import time
+import uuid
+import hashlib
+import base64
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy.sparse as sp
+import shapely
 from dotenv import load_dotenv
-from shapely.geometry import Point, shape
-from shapely.ops import unary_union
+from shapely.geometry import mapping, shape
+from cache import DiskCache, LRUCache, TieredCache
+from census_shards import CensusView, ShardedCensus
+from census_store import read_census_store, store_available
+from local_isochrones import WALKING_SPEED, WalkingGraph
+from metrics import REGISTRY, SamplingProfiler, server_timing, stage, start_timings
+from ors_client import ORSClient
+from point_io import MEDIA_TYPES, csv_chunks, detect_format, geojson_chunks, parquet_available, parquet_chunks, read_points
+from parallel_overlay import ParallelOverlay, init_worker as init_overlay_worker
+from population_engine import allocate_population
+from population_grid import PopulationGrid
+from scenarios import ScenarioEvaluator, init_worker
+from sessions import PlanningSession, SessionStore
+from tiles import TILE_EXTENT, encode_geojson, encode_mvt, tile_area, tile_bounds, tile_geometries, tile_latitude, valid_tile
+from station_optimizer import CoverageProblem, coverage_matrix, grid_candidates
+from projection import DEFAULT_METRIC_CRS, WGS84, transform_geometries, transform_points
 
 # Carregar variáveis de ambiente do ficheiro .env
 load_dotenv()
@@ -28,56 +55,462 @@ if not ORS_API_KEY:
     print("AVISO: ORS_API_KEY não definida! Copia .env.example para .env e adiciona a tua chave.")
     print("       Obter chave em: https://openrouteservice.org/dev/#/signup")
 
+# Cliente do OpenRouteService (ligações reutilizadas, chamadas em lote e em paralelo)
+# ORS_BASE_URL permite apontar para uma instância própria ou um servidor de testes.
+# ORS_API_KEY aceita várias chaves separadas por vírgulas, cada uma com ORS_RATE_LIMIT
+# chamadas por minuto (0 sem limite); sem quota ou vaga em ORS_QUEUE_TIMEOUT segundos,
+# e com o disjuntor aberto (ORS_BREAKER_FAILURES falhas seguidas), usa-se o fallback
+ORS_CLIENT = ORSClient(
+    os.getenv('ORS_BASE_URL', 'https://api.openrouteservice.org'),
+    api_key=ORS_API_KEY,
+    timeout=float(os.getenv('ORS_TIMEOUT', '15')),
+    max_locations=int(os.getenv('ORS_MAX_LOCATIONS', '5')),
+    max_concurrency=int(os.getenv('ORS_MAX_CONCURRENCY', '4')),
+    rate_limit=float(os.getenv('ORS_RATE_LIMIT', '20')),
+    queue_timeout=float(os.getenv('ORS_QUEUE_TIMEOUT', '5')),
+    failure_threshold=int(os.getenv('ORS_BREAKER_FAILURES', '5')),
+    probe_interval=float(os.getenv('ORS_BREAKER_PROBE_SECONDS', '30')),
+    probe_location=[float(v) for v in os.getenv('ORS_PROBE_LOCATION', '-7.9075,38.5667').split(',')]
+)
+
+# CRS métrico usado nos cálculos de população
+METRIC_CRS = os.getenv('METRIC_CRS', DEFAULT_METRIC_CRS)
+
+# Motor de isócronas: 'ors' (OpenRouteService), 'local' (rede pedonal pré-compilada
+# com build_walking_graph.py) ou 'circle' (círculos, sem dependências externas)
+ISOCHRONE_BACKENDS = ('ors', 'local', 'circle')
+ISOCHRONE_BACKEND = os.getenv('ISOCHRONE_BACKEND', 'ors')
+WALKING_GRAPH_FILE = os.getenv('WALKING_GRAPH_FILE', 'data/walking_graph.npz')
+WALKING_GRAPH = None
+
+# Bandas de tempo (segundos) por omissão e número máximo de bandas por pedido
+DEFAULT_RANGES = [300, 600]
+MAX_RANGES = int(os.getenv('MAX_RANGES', '10'))
+MAX_RANGE_SECONDS = 3600
+# Localizações por pedido de isócronas em lote (cada pedido dá várias chamadas ao ORS)
+MAX_BATCH_LOCATIONS = int(os.getenv('MAX_BATCH_LOCATIONS', '500'))
+
+# Perfis de isócronas aceites pelo OpenRouteService
+ISOCHRONE_PROFILES = ('foot-walking', 'foot-hiking', 'wheelchair', 'cycling-regular', 'driving-car')
+
+# Cache de isócronas: memória (LRU) + disco (SQLite em data/), com TTL
+ISOCHRONE_SNAP_DECIMALS = int(os.getenv('ISOCHRONE_SNAP_DECIMALS', '5'))  # ~1 m
+ISOCHRONE_CACHE_TTL = int(os.getenv('ISOCHRONE_CACHE_TTL', str(7 * 24 * 3600)))
+ISOCHRONE_CACHE_DISK = os.getenv('ISOCHRONE_CACHE_DISK', 'data/isochrone_cache.sqlite')
+ISOCHRONE_CACHE = TieredCache(
+    LRUCache(int(os.getenv('ISOCHRONE_CACHE_SIZE', '1024')), ttl=ISOCHRONE_CACHE_TTL),
+    DiskCache(ISOCHRONE_CACHE_DISK, int(os.getenv('ISOCHRONE_CACHE_DISK_SIZE', '50000')), ttl=ISOCHRONE_CACHE_TTL)
+    if ISOCHRONE_CACHE_DISK else None
+)
+
+# Isócronas já convertidas para o CRS métrico, identificadas pelo hash da geometria:
+# os clientes enviam o `isochrone_id` em vez do GeoJSON no cálculo de população
+ISOCHRONE_STORE = LRUCache(
+    int(os.getenv('ISOCHRONE_STORE_SIZE', '4096')), ttl=int(os.getenv('ISOCHRONE_STORE_TTL', str(6 * 3600)))
+)
+
 # Carregar dados de censos
 CENSUS_DATA = None
 POP_COLUMN = None
 METADATA = None
 
+# Índice espacial sobre as subsecções (construído em load_census_data)
+CENSUS_VIEW = None   # todas as subsecções do ficheiro único (CensusView)
+CENSUS_GEOMS = None  # array numpy de geometrias preparadas
+CENSUS_AREAS = None  # área de cada subsecção
+CENSUS_TREE = None   # índice espacial de CENSUS_VIEW (nas partições, cada vista tem o seu, ver census_shards.py)
+
+# Dados em partições por município (process_data.py --shards): só o índice fica
+# carregado; cada pedido lê as partições que as suas zonas tocam (cache LRU)
+CENSUS_SHARDS = None
+CENSUS_SHARD_CACHE_SIZE = int(os.getenv('CENSUS_SHARD_CACHE_SIZE', '16'))  # partições em memória
+CENSUS_VIEW_CACHE_SIZE = int(os.getenv('CENSUS_VIEW_CACHE_SIZE', '8'))     # combinações com índice espacial
+CENSUS_VIEW_CACHE_FEATURES = int(os.getenv('CENSUS_VIEW_CACHE_FEATURES', '200000'))  # subsecções nessas combinações
+
+# Dicionário das variáveis da BGRI (nome -> descrição), para identificar os atributos agregados
+CENSUS_VARIABLES_FILE = os.getenv('CENSUS_VARIABLES_FILE', 'BGRI2021_0705/C2021_FSINTESE_VARIAVEIS.csv')
+CENSUS_VARIABLES = {}      # coluna numérica dos dados -> descrição (None se não estiver no dicionário)
+CENSUS_VARIABLE_KEYS = {}  # nome normalizado -> coluna dos dados
+MAX_ATTRIBUTES = int(os.getenv('MAX_ATTRIBUTES', '50'))
+
+# Grelha de população para o modo aproximado ('grid'); POPULATION_GRID_CELL=0 desativa
+POPULATION_MODES = ('exact', 'grid')
+POPULATION_GRID_CELL = float(os.getenv('POPULATION_GRID_CELL', '25'))  # metros
+POPULATION_GRID_FILE = os.getenv('POPULATION_GRID_FILE', 'data/population_grid.npz')
+POPULATION_GRID = None
+
+# Níveis de detalhe para a pré-visualização (precision='preview'): subsecções simplificadas,
+# preservando a topologia, a cada tolerância (metros); CENSUS_LOD_TOLERANCES vazio desativa.
+# Cada pedido usa o nível mais grosseiro que não exceda PREVIEW_TOLERANCE x alcance da maior banda
+POPULATION_PRECISIONS = ('exact', 'preview')
+CENSUS_LOD_TOLERANCES = sorted(float(t) for t in os.getenv('CENSUS_LOD_TOLERANCES', '5,15,40').split(',') if t.strip())
+PREVIEW_TOLERANCE = float(os.getenv('PREVIEW_TOLERANCE', '0.02'))
+
+# Otimizador de localização: matrizes de cobertura dos candidatos guardadas em memória
+OPTIMIZER_BACKENDS = ('circle', 'local')
+OPTIMIZER_MAX_CANDIDATES = int(os.getenv('OPTIMIZER_MAX_CANDIDATES', '20000'))
+OPTIMIZER_CACHE = LRUCache(int(os.getenv('OPTIMIZER_CACHE_SIZE', '8')))
+
+# Avaliação de cenários: regiões das estações calculadas num conjunto de processos
+# (fork, herdando os dados de censos já carregados); SCENARIO_WORKERS=1 calcula em série
+SCENARIO_WORKERS = int(os.getenv('SCENARIO_WORKERS', str(min(4, os.cpu_count() or 1))))
+SCENARIO_MAX_SCENARIOS = int(os.getenv('SCENARIO_MAX_SCENARIOS', '200'))
+SCENARIO_EXECUTOR = None
+
+# Sobreposição em paralelo (redes com muitas estações): partições espaciais das estações e das
+# subsecções num conjunto de processos (fork), quando o trabalho estimado (vértices dos pares)
+# passa OVERLAY_MIN_WORK; OVERLAY_WORKERS=1 calcula sempre em série. O resultado é o mesmo
+OVERLAY_WORKERS = int(os.getenv('OVERLAY_WORKERS', str(min(8, os.cpu_count() or 1))))
+OVERLAY_MIN_WORK = int(os.getenv('OVERLAY_MIN_WORK', '2000000'))
+OVERLAY_EXECUTOR = None
+
+# Cache de resultados de população, identificados pela impressão digital do pedido
+POPULATION_CACHE_DISK = os.getenv('POPULATION_CACHE_DISK', '')  # ex.: data/population_cache.sqlite
+POPULATION_CACHE = TieredCache(
+    LRUCache(int(os.getenv('POPULATION_CACHE_SIZE', '512'))),
+    DiskCache(POPULATION_CACHE_DISK, int(os.getenv('POPULATION_CACHE_DISK_SIZE', '10000')))
+    if POPULATION_CACHE_DISK else None
+)
+
+# Sessões de planeamento (recálculo incremental): estado partilhado pelos workers em SQLite,
+# com uma cópia em memória de cada processo (vazio = só em memória, num único processo)
+SESSION_TTL = int(os.getenv('SESSION_TTL', str(4 * 3600)))
+SESSION_STORE_DISK = os.getenv('SESSION_STORE_DISK', 'data/sessions.sqlite')
+SESSION_SAVE_RETRIES = int(os.getenv('SESSION_SAVE_RETRIES', '10'))  # tentativas de uma edição quando outro worker grava a sessão ao mesmo tempo
+SESSIONS = SessionStore(
+    LRUCache(int(os.getenv('SESSION_MAX', '256')), ttl=SESSION_TTL), lambda state: restore_session(state),
+    SESSION_STORE_DISK or None, int(os.getenv('SESSION_STORE_MAX', '10000')), ttl=SESSION_TTL
+)
+
+# Importação e exportação de estações (CSV, GeoJSON, GeoParquet), em streaming
+MAX_IMPORT_POINTS = int(os.getenv('MAX_IMPORT_POINTS', '100000'))
+MAX_IMPORT_ERRORS = int(os.getenv('MAX_IMPORT_ERRORS', '100'))  # erros de linha devolvidos (todos são contados)
+EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', '1000'))
+UPLOAD_SPOOL_BYTES = 8 * 1024 * 1024  # corpo em memória até este tamanho; depois num ficheiro temporário
+
+# Mosaicos vetoriais (GET /tiles/<camada>/<z>/<x>/<y>.<formato>) das subsecções e da cobertura de uma sessão
+TILE_FORMATS = {'mvt': 'application/vnd.mapbox-vector-tile', 'pbf': 'application/vnd.mapbox-vector-tile',
+                'json': 'application/geo+json', 'geojson': 'application/geo+json'}
+TILE_MIN_ZOOM = int(os.getenv('TILE_MIN_ZOOM', '10'))
+TILE_MAX_ZOOM = int(os.getenv('TILE_MAX_ZOOM', '18'))
+TILE_BUFFER = int(os.getenv('TILE_BUFFER', '64'))            # margem (unidades do mosaico, 4096 por lado) nos MVT
+TILE_SIMPLIFY = float(os.getenv('TILE_SIMPLIFY', '4'))       # tolerância de simplificação (unidades do mosaico)
+TILE_ATTRIBUTES = [name.strip() for name in os.getenv('TILE_ATTRIBUTES', '').split(',') if name.strip()]
+TILE_ID_COLUMN = os.getenv('TILE_ID_COLUMN', 'BGRI2021')     # código da subsecção, se existir nos dados
+TILE_MAX_AGE = int(os.getenv('TILE_MAX_AGE', '3600'))
+TILE_CACHE_DISK = os.getenv('TILE_CACHE_DISK', 'data/tile_cache.sqlite')
+TILE_CACHE = TieredCache(
+    LRUCache(int(os.getenv('TILE_CACHE_SIZE', '2048'))),
+    DiskCache(TILE_CACHE_DISK, int(os.getenv('TILE_CACHE_DISK_SIZE', '200000'))) if TILE_CACHE_DISK else None,
+    dumps=lambda tile: base64.b64encode(tile).decode('ascii'), loads=base64.b64decode
+)
+# Mosaicos de cobertura: dependem da sessão, só em memória
+COVERAGE_TILE_CACHE = TieredCache(LRUCache(int(os.getenv('COVERAGE_TILE_CACHE_SIZE', '1024'))))
+
+# Métricas (GET /metrics) e tempos por etapa (cabeçalho Server-Timing)
+REQUESTS = REGISTRY.counter('http_requests_total', 'Pedidos HTTP', ('endpoint', 'method', 'status'))
+REQUEST_SECONDS = REGISTRY.histogram('http_request_duration_seconds', 'Duração dos pedidos HTTP', ('endpoint',))
+ISOCHRONE_SOURCES = REGISTRY.counter('isochrones_total', 'Isócronas devolvidas, por origem (ors, cache, local, circle, fallback)', ('source',))
+STATIONS_PER_REQUEST = REGISTRY.histogram(
+    'stations_per_request', 'Estações (ou localizações) por pedido', ('endpoint',),
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+)
+
+# Perfis por pedido (opcional): com PROFILE_DIR definido, cada pedido mais lento que
+# PROFILE_MIN_MS é amostrado a cada PROFILE_INTERVAL_MS e gravado nesse diretório
+PROFILE_DIR = os.getenv('PROFILE_DIR', '')
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '5'))
+PROFILE_MIN_MS = float(os.getenv('PROFILE_MIN_MS', '0'))
+
+# Estado do carregamento (exposto em /api/ready)
+CENSUS_LOCK = threading.Lock()
+CENSUS_STATUS = {"status": "not_loaded", "error": None, "load_seconds": None}
+CENSUS_VERSION = None  # identifica os dados carregados (entra nas chaves da cache de resultados)
+
 def load_census_data():
-    """Carrega dados de censos na memória"""
-    global CENSUS_DATA, POP_COLUMN, METADATA
+    """Carrega dados de censos na memória (ou, se estiverem em partições, só o índice das partições)"""
+    global CENSUS_DATA, POP_COLUMN, METADATA, CENSUS_VIEW, CENSUS_GEOMS, CENSUS_AREAS, CENSUS_TREE
+    global CENSUS_SHARDS, CENSUS_VERSION
+    
+    CENSUS_STATUS.update(status="loading", error=None)
+    start_time = time.perf_counter()
     
     census_file = "data/census_data.geojson"
+    store_file = "data/census_data.arrow"
     metadata_file = "data/metadata.json"
     
-    if not os.path.exists(census_file):
-        return {"error": "Dados de censos não processados. Execute: python3 process_data.py"}
-    
-    CENSUS_DATA = gpd.read_file(census_file)
-    
     if os.path.exists(metadata_file):
         with open(metadata_file, "r", encoding="utf-8") as f:
             METADATA = json.load(f)
             POP_COLUMN = METADATA.get("pop_column")
     
+    if METADATA and METADATA.get("shards") and store_available():
+        # Partições lidas a pedido; as colunas vêm dos metadados
+        CENSUS_SHARDS = ShardedCensus.from_metadata(
+            METADATA, os.path.dirname(metadata_file), METRIC_CRS,
+            max_shards=CENSUS_SHARD_CACHE_SIZE, max_views=CENSUS_VIEW_CACHE_SIZE, max_view_features=CENSUS_VIEW_CACHE_FEATURES
+        )
+        source_file = metadata_file
+        columns = METADATA.get("columns", [])
+        numeric_columns = METADATA.get("numeric_columns", [])
+    else:
+        areas = None
+        if os.path.exists(store_file) and store_available():
+            # Ficheiro binário colunar (memória mapeada, já no CRS métrico)
+            CENSUS_DATA, areas, _ = read_census_store(store_file)
+            source_file = store_file
+        elif os.path.exists(census_file):
+            if os.path.exists(store_file) or (METADATA or {}).get("shards"):
+                print("AVISO: pyarrow não instalado, a ler o GeoJSON (mais lento)")
+            CENSUS_DATA = gpd.read_file(census_file)
+            source_file = census_file
+        else:
+            error = "Dados de censos não processados. Execute: python3 process_data.py"
+            CENSUS_STATUS.update(status="error", error=error)
+            return {"error": error}
+        
+        # Reprojetar uma única vez para o CRS métrico (áreas e distâncias em metros)
+        if CENSUS_DATA.crs != METRIC_CRS:
+            CENSUS_DATA = CENSUS_DATA.to_crs(METRIC_CRS)
+            areas = None
+        
+        # Construir índice espacial persistente com geometrias preparadas,
+        # para que cada pedido consulte apenas as subsecções candidatas
+        CENSUS_VIEW = CensusView(CENSUS_DATA, areas)
+        CENSUS_GEOMS, CENSUS_AREAS, CENSUS_TREE = CENSUS_VIEW.geoms, CENSUS_VIEW.areas, CENSUS_VIEW.tree
+        
+        # Versões simplificadas para a pré-visualização (nas partições, construídas no primeiro uso)
+        for tolerance in CENSUS_LOD_TOLERANCES:
+            level = CENSUS_VIEW.lod(tolerance)
+            print(f"Nível de detalhe {tolerance:g} m: {level.vertices:,} vértices")
+        columns = CENSUS_DATA.columns.tolist()
+        numeric_columns = CENSUS_DATA.select_dtypes(include='number').columns.tolist()
+    
     # Se não houver coluna de população definida, procurar
-    if not POP_COLUMN or POP_COLUMN not in CENSUS_DATA.columns:
+    if not POP_COLUMN or POP_COLUMN not in columns:
         # Prioridade: N_INDIVIDUOS
-        if 'N_INDIVIDUOS' in CENSUS_DATA.columns:
+        if 'N_INDIVIDUOS' in columns:
             POP_COLUMN = 'N_INDIVIDUOS'
         else:
-            pop_cols = [col for col in CENSUS_DATA.columns if 'INDIVIDUOS' in col.upper() or 'POP' in col.upper() or 'HABITANTES' in col.upper()]
+            pop_cols = [col for col in columns if 'INDIVIDUOS' in col.upper() or 'POP' in col.upper() or 'HABITANTES' in col.upper()]
             if pop_cols:
                 POP_COLUMN = pop_cols[0]
             else:
                 # Usar primeira coluna numérica (não ideal)
-                numeric_cols = CENSUS_DATA.select_dtypes(include=['int64', 'float64']).columns.tolist()
-                numeric_cols = [col for col in numeric_cols if 'SHAPE' not in col and 'OBJECTID' not in col and 'ID' not in col]
+                numeric_cols = [col for col in numeric_columns if 'SHAPE' not in col and 'OBJECTID' not in col and 'ID' not in col]
                 if numeric_cols:
                     POP_COLUMN = numeric_cols[0]
                     print(f"AVISO: Usando '{POP_COLUMN}' como população (pode não ser correto!)")
+                else:
+                    POP_COLUMN = None
     
-    print(f"Dados carregados: {len(CENSUS_DATA)} features")
+    if CENSUS_SHARDS is not None:
+        print(f"Dados em partições: {len(CENSUS_SHARDS)} partições, {CENSUS_SHARDS.stats()['features']:,} features")
+    else:
+        print(f"Dados carregados: {len(CENSUS_DATA)} features")
     print(f"Coluna de população: {POP_COLUMN}")
-    if POP_COLUMN and POP_COLUMN in CENSUS_DATA.columns:
-        total_pop = CENSUS_DATA[POP_COLUMN].sum()
+    if POP_COLUMN:
+        if CENSUS_SHARDS is not None:
+            total_pop = sum(shard.get("population") or 0 for shard in METADATA["shards"])
+        else:
+            total_pop = CENSUS_DATA[POP_COLUMN].sum()
         print(f"População total nos dados: {total_pop:,.0f}")
+    
+    load_census_variables(numeric_columns)
+    
+    # Com partições, a grelha é construída a pedido para as partições de cada pedido
+    if POPULATION_GRID_CELL > 0 and POP_COLUMN and CENSUS_SHARDS is None:
+        load_population_grid(source_file)
+    
+    CENSUS_VERSION = f"{os.path.abspath(source_file)}:{os.path.getmtime(source_file)}:{POP_COLUMN}:{METRIC_CRS}"
+    
+    CENSUS_STATUS.update(status="ready", load_seconds=round(time.perf_counter() - start_time, 3))
+
+def read_variable_dictionary(path):
+    """Lê o dicionário de variáveis do INE (UTF-8 com BOM, separador ';'); devolve pares (nome, descrição)"""
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        rows = list(csv.reader(f, delimiter=';'))
+    return [(row[0].strip(), row[1].strip()) for row in rows[1:] if len(row) >= 2 and row[0].strip()]
+
+def variable_key(name):
+    """Nome normalizado de uma variável: sem acentos, em maiúsculas, com espaços e pontuação trocados por '_'
+
+    O dicionário usa espaços em alguns nomes (ex.: 'N_EDIFICIOS_3 MAIS_PISOS')
+    que nas colunas dos dados podem aparecer com '_'.
+    """
+    name = unicodedata.normalize('NFKD', str(name)).encode('ascii', 'ignore').decode()
+    return re.sub(r'[^A-Z0-9]+', '_', name.upper()).strip('_')
+
+def load_census_variables(columns):
+    """Associa as colunas numéricas dos dados às descrições do dicionário de variáveis"""
+    global CENSUS_VARIABLES, CENSUS_VARIABLE_KEYS
+    
+    descriptions = {}
+    if os.path.exists(CENSUS_VARIABLES_FILE):
+        descriptions = {
+            variable_key(name): description for name, description in read_variable_dictionary(CENSUS_VARIABLES_FILE)
+        }
+    else:
+        print(f"AVISO: Dicionário de variáveis não encontrado em {CENSUS_VARIABLES_FILE}")
+    
+    CENSUS_VARIABLES = {col: descriptions.get(variable_key(col)) for col in columns}
+    CENSUS_VARIABLE_KEYS = {variable_key(col): col for col in columns}
+    described = sum(description is not None for description in CENSUS_VARIABLES.values())
+    print(f"Variáveis dos censos: {len(CENSUS_VARIABLES)} colunas numéricas, {described} com descrição")
+
+def load_population_grid(source_file):
+    """Carrega a grelha de população do disco ou constrói-a (e grava-a) a partir das subsecções"""
+    global POPULATION_GRID
+    
+    # A grelha gravada só serve se for mais recente que os dados e tiver o mesmo tamanho de célula
+    if os.path.exists(POPULATION_GRID_FILE) and os.path.getmtime(POPULATION_GRID_FILE) >= os.path.getmtime(source_file):
+        grid = PopulationGrid.load(POPULATION_GRID_FILE)
+        if grid.cell_size == POPULATION_GRID_CELL:
+            POPULATION_GRID = grid
+    
+    if POPULATION_GRID is None:
+        print(f"Construindo grelha de população ({POPULATION_GRID_CELL:g} m)...")
+        POPULATION_GRID = PopulationGrid.from_blocks(
+            CENSUS_GEOMS, CENSUS_DATA[POP_COLUMN].to_numpy(dtype=float), POPULATION_GRID_CELL
+        )
+        POPULATION_GRID.save(POPULATION_GRID_FILE)
+    
+    print(f"Grelha de população: {len(POPULATION_GRID):,} células com população")
+
+def census_loaded():
+    return CENSUS_VIEW is not None or CENSUS_SHARDS is not None
+
+def ensure_census_loaded():
+    """Carrega os dados de censos uma única vez, mesmo com vários pedidos em simultâneo"""
+    if not census_loaded():
+        with CENSUS_LOCK:
+            if not census_loaded():
+                load_census_data()
+    return census_loaded()
+
+def census_view(bounds=None):
+    """Subsecções para um pedido: todas (ficheiro único) ou as das partições que intersectam `bounds`"""
+    if CENSUS_SHARDS is None:
+        return CENSUS_VIEW
+    return CENSUS_SHARDS.view(bounds)
+
+def catchment_bounds(xy, ranges):
+    """Retângulo que contém as zonas (círculos ou rede pedonal) de estações nas coordenadas `xy`"""
+    reach = max(ranges) * WALKING_SPEED
+    return (*(xy.min(axis=0) - reach), *(xy.max(axis=0) + reach))
+
+def population_grid(view):
+    """Grelha de população das subsecções de `view` (a do ficheiro único, ou construída para as partições)"""
+    if view is CENSUS_VIEW:
+        return POPULATION_GRID
+    return view.derived('grid', lambda v: PopulationGrid.from_blocks(v.geoms, v.values(POP_COLUMN), POPULATION_GRID_CELL))
+
+def preview_tolerance(ranges):
+    """Tolerância (metros) do nível de detalhe para pré-visualizar zonas com estes intervalos (None sem níveis)"""
+    if not CENSUS_LOD_TOLERANCES:
+        return None
+    limit = PREVIEW_TOLERANCE * max(ranges) * WALKING_SPEED
+    return max([t for t in CENSUS_LOD_TOLERANCES if t <= limit], default=CENSUS_LOD_TOLERANCES[0])
+
+@app.before_request
+def start_request_timing():
+    """Começa o registo das etapas do pedido (e o perfil, se ativado)"""
+    g.timings = start_timings()
+    g.start_time = time.perf_counter()
+    g.profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000).start() if PROFILE_DIR else None
+
+@app.after_request
+def finish_request_timing(response):
+    """Acrescenta o cabeçalho Server-Timing e regista o pedido nas métricas"""
+    if 'start_time' not in g:
+        return response
+    elapsed = time.perf_counter() - g.start_time
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    response.headers['Server-Timing'] = server_timing(g.timings, elapsed)
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    REQUEST_SECONDS.observe(elapsed, endpoint=endpoint)
+    
+    if g.profiler is not None:
+        g.profiler.stop()
+        if elapsed * 1000 >= PROFILE_MIN_MS and g.profiler.samples:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            name = re.sub(r'[^A-Za-z0-9]+', '_', endpoint).strip('_') or 'root'
+            path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{elapsed * 1000:.0f}ms-{uuid.uuid4().hex[:6]}.folded")
+            g.profiler.dump(path)
+            print(f"Perfil do pedido {request.method} {request.path} ({elapsed * 1000:.0f} ms): {path}")
+    return response
+
+@REGISTRY.collector
+def cache_metrics():
+    """Acertos, falhas, despejos e entradas das caches do servidor"""
+    caches = {
+        "isochrones": ISOCHRONE_CACHE, "population": POPULATION_CACHE, "isochrone_store": ISOCHRONE_STORE,
+        "optimizer": OPTIMIZER_CACHE, "sessions": SESSIONS, "tiles": TILE_CACHE, "coverage_tiles": COVERAGE_TILE_CACHE
+    }
+    if CENSUS_SHARDS is not None:
+        caches.update(census_shards=CENSUS_SHARDS.shards, census_views=CENSUS_SHARDS.views)
+    tiers = []  # (cache, nível, estatísticas)
+    coalesced = []
+    for name, cache in caches.items():
+        if isinstance(cache, (TieredCache, SessionStore)):
+            stats = cache.stats()
+            tiers.append((name, "memory", stats["memory"]))
+            if "disk" in stats:
+                tiers.append((name, "disk", stats["disk"]))
+            if "coalesced" in stats:
+                coalesced.append(({"cache": name}, stats["coalesced"]))
+        else:
+            tiers.append((name, "memory", cache.stats()))
+    families = []
+    for field, metric, kind, help_text in (
+        ("hits", "cache_hits_total", "counter", "Acertos nas caches"),
+        ("misses", "cache_misses_total", "counter", "Falhas nas caches"),
+        ("evictions", "cache_evictions_total", "counter", "Entradas despejadas das caches"),
+        ("entries", "cache_entries", "gauge", "Entradas nas caches")
+    ):
+        families.append((metric, kind, help_text, [({"cache": name, "tier": tier}, stats[field]) for name, tier, stats in tiers]))
+    families.append(("cache_coalesced_total", "counter", "Caches: pedidos que partilharam um cálculo em curso", coalesced))
+    families.append(("census_loaded", "gauge", "Dados de censos carregados (1) ou não (0)", [({}, int(census_loaded()))]))
+    return families
+
+@REGISTRY.collector
+def ors_metrics():
+    """Chamadas ao OpenRouteService por resultado e estado do disjuntor"""
+    stats = ORS_CLIENT.stats()
+    return [
+        ("ors_calls_total", "counter", "Chamadas ao OpenRouteService por resultado (ok, error, circuit_open, rate_limited, busy...)",
+         [({"outcome": outcome}, count) for outcome, count in sorted(stats["calls"].items())]),
+        ("ors_circuit_open", "gauge", "Disjuntor do OpenRouteService aberto (1) ou fechado (0)", [({}, int(stats["state"] == 'open'))]),
+        ("ors_circuit_trips_total", "counter", "Vezes que o disjuntor do OpenRouteService abriu", [({}, stats["trips"])])
+    ]
+
+@app.route('/metrics')
+def metrics():
+    """Métricas do processo no formato de texto do Prometheus"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def index():
     """Serve a página principal"""
     return send_from_directory('static', 'index.html')
 
+@app.route('/api/health')
+def health():
+    """Indica que o processo está a responder (liveness)"""
+    return jsonify({"status": "ok"})
+
+@app.route('/api/ready')
+def ready():
+    """Indica se os dados de censos e o índice espacial já estão carregados (readiness)"""
+    status = dict(CENSUS_STATUS)
+    if CENSUS_SHARDS is not None:
+        status.update(CENSUS_SHARDS.stats())
+        status["pop_column"] = POP_COLUMN
+    elif CENSUS_DATA is not None:
+        status["features"] = len(CENSUS_DATA)
+        status["pop_column"] = POP_COLUMN
+    return jsonify(status), 200 if status["status"] == "ready" else 503
+
 @app.route('/api/census-metadata')
 def get_metadata():
     """Retorna metadados dos dados de censos"""
@@ -85,139 +518,396 @@ def get_metadata():
         return jsonify(METADATA)
     return jsonify({"error": "Metadados não disponíveis"})
 
-@app.route('/api/isochrones', methods=['POST'])
-def get_isochrones():
-    """Calcula isócronas reais usando OpenRouteService"""
-    data = request.json
+@app.route('/api/census-variables')
+def get_census_variables():
+    """Variáveis dos censos que podem ser pedidas em `attributes`, com a descrição do dicionário"""
+    if not ensure_census_loaded():
+        return jsonify({"error": "Dados não carregados"}), 500
+    return jsonify({
+        "variables": [{"name": col, "description": description} for col, description in CENSUS_VARIABLES.items()]
+    })
+
+def isochrone_cache_key(lat, lng, ranges, profile):
+    """Chave de cache das isócronas: coordenadas arredondadas, perfil e intervalos"""
+    ranges_key = ",".join(str(r) for r in ranges)
+    return f"{profile}|{lat:.{ISOCHRONE_SNAP_DECIMALS}f}|{lng:.{ISOCHRONE_SNAP_DECIMALS}f}|{ranges_key}"
+
+def request_ors_isochrones(lat, lng, ranges, profile):
+    """Pede isócronas ao OpenRouteService para um ponto; devolve a lista de features ou None"""
+    with stage('ors'):
+        isochrones = ORS_CLIENT.request_isochrones([[lng, lat]], ranges, profile)
+    if isochrones and isochrones[0]:
+        return isochrones[0]
+    print("OpenRouteService não retornou isócronas, usando fallback")
+    return None
+
+def parse_isochrone_request(data):
+    """Valida um pedido de isócronas; devolve ((lat, lng, intervalos, perfil, motor), erro)"""
+    if not isinstance(data, dict):
+        return None, "O pedido deve ser um objeto {lat, lng}"
     lat = data.get('lat')
     lng = data.get('lng')
-    ranges = data.get('ranges', [300, 600])  # 5 min e 10 min em segundos
+    ranges, error = parse_ranges(data.get('ranges'))  # por omissão 5 min e 10 min em segundos
+    profile = data.get('profile', 'foot-walking')
+    backend = data.get('backend', ISOCHRONE_BACKEND)
     
     if not lat or not lng:
-        return jsonify({"error": "Coordenadas não fornecidas"}), 400
+        return None, "Coordenadas não fornecidas"
+    if not (is_coordinate(lat) and is_coordinate(lng)):
+        return None, "Coordenadas inválidas"
     
-    try:
-        # OpenRouteService API
-        url = "https://api.openrouteservice.org/v2/isochrones/foot-walking"
-        
-        headers = {
-            "Accept": "application/json, application/geo+json",
-            "Content-Type": "application/json"
-        }
-        
-        # Adicionar API key se disponível
-        if ORS_API_KEY:
-            headers["Authorization"] = f"Bearer {ORS_API_KEY}"
-        
-        body = {
-            "locations": [[lng, lat]],  # OpenRouteService usa [lng, lat]
-            "range": ranges,  # em segundos
-            "range_type": "time"
-        }
-        
-        response = requests.post(url, json=body, headers=headers, timeout=15)
-        
-        if response.status_code == 200:
-            result = response.json()
-            
-            # Converter para formato GeoJSON
-            isochrones = []
-            if 'features' in result:
-                for feature in result['features']:
-                    isochrones.append(feature)
-            
-            if isochrones:
-                return jsonify({"isochrones": isochrones})
-        
-        # Se chegou aqui, a API falhou ou não retornou dados
-        print(f"OpenRouteService retornou status {response.status_code}, usando fallback")
-        return create_fallback_isochrones(lat, lng, ranges)
-        
-    except requests.exceptions.RequestException as e:
-        print(f"Erro de conexão com OpenRouteService: {e}")
-        # Fallback: usar círculos
-        return create_fallback_isochrones(lat, lng, ranges)
-    except Exception as e:
-        print(f"Erro ao obter isócronas: {e}")
-        # Fallback: usar círculos
-        return create_fallback_isochrones(lat, lng, ranges)
+    error = error or validate_isochrone_options(profile, backend)
+    if error:
+        return None, error
+    return (lat, lng, ranges, profile, backend), None
 
-def create_fallback_isochrones(lat, lng, ranges):
-    """Cria isócronas usando círculos como fallback"""
-    import math
+def snap_location(lat, lng, ranges, profile):
+    """Coordenadas arredondadas (pedidos no mesmo sítio partilham a entrada de cache) e a chave de cache"""
+    snapped_lat = round(float(lat), ISOCHRONE_SNAP_DECIMALS)
+    snapped_lng = round(float(lng), ISOCHRONE_SNAP_DECIMALS)
+    return snapped_lat, snapped_lng, isochrone_cache_key(snapped_lat, snapped_lng, ranges, profile)
+
+def isochrone_result(lat, lng, ranges, backend, isochrones):
+    """Resposta de /api/isochrones: as isócronas obtidas (ou círculos), o identificador e a origem"""
+    source = backend
+    if not isochrones:
+        # Fallback: usar círculos
+        isochrones = create_fallback_isochrones(lat, lng, ranges)
+        source = 'fallback' if backend != 'circle' else 'circle'
+    ISOCHRONE_SOURCES.inc(source=source)
     
-    # Velocidade a pé: ~5 km/h = ~1.39 m/s
-    speed_ms = 1.39
+    isochrone_id = store_isochrones(isochrones)
+    return {"isochrones": isochrones, "isochrone_id": isochrone_id, "source": source}
+
+@app.route('/api/isochrones', methods=['POST'])
+def get_isochrones():
+    """Calcula isócronas reais (OpenRouteService com cache, motor local ou círculos)"""
+    params, error = parse_isochrone_request(request.json)
+    if error:
+        return jsonify({"error": error}), 400
+    lat, lng, ranges, profile, backend = params
     
-    isochrones = []
-    for range_seconds in ranges:
-        # Calcular raio em metros
-        radius_m = range_seconds * speed_ms
-        
-        # Converter para graus (aproximação)
-        # 1 grau de latitude ≈ 111 km
-        radius_deg = radius_m / 111000
+    isochrones = None
+    if backend == 'ors':
+        snapped_lat, snapped_lng, key = snap_location(lat, lng, ranges, profile)
         
-        # Criar círculo usando Turf.js (será feito no frontend se necessário)
-        # Por agora, retornamos um círculo simples
-        center = [lng, lat]
-        # Vamos criar um polígono circular simples
-        import math
-        num_points = 64
-        points = []
-        for i in range(num_points):
-            angle = 2 * math.pi * i / num_points
-            dx = radius_deg * math.cos(angle)
-            dy = radius_deg * math.sin(angle)
-            points.append([center[0] + dx, center[1] + dy])
-        points.append(points[0])  # Fechar o polígono
-        
-        isochrone = {
-            "type": "Feature",
-            "geometry": {
-                "type": "Polygon",
-                "coordinates": [points]
-            },
-            "properties": {
-                "value": range_seconds
-            }
-        }
-        isochrones.append(isochrone)
+        # Pedidos idênticos em simultâneo partilham uma única chamada ao OpenRouteService
+        isochrones = ISOCHRONE_CACHE.get_or_compute(
+            key, lambda: request_ors_isochrones(snapped_lat, snapped_lng, ranges, profile)
+        )
+    elif backend == 'local':
+        isochrones = create_local_isochrones(lat, lng, ranges)
     
-    return jsonify({"isochrones": isochrones})
+    result = isochrone_result(lat, lng, ranges, backend, isochrones)
+    with stage('serialize'):
+        return jsonify(result)
 
-@app.route('/api/population-in-isochrones', methods=['POST'])
-def calculate_population():
-    """Calcula população dentro de isócronas, evitando duplicações em sobreposições"""
-    global CENSUS_DATA, POP_COLUMN
+def isochrone_geometry_hash(isochrones):
+    """Hash do conteúdo (intervalo e geometria) de uma lista de features (identificador estável)"""
+    content = [[feature_range(feature), feature.get('geometry')] for feature in isochrones]
+    return hashlib.sha256(json.dumps(content, separators=(',', ':'), sort_keys=True).encode()).hexdigest()
+
+def feature_range(feature):
+    """Intervalo (segundos) de uma isócrona, se indicado nas propriedades"""
+    return (feature.get('properties') or {}).get('value')
+
+def store_isochrones(isochrones):
+    """Guarda as isócronas já convertidas (shape + reprojeção) e devolve o seu identificador"""
+    isochrone_id = isochrone_geometry_hash(isochrones)
+    if ISOCHRONE_STORE.get(isochrone_id) is None:
+        with stage('reproject'):
+            geoms = [shape(feature['geometry']) for feature in isochrones]
+            zones = transform_geometries(geoms, dst_crs=METRIC_CRS)
+        ISOCHRONE_STORE.set(isochrone_id, {
+            "values": [feature_range(feature) for feature in isochrones],
+            "zones": zones
+        })
+    return isochrone_id
+
+def missing_isochrone_ids(points):
+    """Identificadores de isócronas que já não estão guardados e não vêm acompanhados da geometria"""
+    return [
+        p['isochrone_id'] for p in points
+        if p.get('isochrone_id') and not p.get('isochrones') and ISOCHRONE_STORE.get(p['isochrone_id']) is None
+    ]
+
+def missing_isochrones_response(missing):
+    """Resposta 409: o cliente deve reenviar estas isócronas com a geometria"""
+    return jsonify({
+        "error": "Isócronas expiradas, reenviar com a geometria",
+        "missing_isochrone_ids": missing
+    }), 409
+
+def parse_ranges(raw_ranges):
+    """Valida a lista de intervalos (segundos, crescentes); devolve (intervalos, erro)"""
+    if raw_ranges is None:
+        return list(DEFAULT_RANGES), None
+    try:
+        ranges = [int(r) if float(r).is_integer() else float(r) for r in raw_ranges]
+    except (TypeError, ValueError):
+        return None, "ranges deve ser uma lista de intervalos em segundos"
+    if not ranges or len(ranges) > MAX_RANGES:
+        return None, f"ranges deve ter entre 1 e {MAX_RANGES} intervalos"
+    if any(r <= 0 or r > MAX_RANGE_SECONDS for r in ranges) or any(a >= b for a, b in zip(ranges, ranges[1:])):
+        return None, f"ranges deve ser crescente, com valores entre 0 e {MAX_RANGE_SECONDS} segundos"
+    return ranges, None
+
+def band_label(range_seconds):
+    """Sufixo dos campos de uma banda: '5min' para 300 s, '90s' quando não são minutos inteiros"""
+    if range_seconds % 60 == 0:
+        return f"{int(range_seconds // 60)}min"
+    return f"{range_seconds:g}s"
+
+def population_fields(values, ranges, total=False):
+    """Campos de população por banda (population_5min, ...) e total de uma estação ou do conjunto"""
+    prefix = 'total_population' if total else 'population'
+    fields = {f"{prefix}_{band_label(r)}": round(float(v)) for r, v in zip(ranges, values)}
+    fields['total_population' if total else 'population_total'] = round(float(np.sum(values)))
+    return fields
+
+def parse_attributes(raw_attributes):
+    """Valida os atributos pedidos (nomes dos dados ou do dicionário); devolve (colunas, erro)"""
+    if raw_attributes is None:
+        return [], None
+    if not isinstance(raw_attributes, list) or not all(isinstance(name, str) for name in raw_attributes):
+        return None, "attributes deve ser uma lista de nomes de variáveis"
+    if len(raw_attributes) > MAX_ATTRIBUTES:
+        return None, f"Máximo de {MAX_ATTRIBUTES} atributos por pedido"
     
-    if CENSUS_DATA is None:
-        load_census_data()
+    columns = [CENSUS_VARIABLE_KEYS.get(variable_key(name)) for name in raw_attributes]
+    unknown = [name for name, col in zip(raw_attributes, columns) if col is None]
+    if unknown:
+        return None, f"Variáveis desconhecidas: {', '.join(unknown)}"
+    return list(dict.fromkeys(columns)), None
+
+def attribute_fields(values, ranges):
+    """Valor de um atributo em cada banda ('5min', ...) e no total"""
+    fields = {band_label(r): round(float(v), 2) for r, v in zip(ranges, values)}
+    fields['total'] = round(float(np.sum(values)), 2)
+    return fields
+
+def validate_isochrone_options(profile, backend):
+    """Valida o perfil e o motor de isócronas pedidos; devolve a mensagem de erro ou None"""
+    if profile not in ISOCHRONE_PROFILES:
+        return f"Perfil inválido: {profile}"
+    if backend not in ISOCHRONE_BACKENDS:
+        return f"Motor de isócronas inválido: {backend}"
+    if backend == 'local' and profile != 'foot-walking':
+        return "O motor local só suporta o perfil foot-walking"
+    return None
+
+def is_coordinate(value):
+    """Indica se o valor é um número finito (e não um booleano)"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and np.isfinite(value)
+
+def parse_batch_request(data):
+    """Valida um pedido de isócronas em lote; devolve ((localizações, intervalos, perfil, motor), erro)"""
+    locations = data.get('locations', [])  # [{lat, lng, id?}]
+    ranges, error = parse_ranges(data.get('ranges'))
+    profile = data.get('profile', 'foot-walking')
+    backend = data.get('backend', ISOCHRONE_BACKEND)
     
-    if CENSUS_DATA is None:
-        return jsonify({"error": "Dados não carregados"}), 500
+    if not locations:
+        return None, "Nenhuma localização fornecida"
+    if not isinstance(locations, list):
+        return None, "locations deve ser uma lista de localizações"
+    if len(locations) > MAX_BATCH_LOCATIONS:
+        return None, f"Demasiadas localizações: {len(locations)} (máximo {MAX_BATCH_LOCATIONS} por pedido)"
     
-    data = request.json
-    points = data.get('points', [])  # [{lat, lng, id, isochrones?}]
+    error = error or validate_isochrone_options(profile, backend)
+    if error:
+        return None, error
     
-    if not points:
-        return jsonify({
-            "total_population": 0,
-            "total_population_5min": 0,
-            "total_population_10min": 0,
-            "points": []
+    for idx, location in enumerate(locations):
+        if not isinstance(location, dict):
+            return None, f"A localização {idx} deve ser um objeto {{lat, lng}}"
+        if not location.get('lat') or not location.get('lng'):
+            return None, f"Coordenadas não fornecidas na localização {idx}"
+        if not all(is_coordinate(location[key]) for key in ('lat', 'lng')):
+            return None, f"Coordenadas inválidas na localização {idx}"
+    STATIONS_PER_REQUEST.observe(len(locations), endpoint='/api/isochrones/batch')
+    return (locations, ranges, profile, backend), None
+
+def local_batch_results(locations, ranges, backend):
+    """Isócronas do lote pelo motor local ou por círculos, calculadas no próprio processo"""
+    results = []
+    for location in locations:
+        isochrones = None
+        if backend == 'local':
+            isochrones = create_local_isochrones(location['lat'], location['lng'], ranges)
+        source = backend
+        if not isochrones:
+            isochrones = create_fallback_isochrones(location['lat'], location['lng'], ranges)
+            source = 'fallback' if backend != 'circle' else 'circle'
+        ISOCHRONE_SOURCES.inc(source=source)
+        results.append({
+            "id": location.get('id'),
+            "lat": location['lat'],
+            "lng": location['lng'],
+            "isochrones": isochrones,
+            "isochrone_id": store_isochrones(isochrones),
+            "source": source
+        })
+    return results
+
+def cached_batch_results(locations, ranges, profile):
+    """Resultados do lote com as isócronas já em cache e as localizações em falta (chave -> (lat, lng))"""
+    results = []
+    missing = {}  # chave -> (lat, lng) arredondados, sem repetir chaves
+    for location in locations:
+        snapped_lat, snapped_lng, key = snap_location(location['lat'], location['lng'], ranges, profile)
+        isochrones = ISOCHRONE_CACHE.get(key)
+        if isochrones is None:
+            missing[key] = (snapped_lat, snapped_lng)
+        results.append({
+            "id": location.get('id'),
+            "lat": location['lat'],
+            "lng": location['lng'],
+            "key": key,
+            "isochrones": isochrones,
+            "source": "cache" if isochrones else None
         })
+    return results, missing
+
+def finish_batch_results(results, missing, features, ranges):
+    """Completa os resultados com as isócronas pedidas ao ORS (`features`, alinhadas com `missing`) ou círculos"""
+    fetched = {}
+    for key, location_features in zip(missing, features):
+        if location_features:
+            ISOCHRONE_CACHE.set(key, location_features)
+            fetched[key] = location_features
+    
+    for result in results:
+        key = result.pop('key')
+        if result['isochrones'] is None:
+            if key in fetched:
+                result['isochrones'] = fetched[key]
+                result['source'] = "ors"
+            else:
+                # Fallback por localização
+                result['isochrones'] = create_fallback_isochrones(result['lat'], result['lng'], ranges)
+                result['source'] = "fallback"
+        ISOCHRONE_SOURCES.inc(source=result['source'])
+        result['isochrone_id'] = store_isochrones(result['isochrones'])
+    return results
+
+@app.route('/api/isochrones/batch', methods=['POST'])
+def get_isochrones_batch():
+    """Calcula isócronas para várias localizações num só pedido (chamadas ao ORS em lote e em paralelo)"""
+    params, error = parse_batch_request(request.json)
+    if error:
+        return jsonify({"error": error}), 400
+    locations, ranges, profile, backend = params
+    
+    if backend != 'ors':
+        # Motor local ou círculos: calculados no próprio processo
+        results = local_batch_results(locations, ranges, backend)
+        with stage('serialize'):
+            return jsonify({"results": results})
+    
+    # Consultar a cache e juntar as localizações em falta
+    results, missing = cached_batch_results(locations, ranges, profile)
+    
+    # Chamadas ao ORS com várias localizações cada, em paralelo
+    features = []
+    if missing:
+        with stage('ors'):
+            features = ORS_CLIENT.request_isochrones_batch(
+                [[lng, lat] for lat, lng in missing.values()], ranges, profile
+            )
+    results = finish_batch_results(results, missing, features, ranges)
+    
+    with stage('serialize'):
+        return jsonify({"results": results})
+
+@app.route('/api/isochrones/cache')
+def get_isochrone_cache_stats():
+    """Estatísticas da cache de isócronas (acertos, falhas, despejos)"""
+    return jsonify(ISOCHRONE_CACHE.stats())
+
+def create_fallback_isochrones(lat, lng, ranges):
+    """Cria isócronas usando círculos como fallback"""
+    # Círculos construídos em metros no CRS métrico (e não em graus, que os deformam)
+    with stage('fallback'):
+        (x, y), = transform_points([lng], [lat], dst_crs=METRIC_CRS)
+        radii = np.asarray(ranges, dtype=float) * WALKING_SPEED
+        circles = shapely.buffer(shapely.points(np.tile([x, y], (len(radii), 1))), radii, quad_segs=16)
+        circles = transform_geometries(circles, src_crs=METRIC_CRS, dst_crs=WGS84)
+        
+        isochrones = []
+        for range_seconds, circle in zip(ranges, circles):
+            isochrones.append({
+                "type": "Feature",
+                "geometry": mapping(circle),
+                "properties": {
+                    "value": range_seconds
+                }
+            })
     
-    # Velocidade a pé: ~5 km/h = ~83 m/min = ~1.39 m/s
-    # 5 minutos = 300 segundos, 10 minutos = 600 segundos
-    # Raio aproximado: 5 min = ~417 metros, 10 min = ~833 metros
-    radius_5min = 417  # metros (fallback)
-    radius_10min = 833  # metros (fallback)
+    return isochrones
+
+def get_walking_graph():
+    """Carrega (uma única vez) a rede pedonal do motor local de isócronas"""
+    global WALKING_GRAPH
+    if WALKING_GRAPH is None and os.path.exists(WALKING_GRAPH_FILE):
+        WALKING_GRAPH = WalkingGraph.load(WALKING_GRAPH_FILE)
+        print(f"Rede pedonal carregada: {WALKING_GRAPH.num_nodes:,} nós")
+    return WALKING_GRAPH
+
+def create_local_isochrones(lat, lng, ranges):
+    """Calcula isócronas com o motor local; devolve None se não houver rede ou o ponto estiver fora dela"""
+    graph = get_walking_graph()
+    if graph is None:
+        print(f"Rede pedonal não encontrada em {WALKING_GRAPH_FILE}, usando fallback")
+        return None
+    with stage('local_isochrones'):
+        return graph.isochrones(lat, lng, ranges)
+
+def population_fingerprint(points, mode, ranges, attributes=(), precision='exact'):
+    """Impressão digital de um pedido de população: pontos normalizados, hash de cada isócrona e dados carregados"""
+    digest = hashlib.sha256()
+    request_key = [CENSUS_VERSION, mode, ranges, list(attributes)]
+    if precision != 'exact':
+        request_key += [precision, preview_tolerance(ranges)]
+    digest.update(json.dumps(request_key).encode())
+    for point_data in points:
+        isochrones = point_data.get('isochrones')
+        geometry_hash = None
+        if point_data.get('isochrone_id') and ISOCHRONE_STORE.get(point_data['isochrone_id']) is not None:
+            # O identificador já é o hash da geometria
+            geometry_hash = point_data['isochrone_id']
+        elif isochrones:
+            geometry_hash = isochrone_geometry_hash(isochrones)
+        normalized = [
+            str(point_data.get('id')),
+            round(float(point_data['lat']), 7),
+            round(float(point_data['lng']), 7),
+            geometry_hash
+        ]
+        digest.update(json.dumps(normalized).encode())
+    return digest.hexdigest()
+
+def match_bands(values, zones, ranges):
+    """Pares (banda, zona) das isócronas de uma estação para os intervalos pedidos
+
+    As isócronas são associadas pelo intervalo (`value` do ORS); sem essa
+    informação, pela ordem. Bandas sem isócrona ficam com o círculo.
+    """
+    if all(value is not None for value in values):
+        by_range = {float(value): zone for value, zone in zip(values, zones)}
+        return [(band, by_range[float(r)]) for band, r in enumerate(ranges) if float(r) in by_range]
+    return list(zip(range(len(ranges)), zones))
+
+def prepare_stations(points, ranges=DEFAULT_RANGES):
+    """Converte os pontos do pedido em coordenadas e zonas (estações x bandas) no CRS métrico"""
+    # Velocidade a pé: ~5 km/h = ~1.39 m/s; 5 min = 300 s = ~417 m, 10 min = 600 s = ~833 m
+    radii = np.asarray(ranges, dtype=float) * WALKING_SPEED  # metros (fallback)
     
     # Preparar dados dos pontos e suas isócronas
     point_info = []
-    all_5min_buffers = []
-    all_10min_buffers = []
+    iso_geoms = []  # isócronas reais (WGS84), reprojetadas todas de uma vez
+    iso_slots = []  # (índice do ponto, banda) de cada isócrona real
+    stored_slots = []  # (índice do ponto, banda, zona guardada já no CRS métrico)
     
     for point_data in points:
         lat = point_data['lat']
@@ -233,325 +923,997 @@ def calculate_population():
             except (ValueError, TypeError):
                 point_id = point_id_raw
         
-        # Criar ponto em WGS84
-        point_wgs84 = Point(lng, lat)
-        point_gdf_wgs84 = gpd.GeoDataFrame([1], geometry=[point_wgs84], crs="EPSG:4326")
-        
-        # Converter para CRS métrico (Web Mercator) para criar buffers precisos em metros
-        point_gdf_metric = point_gdf_wgs84.to_crs("EPSG:3857")
-        point_metric = point_gdf_metric.geometry.iloc[0]
-        
-        # Converter ponto para CRS dos dados de censos para cálculos de distância
-        point_gdf_census = point_gdf_wgs84.to_crs(CENSUS_DATA.crs)
-        point_census = point_gdf_census.geometry.iloc[0]
-        
-        # Verificar se há isócronas reais fornecidas
+        # Verificar se há isócronas reais fornecidas (guardadas no servidor ou no próprio pedido)
         isochrones = point_data.get('isochrones')
+        stored = ISOCHRONE_STORE.get(point_data['isochrone_id']) if point_data.get('isochrone_id') else None
         
-        if isochrones and len(isochrones) >= 2:
-            # Usar isócronas reais
+        if stored is not None:
+            # Já convertidas e reprojetadas quando foram calculadas
+            for band, zone in match_bands(stored['values'], stored['zones'], ranges):
+                stored_slots.append((len(point_info), band, zone))
+        elif isochrones:
             try:
                 # Converter isócronas GeoJSON para Shapely
-                iso_5min_geom = shape(isochrones[0]['geometry'])
-                iso_10min_geom = shape(isochrones[1]['geometry'])
-                
-                # Converter para o CRS dos dados de censos
-                iso_5min_gdf = gpd.GeoDataFrame([1], geometry=[iso_5min_geom], crs="EPSG:4326")
-                iso_10min_gdf = gpd.GeoDataFrame([1], geometry=[iso_10min_geom], crs="EPSG:4326")
-                
-                if CENSUS_DATA.crs != "EPSG:4326":
-                    iso_5min_gdf = iso_5min_gdf.to_crs(CENSUS_DATA.crs)
-                    iso_10min_gdf = iso_10min_gdf.to_crs(CENSUS_DATA.crs)
-                
-                buffer_5min = iso_5min_gdf.geometry.iloc[0]
-                buffer_10min = iso_10min_gdf.geometry.iloc[0]
+                geoms = [shape(feature['geometry']) for feature in isochrones]
             except Exception as e:
                 print(f"Erro ao processar isócronas reais, usando fallback: {e}")
-                # Fallback para círculos
-                buffer_5min_metric = point_metric.buffer(radius_5min)
-                buffer_10min_metric = point_metric.buffer(radius_10min)
-                buffer_gdf_5 = gpd.GeoDataFrame([1], geometry=[buffer_5min_metric], crs="EPSG:3857")
-                buffer_gdf_10 = gpd.GeoDataFrame([1], geometry=[buffer_10min_metric], crs="EPSG:3857")
-                buffer_5min = buffer_gdf_5.to_crs(CENSUS_DATA.crs).geometry.iloc[0]
-                buffer_10min = buffer_gdf_10.to_crs(CENSUS_DATA.crs).geometry.iloc[0]
-        else:
-            # Usar círculos como fallback
-            buffer_5min_metric = point_metric.buffer(radius_5min)
-            buffer_10min_metric = point_metric.buffer(radius_10min)
-            buffer_gdf_5 = gpd.GeoDataFrame([1], geometry=[buffer_5min_metric], crs="EPSG:3857")
-            buffer_gdf_10 = gpd.GeoDataFrame([1], geometry=[buffer_10min_metric], crs="EPSG:3857")
-            buffer_5min = buffer_gdf_5.to_crs(CENSUS_DATA.crs).geometry.iloc[0]
-            buffer_10min = buffer_gdf_10.to_crs(CENSUS_DATA.crs).geometry.iloc[0]
+            else:
+                values = [feature_range(feature) for feature in isochrones]
+                for band, geom in match_bands(values, geoms, ranges):
+                    iso_geoms.append(geom)
+                    iso_slots.append((len(point_info), band))
         
         point_info.append({
             'id': point_id,
             'lat': lat,
-            'lng': lng,
-            'point': point_census,
-            'buffer_5min': buffer_5min,
-            'buffer_10min': buffer_10min
+            'lng': lng
         })
-        all_5min_buffers.append(buffer_5min)
-        all_10min_buffers.append(buffer_10min)
+    
+    # Reprojetar todos os pontos para o CRS métrico numa única chamada
+    with stage('reproject'):
+        station_xy = transform_points(
+            [p['lng'] for p in point_info], [p['lat'] for p in point_info], dst_crs=METRIC_CRS
+        )
+        
+        # Círculos em metros como fallback, substituídos pelas isócronas reais quando existem
+        station_points = shapely.points(station_xy)
+        band_zones = np.empty((len(point_info), len(ranges)), dtype=object)
+        for band, radius in enumerate(radii):
+            band_zones[:, band] = shapely.buffer(station_points, radius)
+        if iso_geoms:
+            rows, cols = zip(*iso_slots)
+            band_zones[list(rows), list(cols)] = transform_geometries(iso_geoms, dst_crs=METRIC_CRS)
+    for idx, band, zone in stored_slots:
+        band_zones[idx, band] = zone
+    
+    return point_info, station_xy, band_zones
+
+@app.route('/api/population-in-isochrones', methods=['POST'])
+def calculate_population():
+    """Calcula população dentro de isócronas, evitando duplicações em sobreposições"""
+    global CENSUS_DATA, POP_COLUMN
+    
+    if not ensure_census_loaded():
+        return jsonify({"error": "Dados não carregados"}), 500
+    
+    data = request.json
+    points = data.get('points', [])  # [{lat, lng, id, isochrones?}]
+    ranges, error = parse_ranges(data.get('ranges'))
+    if error:
+        return jsonify({"error": error}), 400
+    
+    if not points:
+        return jsonify({**population_fields(np.zeros(len(ranges)), ranges, total=True), "points": []})
+    
+    mode = data.get('mode', 'exact')
+    if mode not in POPULATION_MODES:
+        return jsonify({"error": f"Modo inválido: {mode}"}), 400
+    
+    if mode == 'grid' and (POPULATION_GRID_CELL <= 0 or not POP_COLUMN):
+        return jsonify({"error": "Grelha de população não disponível (POPULATION_GRID_CELL=0?)"}), 400
+    
+    # Outras variáveis dos censos, agregadas com os mesmos pesos da população
+    attributes, error = parse_attributes(data.get('attributes'))
+    if error:
+        return jsonify({"error": error}), 400
+    if attributes and mode == 'grid':
+        return jsonify({"error": "Os atributos só estão disponíveis no modo exato"}), 400
+    
+    # Pré-visualização (ex.: enquanto uma estação é arrastada): subsecções e zonas simplificadas
+    precision = data.get('precision', 'exact')
+    if precision not in POPULATION_PRECISIONS:
+        return jsonify({"error": f"Precisão inválida: {precision}"}), 400
+    if precision == 'preview' and mode == 'grid':
+        return jsonify({"error": "A pré-visualização só está disponível no modo exato"}), 400
+    
+    missing = missing_isochrone_ids(points)
+    if missing:
+        return missing_isochrones_response(missing)
+    STATIONS_PER_REQUEST.observe(len(points), endpoint='/api/population-in-isochrones')
+    
+    # O resultado depende só do conteúdo do pedido: a impressão digital serve de ETag
+    fingerprint = population_fingerprint(points, mode, ranges, attributes, precision)
+    if request.if_none_match.contains(fingerprint):
+        response = make_response('', 304)
+        response.set_etag(fingerprint)
+        return response
+    
+    if precision == 'preview':
+        # Posições intermédias raramente se repetem: não ocupam a cache dos resultados exatos
+        result = compute_population(points, mode, ranges, attributes, precision)
+    else:
+        result = POPULATION_CACHE.get_or_compute(fingerprint, lambda: compute_population(points, mode, ranges, attributes))
+    with stage('serialize'):
+        response = make_response(jsonify(result))
+    response.set_etag(fingerprint)
+    return response
+
+@app.route('/api/population-in-isochrones/cache')
+def get_population_cache_stats():
+    """Estatísticas da cache de resultados de população"""
+    return jsonify(POPULATION_CACHE.stats())
+
+def compute_population(points, mode, ranges, attributes=(), precision='exact'):
+    """Calcula a população de cada estação (resposta de /api/population-in-isochrones)
+
+    Os `attributes` (colunas dos dados) são agregados com a mesma matriz de
+    pesos (estação, banda) x subsecção: um só cálculo geométrico para todos.
+    Com `precision='preview'` as subsecções e as zonas são as simplificadas
+    (nível de detalhe da tolerância de `preview_tolerance`).
+    """
+    point_info, station_xy, band_zones = prepare_stations(points, ranges)
     
     # Calcular população evitando duplicações
     results = []
-    total_pop_5min = 0
-    total_pop_10min = 0
+    totals = np.zeros(len(ranges))
+    estimated_error = None
+    tolerance = preview_tolerance(ranges) if precision == 'preview' else None
     
-    # Inicializar população para cada ponto
-    point_populations = {p['id']: {'5min': 0, '10min': 0} for p in point_info}
+    # Inicializar população (e atributos) para cada ponto
+    point_populations = {p['id']: np.zeros(len(ranges)) for p in point_info}
+    point_attributes = {p['id']: np.zeros((len(ranges), len(attributes))) for p in point_info}
+    attribute_totals = np.zeros((len(ranges), len(attributes)))
     
-    if POP_COLUMN and POP_COLUMN in CENSUS_DATA.columns:
-        # Criar união de todas as isócronas para encontrar todas as áreas de censo afetadas
-        union_5min = unary_union(all_5min_buffers) if all_5min_buffers else None
-        union_10min = unary_union(all_10min_buffers) if all_10min_buffers else None
-        
-        # Encontrar todas as áreas de censo que intersectam com qualquer isócrona
-        if union_5min:
-            census_in_any_5min = CENSUS_DATA[CENSUS_DATA.geometry.intersects(union_5min)].copy()
-        else:
-            census_in_any_5min = gpd.GeoDataFrame()
+    if POP_COLUMN:
+        # Subsecções que as zonas podem tocar (todas, ou as partições necessárias)
+        with stage('census'):
+            view = census_view(shapely.total_bounds(band_zones))
         
-        if union_10min:
-            census_in_any_10min = CENSUS_DATA[CENSUS_DATA.geometry.intersects(union_10min)].copy()
+        # Todas as bandas de todas as estações numa única passagem sobre as subsecções
+        if mode == 'grid':
+            # Aproximação pela grelha de população (centroides das células)
+            populations, estimated_error = population_grid(view).allocate(station_xy, band_zones)
         else:
-            census_in_any_10min = gpd.GeoDataFrame()
-        
-        # Processar área de 5 minutos
-        for idx, row in census_in_any_5min.iterrows():
-            # Encontrar todos os pontos cujas isócronas de 5 min intersectam esta área de censo
-            intersecting_points = []
-            for point_idx, point_data in enumerate(point_info):
-                intersection = row.geometry.intersection(point_data['buffer_5min'])
-                if not intersection.is_empty and intersection.area > 0:
-                    intersecting_points.append({
-                        'point_idx': point_idx,
-                        'point_data': point_data,
-                        'intersection': intersection
-                    })
+            # Matriz subsecções x (população + atributos pedidos)
+            block_values = view.values([POP_COLUMN, *attributes])
+            blocks, zones = view, band_zones
+            if tolerance is not None:
+                with stage('lod'):
+                    blocks = view.lod(tolerance)
+                    zones = shapely.simplify(band_zones, tolerance)
             
-            if not intersecting_points:
-                continue
-            
-            # Se há apenas um ponto, atribuir diretamente
-            if len(intersecting_points) == 1:
-                point_data = intersecting_points[0]['point_data']
-                intersection = intersecting_points[0]['intersection']
-                area_ratio = intersection.area / row.geometry.area if row.geometry.area > 0 else 1.0
-                pop_value = row[POP_COLUMN] * area_ratio
-                point_populations[point_data['id']]['5min'] += pop_value
-            else:
-                # Há sobreposição - dividir a área de censo entre os pontos mais próximos
-                # Para cada parte da interseção, determinar qual ponto está mais próximo
-                # Para cada ponto que intersecta, calcular a parte única (sem sobreposição)
-                for i, item in enumerate(intersecting_points):
-                    point_id = item['point_data']['id']
-                    intersection = item['intersection']
-                    
-                    # Remover partes que já foram atribuídas a outros pontos mais próximos
-                    unique_intersection = intersection
-                    for other_item in intersecting_points:
-                        if other_item['point_data']['id'] != point_id:
-                            other_intersection = other_item['intersection']
-                            # Verificar se há sobreposição
-                            if unique_intersection.intersects(other_intersection):
-                                # Determinar qual ponto está mais próximo do centroide da sobreposição
-                                overlap = unique_intersection.intersection(other_intersection)
-                                if not overlap.is_empty:
-                                    overlap_centroid = overlap.centroid
-                                    dist_current = item['point_data']['point'].distance(overlap_centroid)
-                                    dist_other = other_item['point_data']['point'].distance(overlap_centroid)
-                                    
-                                    # Se o outro ponto está mais próximo, remover a sobreposição
-                                    if dist_other < dist_current:
-                                        unique_intersection = unique_intersection.difference(overlap)
-                    
-                    # Atribuir população da parte única
-                    if not unique_intersection.is_empty and unique_intersection.area > 0:
-                        area_ratio = unique_intersection.area / row.geometry.area if row.geometry.area > 0 else 1.0
-                        pop_value = row[POP_COLUMN] * area_ratio
-                        point_populations[point_id]['5min'] += pop_value
-        
-        # Processar área de 10 minutos (apenas a parte que não está em 5 min)
-        for idx, row in census_in_any_10min.iterrows():
-            # Encontrar todos os pontos cujas isócronas de 10 min intersectam esta área de censo
-            intersecting_points = []
+            # Cada parte das áreas sobrepostas é atribuída à estação mais próxima que a cobre
+            allocated = allocate_population(
+                station_xy, zones, blocks.tree, blocks.geoms, blocks.areas, block_values,
+                parallel_overlay(view, tolerance)
+            )
+            populations = allocated[:, :, 0]
             for point_idx, point_data in enumerate(point_info):
-                intersection_10min = row.geometry.intersection(point_data['buffer_10min'])
-                if not intersection_10min.is_empty and intersection_10min.area > 0:
-                    # Remover a parte que já está na área de 5 min deste ponto
-                    intersection_5min = row.geometry.intersection(point_data['buffer_5min'])
-                    if not intersection_5min.is_empty:
-                        intersection_secondary = intersection_10min.difference(intersection_5min)
-                    else:
-                        intersection_secondary = intersection_10min
-                    
-                    if not intersection_secondary.is_empty and intersection_secondary.area > 0:
-                        intersecting_points.append({
-                            'point_idx': point_idx,
-                            'point_data': point_data,
-                            'intersection': intersection_secondary
-                        })
-            
-            if not intersecting_points:
-                continue
-            
-            # Se há apenas um ponto, atribuir diretamente
-            if len(intersecting_points) == 1:
-                point_data = intersecting_points[0]['point_data']
-                intersection = intersecting_points[0]['intersection']
-                area_ratio = intersection.area / row.geometry.area if row.geometry.area > 0 else 1.0
-                pop_value = row[POP_COLUMN] * area_ratio
-                point_populations[point_data['id']]['10min'] += pop_value
-            else:
-                # Há sobreposição - dividir a área de censo entre os pontos mais próximos
-                # Para cada parte da interseção, determinar qual ponto está mais próximo
-                # Para cada ponto que intersecta, calcular a parte única (sem sobreposição)
-                for i, item in enumerate(intersecting_points):
-                    point_id = item['point_data']['id']
-                    intersection = item['intersection']
-                    
-                    # Remover partes que já foram atribuídas a outros pontos mais próximos
-                    unique_intersection = intersection
-                    for other_item in intersecting_points:
-                        if other_item['point_data']['id'] != point_id:
-                            other_intersection = other_item['intersection']
-                            # Verificar se há sobreposição
-                            if unique_intersection.intersects(other_intersection):
-                                # Determinar qual ponto está mais próximo do centroide da sobreposição
-                                overlap = unique_intersection.intersection(other_intersection)
-                                if not overlap.is_empty:
-                                    overlap_centroid = overlap.centroid
-                                    dist_current = item['point_data']['point'].distance(overlap_centroid)
-                                    dist_other = other_item['point_data']['point'].distance(overlap_centroid)
-                                    
-                                    # Se o outro ponto está mais próximo, remover a sobreposição
-                                    if dist_other < dist_current:
-                                        unique_intersection = unique_intersection.difference(overlap)
-                    
-                    # Atribuir população da parte única
-                    if not unique_intersection.is_empty and unique_intersection.area > 0:
-                        area_ratio = unique_intersection.area / row.geometry.area if row.geometry.area > 0 else 1.0
-                        pop_value = row[POP_COLUMN] * area_ratio
-                        point_populations[point_id]['10min'] += pop_value
+                point_attributes[point_data['id']] += allocated[point_idx, :, 1:]
+        for point_idx, point_data in enumerate(point_info):
+            point_populations[point_data['id']] += populations[point_idx]
         
         # Criar resultados finais
         for point_data in point_info:
-            point_id = point_data['id']
-            pop_5min = point_populations[point_id]['5min']
-            pop_10min = point_populations[point_id]['10min']
+            point_pop = point_populations[point_data['id']]
+            totals += point_pop
             
-            total_pop_5min += pop_5min
-            total_pop_10min += pop_10min
-            
-            results.append({
-                "id": point_id,
+            result = {
+                "id": point_data['id'],
                 "lat": point_data['lat'],
                 "lng": point_data['lng'],
-                "population_5min": round(pop_5min),
-                "population_10min": round(pop_10min),
-                "population_total": round(pop_5min + pop_10min)
-            })
+                **population_fields(point_pop, ranges)
+            }
+            if attributes:
+                values = point_attributes[point_data['id']]
+                attribute_totals += values
+                result["attributes"] = {col: attribute_fields(values[:, k], ranges) for k, col in enumerate(attributes)}
+            results.append(result)
+    
+    response = {
+        **population_fields(totals, ranges, total=True),
+        "points": results,
+        "ranges": ranges,
+        "mode": mode
+    }
+    if precision != 'exact':
+        response["precision"] = precision
+        response["tolerance"] = tolerance
+    if attributes:
+        response["attributes"] = {col: attribute_fields(attribute_totals[:, k], ranges) for k, col in enumerate(attributes)}
+        response["attribute_descriptions"] = {col: CENSUS_VARIABLES.get(col) for col in attributes}
+    if estimated_error is not None:
+        # Erro estimado da aproximação face ao modo exato (pessoas)
+        total = totals.sum()
+        response["estimated_error"] = {
+            "absolute": round(estimated_error["absolute"]),
+            "bound": round(estimated_error["bound"]),
+            "relative": round(estimated_error["absolute"] / total, 4) if total > 0 else 0.0
+        }
+    return response
+
+def worker_overlay_blocks(blocks_key):
+    """Geometrias das subsecções nos processos do conjunto: partições e tolerância do nível de detalhe"""
+    census_key, tolerance = blocks_key
+    view = CENSUS_VIEW if CENSUS_SHARDS is None else CENSUS_SHARDS.view_of(census_key)
+    return (view.lod(tolerance) if tolerance is not None else view).geoms
+
+def get_overlay_executor():
+    """Conjunto de processos da sobreposição em paralelo, se configurado (criado uma única vez)"""
+    global OVERLAY_EXECUTOR
+    # Os processos só herdam os dados sem os copiar com o método fork
+    if OVERLAY_EXECUTOR is None and OVERLAY_WORKERS > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        OVERLAY_EXECUTOR = ProcessPoolExecutor(
+            OVERLAY_WORKERS,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=init_overlay_worker,
+            initargs=(worker_overlay_blocks,)
+        )
+    return OVERLAY_EXECUTOR
+
+def parallel_overlay(view, tolerance=None):
+    """Execução em paralelo da sobreposição com as subsecções de `view` (None: em série)"""
+    executor = get_overlay_executor()
+    if executor is None:
+        return None
+    return ParallelOverlay(executor, OVERLAY_WORKERS, (view.key, tolerance), OVERLAY_MIN_WORK)
+
+def candidate_zones(xy, backend, ranges):
+    """Zonas (candidatos x bandas, CRS dos censos) dos locais candidatos do otimizador"""
+    radii = np.asarray(ranges, dtype=float) * WALKING_SPEED
+    points = shapely.points(xy)
+    zones = np.empty((len(xy), len(radii)), dtype=object)
+    for band, radius in enumerate(radii):
+        zones[:, band] = shapely.buffer(points, radius)
+    
+    graph = get_walking_graph() if backend == 'local' else None
+    if graph is not None:
+        graph_xy = transform_points(xy[:, 0], xy[:, 1], src_crs=METRIC_CRS, dst_crs=graph.crs)
+        for i, (x, y) in enumerate(graph_xy):
+            # Candidatos fora da rede ficam com os círculos
+            polygons = graph.isochrone_polygons(x, y, ranges)
+            if polygons is not None:
+                zones[i] = transform_geometries(polygons, src_crs=graph.crs, dst_crs=METRIC_CRS)
+    return zones
+
+def candidate_matrix(xy, backend, ranges, view):
+    """Matriz de cobertura dos candidatos, reutilizada enquanto o conjunto de candidatos não mudar
+
+    As colunas são as subsecções de `view`, que também entra na chave.
+    """
+    key = hashlib.sha1(np.round(xy, 1).tobytes() + json.dumps([backend, ranges, view.key]).encode()).hexdigest()
+    matrix = OPTIMIZER_CACHE.get(key)
+    if matrix is None:
+        zones = candidate_zones(xy, backend, ranges)
+        matrix = coverage_matrix(zones, view.tree, view.geoms, view.areas)
+        OPTIMIZER_CACHE.set(key, matrix)
+    return matrix
+
+def parse_optimizer_request():
+    """Lê os parâmetros do otimizador de JSON ou de um formulário com o CSV de candidatos"""
+    if 'file' in request.files:
+        params = {}
+        for key, value in request.form.items():
+            # Listas e números vêm codificados em JSON; o resto como texto
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                params[key] = value
+        file = request.files['file']
+        fmt = detect_format(params.get('format'), file.filename, file.mimetype) or 'csv'
+        rows = read_points(file.stream, fmt, first_id=int(time.time() * 1000))
+        params['candidates'] = [point for _, point, _ in rows if point is not None]
+        return params
+    return request.json or {}
+
+@app.route('/api/optimize-stations', methods=['POST'])
+def optimize_stations():
+    """Escolhe a localização de novas estações que maximiza a população coberta (sem duplicações)"""
+    if not ensure_census_loaded():
+        return jsonify({"error": "Dados não carregados"}), 500
+    if not POP_COLUMN:
+        return jsonify({"error": "Coluna de população não encontrada"}), 500
+    
+    try:
+        params = parse_optimizer_request()
+        budget = int(params.get('budget', 1))
+        spacing = float(params.get('spacing', 250))
+        max_rounds = int(params.get('max_rounds', 10))
+        ranges, error = parse_ranges(params.get('ranges'))
+        if error:
+            return jsonify({"error": error}), 400
+        band_weights = [float(w) for w in params.get('band_weights', [1.0] * len(ranges))]
+        bbox = [float(v) for v in params['bbox']] if params.get('bbox') else None
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": f"Parâmetros inválidos: {e}"}), 400
+    backend = params.get('backend', 'circle')
+    fixed_points = params.get('fixed', [])
+    
+    if backend not in OPTIMIZER_BACKENDS:
+        return jsonify({"error": f"Backend inválido: {backend}"}), 400
+    if budget < 1 or spacing <= 0 or len(band_weights) != len(ranges) or (bbox is not None and len(bbox) != 4):
+        return jsonify({"error": "budget, spacing, band_weights ou bbox inválidos"}), 400
+    
+    start_time = time.perf_counter()
+    
+    # Locais candidatos: enviados pelo cliente ou uma grelha sobre a área pedida (bbox) ou dos dados
+    candidates = params.get('candidates')
+    if candidates:
+        candidate_xy = transform_points(
+            [c['lng'] for c in candidates], [c['lat'] for c in candidates], dst_crs=METRIC_CRS
+        )
+    else:
+        bounds = (METADATA or {}).get('bounds')
+        if bbox is not None:
+            bounds = dict(zip(('minx', 'miny', 'maxx', 'maxy'), bbox))
+        if bounds:
+            corners = transform_points(
+                [bounds['minx'], bounds['maxx'], bounds['minx'], bounds['maxx']],
+                [bounds['miny'], bounds['miny'], bounds['maxy'], bounds['maxy']],
+                dst_crs=METRIC_CRS
+            )
+            extent = (*corners.min(axis=0), *corners.max(axis=0))
+        else:
+            extent = shapely.total_bounds(CENSUS_GEOMS)
+        candidate_xy = grid_candidates(*extent, spacing)
+    
+    if len(candidate_xy) > OPTIMIZER_MAX_CANDIDATES:
+        return jsonify({
+            "error": f"Demasiados candidatos ({len(candidate_xy)}); máximo {OPTIMIZER_MAX_CANDIDATES}. Aumente o spacing."
+        }), 400
+    
+    fixed_xy = np.empty((0, 2))
+    if fixed_points:
+        fixed_xy = transform_points(
+            [p['lng'] for p in fixed_points], [p['lat'] for p in fixed_points], dst_crs=METRIC_CRS
+        )
+    
+    # Subsecções ao alcance de todos os candidatos e estações fixas
+    view = census_view(catchment_bounds(np.vstack([candidate_xy, fixed_xy]), ranges))
+    
+    matrix = candidate_matrix(candidate_xy, backend, ranges, view)
+    if not candidates:
+        # Candidatos da grelha que não cobrem nenhuma subsecção não interessam
+        useful = np.flatnonzero(np.diff(matrix.indptr) > 0)
+        matrix, candidate_xy = matrix[useful], candidate_xy[useful]
+    
+    # Estações fixas entram como linhas extra da matriz, já selecionadas
+    n_candidates = len(candidate_xy)
+    if fixed_points:
+        matrix = sp.vstack([matrix, candidate_matrix(fixed_xy, backend, ranges, view)], format='csr')
+        candidate_xy = np.vstack([candidate_xy, fixed_xy])
+    fixed = list(range(n_candidates, len(candidate_xy)))
+    matrix_seconds = time.perf_counter() - start_time
+    
+    # Valor de cada coluna: população da subsecção x peso da banda
+    pop_values = view.values(POP_COLUMN)
+    problem = CoverageProblem(matrix, np.concatenate([w * pop_values for w in band_weights]))
+    selected, evaluations = problem.greedy(budget, fixed)
+    selected, swaps = problem.local_search(selected, fixed, max_rounds)
+    objective = problem.objective(problem.covered(selected))
+    optimize_seconds = time.perf_counter() - start_time - matrix_seconds
+    
+    # População final com o motor exato (partição pela estação mais próxima)
+    selected_xy = candidate_xy[selected]
+    zones = candidate_zones(selected_xy, backend, ranges)
+    populations = allocate_population(selected_xy, zones, view.tree, view.geoms, view.areas, pop_values)
+    lnglat = transform_points(selected_xy[:, 0], selected_xy[:, 1], src_crs=METRIC_CRS, dst_crs=WGS84)
+    
+    stations = []
+    for i, candidate in enumerate(selected):
+        is_fixed = candidate >= n_candidates
+        if is_fixed:
+            station_id = fixed_points[candidate - n_candidates].get('id', candidate - n_candidates)
+        elif candidates:
+            station_id = candidates[candidate].get('id', candidate)
+        else:
+            station_id = f"candidate-{candidate}"
+        stations.append({
+            "id": station_id,
+            "lat": float(lnglat[i, 1]),
+            "lng": float(lnglat[i, 0]),
+            "fixed": bool(is_fixed),
+            **population_fields(populations[i], ranges)
+        })
     
     return jsonify({
-        "total_population_5min": round(total_pop_5min),
-        "total_population_10min": round(total_pop_10min),
-        "total_population": round(total_pop_5min + total_pop_10min),
-        "points": results
+        "stations": stations,
+        **population_fields(populations.sum(axis=0), ranges, total=True),
+        "ranges": ranges,
+        "objective": round(objective),
+        "candidates": n_candidates,
+        "evaluations": evaluations,
+        "swaps": swaps,
+        "timings": {
+            "matrix_seconds": round(matrix_seconds, 3),
+            "optimize_seconds": round(optimize_seconds, 3)
+        }
     })
 
+def scenario_evaluator(view):
+    """Avaliador de cenários sobre as subsecções de `view` (criado uma única vez por conjunto)"""
+    return view.derived('scenarios', lambda v: ScenarioEvaluator(v.tree, v.geoms, v.areas, v.values(POP_COLUMN), v.key))
+
+def worker_scenario_evaluator(census_key):
+    """Avaliador nos processos do conjunto: as mesmas subsecções, identificadas pelas partições"""
+    if CENSUS_SHARDS is None:
+        return scenario_evaluator(CENSUS_VIEW)
+    return scenario_evaluator(CENSUS_SHARDS.view_of(census_key))
+
+def get_scenario_executor():
+    """Conjunto de processos da avaliação de cenários, se configurado (criado uma única vez)"""
+    global SCENARIO_EXECUTOR
+    # Os processos só herdam os dados sem os copiar com o método fork
+    if SCENARIO_EXECUTOR is None and SCENARIO_WORKERS > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        SCENARIO_EXECUTOR = ProcessPoolExecutor(
+            SCENARIO_WORKERS,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=init_worker,
+            initargs=(worker_scenario_evaluator,)
+        )
+    return SCENARIO_EXECUTOR
+
+@app.route('/api/scenarios/evaluate', methods=['POST'])
+def evaluate_scenarios():
+    """Calcula a população de vários cenários (conjuntos de estações) num só pedido"""
+    if not ensure_census_loaded():
+        return jsonify({"error": "Dados não carregados"}), 500
+    if not POP_COLUMN:
+        return jsonify({"error": "Coluna de população não encontrada"}), 500
+    
+    data = request.json or {}
+    points = data.get('stations', [])      # [{id, lat, lng, isochrones?}]
+    scenarios = data.get('scenarios', [])  # [{id, stations: [ids]}]
+    base = data.get('base', [])            # estações comuns a todos os cenários
+    ranges, error = parse_ranges(data.get('ranges'))
+    if error:
+        return jsonify({"error": error}), 400
+    
+    if not points or not scenarios:
+        return jsonify({"error": "É preciso indicar 'stations' e 'scenarios'"}), 400
+    if len(scenarios) > SCENARIO_MAX_SCENARIOS:
+        return jsonify({"error": f"Máximo de {SCENARIO_MAX_SCENARIOS} cenários por pedido"}), 400
+    
+    missing = missing_isochrone_ids(points)
+    if missing:
+        return missing_isochrones_response(missing)
+    
+    start_time = time.perf_counter()
+    
+    # Estações distintas de todos os cenários, preparadas uma única vez
+    index_of = {str(p.get('id', i)): i for i, p in enumerate(points)}
+    members = []
+    for scenario in scenarios:
+        refs = [str(ref) for ref in list(base) + list(scenario.get('stations', []))]
+        unknown = [ref for ref in refs if ref not in index_of]
+        if unknown:
+            return jsonify({"error": f"Estações desconhecidas no cenário {scenario.get('id')}: {unknown}"}), 400
+        members.append(list(dict.fromkeys(index_of[ref] for ref in refs)))
+    
+    point_info, station_xy, band_zones = prepare_stations(points, ranges)
+    evaluator = scenario_evaluator(census_view(shapely.total_bounds(band_zones)))
+    populations, regions = evaluator.evaluate(station_xy, band_zones, members, get_scenario_executor(), SCENARIO_WORKERS)
+    
+    results = []
+    for i, (scenario, scenario_members, scenario_pop) in enumerate(zip(scenarios, members, populations)):
+        results.append({
+            "id": scenario.get('id', i),
+            **population_fields(scenario_pop.sum(axis=0), ranges, total=True),
+            "points": [
+                {"id": point_info[m]['id'], **population_fields(row, ranges)}
+                for m, row in zip(scenario_members, scenario_pop)
+            ]
+        })
+    
+    return jsonify({
+        "scenarios": results,
+        "ranges": ranges,
+        "stations": len(point_info),
+        "regions": regions,
+        "seconds": round(time.perf_counter() - start_time, 3)
+    })
+
+def station_key(raw_id):
+    """Identificador de uma estação como em prepare_stations (inteiro quando possível)"""
+    try:
+        return int(raw_id)
+    except (ValueError, TypeError):
+        return raw_id
+
+def session_census(session, band_zones):
+    """Com partições, alarga as subsecções da sessão às partições que as novas zonas tocam"""
+    if CENSUS_SHARDS is None:
+        return
+    needed = CENSUS_SHARDS.shards_for(shapely.total_bounds(band_zones))
+    if not set(needed.tolist()) <= set(session.census_key):
+        view = CENSUS_SHARDS.view_of([*session.census_key, *needed.tolist()])
+        session.rebind(view.tree, view.geoms, view.areas, view.values(POP_COLUMN), view.key)
+
+def session_upsert(session, points):
+    """Acrescenta ou move as estações indicadas numa sessão"""
+    recomputed = {"stations": 0, "blocks": 0}
+    point_info, station_xy, band_zones = prepare_stations(points, session.ranges)
+    session_census(session, band_zones)
+    for info, xy, zones in zip(point_info, station_xy, band_zones):
+        stats = session.upsert(info['id'], xy, zones, info)
+        recomputed["stations"] += stats["stations"]
+        recomputed["blocks"] += stats["blocks"]
+    return recomputed
+
+def session_response(session_id, session, recomputed=None, status=200):
+    """Totais da sessão no mesmo formato de /api/population-in-isochrones"""
+    ids, populations = session.populations()
+    results = []
+    for station_id, row in zip(ids, populations):
+        info = session.info[station_id]
+        results.append({
+            "id": station_id,
+            "lat": info.get('lat'),
+            "lng": info.get('lng'),
+            **population_fields(row, session.ranges)
+        })
+    
+    totals = populations.sum(axis=0) if len(ids) else np.zeros(len(session.ranges))
+    response = {
+        "session_id": session_id,
+        **population_fields(totals, session.ranges, total=True),
+        "points": results,
+        "ranges": session.ranges
+    }
+    if recomputed is not None:
+        response["recomputed"] = recomputed
+    return jsonify(response), status
+
+def restore_session(state):
+    """Sessão gravada por outro worker, com as subsecções deste processo (None se os dados mudaram)"""
+    if state['census_version'] != CENSUS_VERSION or not ensure_census_loaded():
+        return None
+    view = CENSUS_VIEW if CENSUS_SHARDS is None else CENSUS_SHARDS.view_of(state['census_key'])
+    return PlanningSession.from_state(state, view.tree, view.geoms, view.areas, view.values(POP_COLUMN))
+
+def with_session(handler):
+    """Obtém a sessão do URL (404 se expirou), serializa as edições da mesma sessão e grava as alterações
+
+    Se outro worker gravou a sessão durante a edição, a edição é repetida sobre o estado gravado.
+    """
+    def wrapper(session_id, *args, **kwargs):
+        for _ in range(SESSION_SAVE_RETRIES):
+            session = SESSIONS.get(session_id)
+            if session is None:
+                return jsonify({"error": "Sessão não encontrada ou expirada"}), 404
+            with session.lock:
+                base_version, base_revision = session.version, session.revision
+                try:
+                    response = handler(session_id, session, *args, **kwargs)
+                except BaseException:
+                    if session.revision != base_revision:
+                        SESSIONS.discard(session_id)
+                    raise
+                if session.revision == base_revision or SESSIONS.save(session_id, session, base_version):
+                    return response
+        return jsonify({"error": "Sessão alterada ao mesmo tempo noutro pedido; tente novamente"}), 409
+    wrapper.__name__ = handler.__name__
+    return wrapper
+
+@app.route('/api/sessions', methods=['POST'])
+def create_session():
+    """Cria uma sessão de planeamento, opcionalmente já com estações"""
+    if not ensure_census_loaded():
+        return jsonify({"error": "Dados não carregados"}), 500
+    if not POP_COLUMN:
+        return jsonify({"error": "Coluna de população não encontrada"}), 500
+    
+    data = request.json or {}
+    ranges, error = parse_ranges(data.get('ranges'))
+    if error:
+        return jsonify({"error": error}), 400
+    missing = missing_isochrone_ids(data.get('stations', []))
+    if missing:
+        return missing_isochrones_response(missing)
+    
+    point_info, station_xy, band_zones = prepare_stations(data.get('stations', []), ranges)
+    view = census_view(shapely.total_bounds(band_zones) if len(point_info) else None)
+    session = PlanningSession(view.tree, view.geoms, view.areas, view.values(POP_COLUMN), ranges, view.key, CENSUS_VERSION)
+    session_id = uuid.uuid4().hex
+    recomputed = None
+    if point_info:
+        recomputed = session.load(
+            [(info['id'], xy, zones, info) for info, xy, zones in zip(point_info, station_xy, band_zones)]
+        )
+    SESSIONS.add(session_id, session)
+    return session_response(session_id, session, recomputed, 201)
+
+@app.route('/api/sessions/<session_id>', methods=['GET'])
+@with_session
+def get_session(session_id, session):
+    """Totais atuais da sessão"""
+    return session_response(session_id, session)
+
+@app.route('/api/sessions/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    SESSIONS.delete(session_id)
+    return jsonify({"success": True})
+
+@app.route('/api/sessions/<session_id>/stations', methods=['POST'])
+@with_session
+def add_session_station(session_id, session):
+    """Acrescenta uma estação ({id, lat, lng, isochrones?}) à sessão"""
+    point = request.json or {}
+    if 'lat' not in point or 'lng' not in point:
+        return jsonify({"error": "Estação sem lat/lng"}), 400
+    missing = missing_isochrone_ids([point])
+    if missing:
+        return missing_isochrones_response(missing)
+    return session_response(session_id, session, session_upsert(session, [point]))
+
+@app.route('/api/sessions/<session_id>/stations/<station_id>', methods=['PUT'])
+@with_session
+def move_session_station(session_id, session, station_id):
+    """Move uma estação (ou substitui as suas isócronas)"""
+    point = dict(request.json or {}, id=station_key(station_id))
+    if 'lat' not in point or 'lng' not in point:
+        return jsonify({"error": "Estação sem lat/lng"}), 400
+    missing = missing_isochrone_ids([point])
+    if missing:
+        return missing_isochrones_response(missing)
+    return session_response(session_id, session, session_upsert(session, [point]))
+
+@app.route('/api/sessions/<session_id>/stations/<station_id>', methods=['DELETE'])
+@with_session
+def remove_session_station(session_id, session, station_id):
+    """Remove uma estação da sessão"""
+    station_id = station_key(station_id)
+    if station_id not in session.order:
+        return jsonify({"error": "Estação não encontrada"}), 404
+    return session_response(session_id, session, session.remove(station_id))
+
+@app.route('/api/sessions/<session_id>/edits', methods=['POST'])
+@with_session
+def edit_session(session_id, session):
+    """Várias edições num só pedido: {"upsert": [estações], "remove": [ids]}"""
+    data = request.json or {}
+    missing = missing_isochrone_ids(data.get('upsert', []))
+    if missing:
+        return missing_isochrones_response(missing)
+    
+    recomputed = {"stations": 0, "blocks": 0}
+    for raw_id in data.get('remove', []):
+        station_id = station_key(raw_id)
+        if station_id in session.order:
+            stats = session.remove(station_id)
+            recomputed["stations"] += stats["stations"]
+            recomputed["blocks"] += stats["blocks"]
+    if data.get('upsert'):
+        stats = session_upsert(session, data['upsert'])
+        recomputed["stations"] += stats["stations"]
+        recomputed["blocks"] += stats["blocks"]
+    return session_response(session_id, session, recomputed)
+
+def is_vector_tile(fmt):
+    return TILE_FORMATS[fmt] == 'application/vnd.mapbox-vector-tile'
+
+def tile_level(view, z, y):
+    """Nível de detalhe de onde partir num mosaico: o mais simplificado abaixo da tolerância do mosaico (None: original)"""
+    minx, _, maxx, _ = tile_bounds(z, 0, y)
+    # Unidades Web Mercator -> metros no terreno, à latitude do mosaico
+    tolerance = TILE_SIMPLIFY * (maxx - minx) / TILE_EXTENT * math.cos(math.radians(tile_latitude(z, y)))
+    levels = [t for t in CENSUS_LOD_TOLERANCES if t <= tolerance]
+    return view.lod(max(levels)) if levels and len(view) else None
+
+def tile_value(value, digits=2):
+    """Valor de um atributo no mosaico (None se estiver em falta)"""
+    if value is None:
+        return None
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) else round(float(value), digits)
+    return str(value)
+
+def tile_properties(rows):
+    """Atributos de cada elemento, sem os valores em falta"""
+    return [{key: value for key, value in ((k, tile_value(v)) for k, v in row.items()) if value is not None} for row in rows]
+
+def encode_tile(layer, fmt, geoms, properties, z, x, y):
+    with stage('serialize'):
+        if is_vector_tile(fmt):
+            return encode_mvt(layer, geoms, properties, TILE_EXTENT)
+        return encode_geojson(geoms, properties, z, x, y, TILE_EXTENT)
+
+def census_tile(z, x, y, fmt, attributes):
+    """Mosaico das subsecções com a população, os atributos pedidos e o código da subsecção"""
+    buffer = TILE_BUFFER if is_vector_tile(fmt) else 0
+    area = tile_area(z, x, y, METRIC_CRS, buffer, TILE_EXTENT)
+    with stage('census'):
+        view = census_view(shapely.bounds(area))
+        level = tile_level(view, z, y)
+    blocks = level or view
+    
+    with stage('query'):
+        idx = np.sort(blocks.tree.query(area, predicate='intersects'))
+    with stage('clip'):
+        kept, geoms = tile_geometries(blocks.geoms[idx], METRIC_CRS, z, x, y, TILE_EXTENT, buffer, TILE_SIMPLIFY)
+    idx = idx[kept]
+    
+    columns = [POP_COLUMN, *attributes]
+    values = view.values(columns)[idx]
+    codes = view.data[TILE_ID_COLUMN].to_numpy()[idx] if TILE_ID_COLUMN in view.data.columns else None
+    rows = []
+    for k, row in enumerate(values):
+        fields = {"population": row[0], **dict(zip(attributes, row[1:]))}
+        if codes is not None:
+            fields = {"id": codes[k], **fields}
+        rows.append(fields)
+    return encode_tile('census', fmt, geoms, tile_properties(rows), z, x, y)
+
+def coverage_tile(session, z, x, y, fmt):
+    """Mosaico das subsecções cobertas pela sessão, com a estação (e banda) a que cada uma é atribuída"""
+    buffer = TILE_BUFFER if is_vector_tile(fmt) else 0
+    area = tile_area(z, x, y, METRIC_CRS, buffer, TILE_EXTENT)
+    blocks, stations, bands, fractions = session.coverage()
+    with stage('query'):
+        idx = np.intersect1d(session.tree.query(area, predicate='intersects'), blocks)
+    with stage('clip'):
+        kept, geoms = tile_geometries(session.block_geoms[idx], METRIC_CRS, z, x, y, TILE_EXTENT, buffer, TILE_SIMPLIFY)
+    positions = np.searchsorted(blocks, idx[kept])
+    
+    rows = [{
+        "station": stations[k],
+        "band": band_label(session.ranges[bands[k]]),
+        "fraction": round(float(fractions[k]), 3),
+        "population": session.block_values[blocks[k]] * fractions[k]
+    } for k in positions]
+    return encode_tile('coverage', fmt, geoms, tile_properties(rows), z, x, y)
+
+def tile_response(tile, fmt, etag, max_age=None):
+    """Resposta de um mosaico com ETag (304 se o cliente já o tiver)"""
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(tile)
+        response.mimetype = TILE_FORMATS[fmt]
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f"public, max-age={max_age}" if max_age else 'no-cache'
+    return response
+
+def census_tile_key(z, x, y, fmt, attributes):
+    """Chave (e ETag) de um mosaico das subsecções: dados carregados, parâmetros do mosaico e atributos"""
+    request_key = [CENSUS_VERSION, 'census', z, x, y, 'mvt' if is_vector_tile(fmt) else 'json', attributes,
+                   TILE_EXTENT, TILE_BUFFER, TILE_SIMPLIFY, TILE_ID_COLUMN, CENSUS_LOD_TOLERANCES]
+    return hashlib.sha256(json.dumps(request_key).encode()).hexdigest()
+
+def cached_census_tile(z, x, y, fmt, attributes):
+    """Mosaico das subsecções pela cache (memória e disco); devolve (mosaico, chave)"""
+    key = census_tile_key(z, x, y, fmt, attributes)
+    return TILE_CACHE.get_or_compute(key, lambda: census_tile(z, x, y, fmt, attributes)), key
+
+@app.route('/tiles/<layer>/<int:z>/<int:x>/<int:y>.<fmt>')
+def get_tile(layer, z, x, y, fmt):
+    """Mosaico vetorial (MVT ou GeoJSON) das subsecções (`census`) ou da cobertura de uma sessão (`coverage`)"""
+    if fmt not in TILE_FORMATS:
+        return jsonify({"error": f"Formato inválido: {fmt}"}), 400
+    if not valid_tile(z, x, y) or not TILE_MIN_ZOOM <= z <= TILE_MAX_ZOOM:
+        return jsonify({"error": f"Mosaico inválido (zoom entre {TILE_MIN_ZOOM} e {TILE_MAX_ZOOM})"}), 404
+    if not ensure_census_loaded():
+        return jsonify({"error": "Dados não carregados"}), 500
+    if not POP_COLUMN:
+        return jsonify({"error": "Coluna de população não encontrada"}), 500
+    
+    if layer == 'census':
+        raw_attributes = request.args.get('attributes')
+        names = [name.strip() for name in raw_attributes.split(',') if name.strip()] if raw_attributes is not None else TILE_ATTRIBUTES
+        attributes, error = parse_attributes(names)
+        if error:
+            return jsonify({"error": error}), 400
+        tile, key = cached_census_tile(z, x, y, fmt, attributes)
+        return tile_response(tile, fmt, key, TILE_MAX_AGE)
+    
+    if layer == 'coverage':
+        session_id = request.args.get('session', '')
+        session = SESSIONS.get(session_id)
+        if session is None:
+            return jsonify({"error": "Sessão não encontrada ou expirada"}), 404
+        with session.lock:
+            # O estado da sessão entra na chave: cada edição muda os mosaicos (e o ETag)
+            key = hashlib.sha256(json.dumps([
+                CENSUS_VERSION, 'coverage', session_id, session.version, z, x, y, 'mvt' if is_vector_tile(fmt) else 'json',
+                TILE_EXTENT, TILE_BUFFER, TILE_SIMPLIFY
+            ]).encode()).hexdigest()
+            if request.if_none_match.contains(key):
+                return tile_response(b'', fmt, key)
+            tile = COVERAGE_TILE_CACHE.get_or_compute(key, lambda: coverage_tile(session, z, x, y, fmt))
+        return tile_response(tile, fmt, key)
+    
+    return jsonify({"error": f"Camada desconhecida: {layer} (census ou coverage)"}), 404
+
+def export_columns(ranges):
+    """Colunas exportadas: identificação, coordenadas e população de cada banda"""
+    return ['id', 'lat', 'lng', *population_fields(np.zeros(len(ranges)), ranges)]
+
+def supplied_export_rows(points, columns):
+    """Linhas com os valores enviados pelo cliente (população em falta = 0)"""
+    for point in points:
+        yield {col: point.get(col, 0 if col.startswith('population_') else '') for col in columns}
+
+def computed_export_rows(points, mode, ranges):
+    """Linhas com a população calculada pelo servidor (ou vinda da cache de resultados)"""
+    fingerprint = population_fingerprint(points, mode, ranges)
+    result = POPULATION_CACHE.get_or_compute(fingerprint, lambda: compute_population(points, mode, ranges))
+    yield from result['points']
+
 @app.route('/api/export-points', methods=['POST'])
 def export_points():
-    """Exporta pontos para CSV"""
-    data = request.json
+    """Exporta estações para CSV, GeoJSON ou GeoParquet, enviando a resposta em blocos
+
+    Por omissão a população vem nos pontos enviados; com `"compute": true` o
+    servidor calcula-a (modo exato ou grelha) e basta enviar as coordenadas
+    (e as isócronas ou o `isochrone_id`, se existirem).
+    """
+    data = request.json or {}
     points = data.get('points', [])
     
     if not points:
         return jsonify({"error": "Nenhum ponto para exportar"}), 400
     
-    # Criar CSV em memória
-    output = io.StringIO()
-    writer = csv.writer(output)
+    fmt = detect_format(request.args.get('format') or data.get('format') or 'csv')
+    if fmt is None:
+        return jsonify({"error": "Formato inválido (csv, geojson ou parquet)"}), 400
+    if fmt == 'parquet' and not parquet_available():
+        return jsonify({"error": "GeoParquet requer o pyarrow (pip install pyarrow)"}), 400
     
-    # Cabeçalho
-    writer.writerow(['id', 'lat', 'lng', 'population_5min', 'population_10min', 'population_total'])
+    ranges, error = parse_ranges(data.get('ranges'))
+    if error:
+        return jsonify({"error": error}), 400
+    columns = export_columns(ranges)
+    # Coordenadas e população convertidas para números, que são os valores exportados
+    for idx, point in enumerate(points):
+        try:
+            lat, lng = float(point['lat']), float(point['lng'])
+        except (KeyError, TypeError, ValueError):
+            return jsonify({"error": f"Coordenadas inválidas no ponto {idx}"}), 400
+        if not (np.isfinite(lat) and np.isfinite(lng)):
+            return jsonify({"error": f"Coordenadas inválidas no ponto {idx}"}), 400
+        try:
+            population = {col: float(point[col]) for col in columns if col.startswith('population_') and point.get(col) is not None}
+        except (TypeError, ValueError):
+            return jsonify({"error": f"População inválida no ponto {idx}"}), 400
+        points[idx] = dict(point, lat=lat, lng=lng, **population)
     
-    # Dados
-    for point in points:
-        writer.writerow([
-            point.get('id', ''),
-            point.get('lat', ''),
-            point.get('lng', ''),
-            point.get('population_5min', 0),
-            point.get('population_10min', 0),
-            point.get('population_total', 0)
-        ])
-    
-    # Criar resposta
-    output.seek(0)
-    response = app.response_class(
-        output.getvalue(),
-        mimetype='text/csv',
-        headers={'Content-Disposition': 'attachment; filename=estacoes.csv'}
+    if data.get('compute'):
+        if not ensure_census_loaded():
+            return jsonify({"error": "Dados não carregados"}), 500
+        mode = data.get('mode', 'exact')
+        if mode not in POPULATION_MODES:
+            return jsonify({"error": f"Modo inválido: {mode}"}), 400
+        if mode == 'grid' and (POPULATION_GRID_CELL <= 0 or not POP_COLUMN):
+            return jsonify({"error": "Grelha de população não disponível (POPULATION_GRID_CELL=0?)"}), 400
+        missing = missing_isochrone_ids(points)
+        if missing:
+            return missing_isochrones_response(missing)
+        # O cálculo só começa quando a resposta começa a ser enviada
+        rows = computed_export_rows(points, mode, ranges)
+    else:
+        rows = supplied_export_rows(points, columns)
+    
+    if fmt == 'csv':
+        chunks = csv_chunks(rows, columns, EXPORT_CHUNK_ROWS)
+    elif fmt == 'geojson':
+        chunks = geojson_chunks(rows, [col for col in columns if col not in ('lat', 'lng')], EXPORT_CHUNK_ROWS)
+    else:
+        chunks = parquet_chunks(rows, columns)
+    
+    return app.response_class(
+        stream_with_context(chunks),
+        mimetype=MEDIA_TYPES[fmt],
+        headers={'Content-Disposition': f'attachment; filename=estacoes.{fmt}'}
     )
+
+def upload_source():
+    """Ficheiro enviado (campo `file` do formulário) ou o próprio corpo do pedido
+
+    Devolve (stream, formato, erro). O formato vem do parâmetro `format`, da
+    extensão do ficheiro ou do Content-Type.
+    """
+    requested = request.args.get('format') or request.form.get('format')
+    if 'file' in request.files:
+        file = request.files['file']
+        if file.filename == '':
+            return None, None, "Nenhum arquivo selecionado"
+        # A resposta é gerada depois de o Flask fechar os ficheiros do pedido: quem lê fica com o ficheiro
+        stream, file.stream = file.stream, io.BytesIO()
+        fmt = detect_format(requested, file.filename, file.mimetype)
+    elif request.content_type and not request.content_type.startswith(('multipart/', 'application/x-www-form-urlencoded')):
+        stream = request.stream
+        fmt = detect_format(requested, None, request.content_type)
+    else:
+        return None, None, "Nenhum arquivo enviado"
     
-    return response
+    if fmt is None:
+        return None, None, "Formato não suportado (CSV, GeoJSON ou GeoParquet)"
+    if fmt == 'parquet':
+        if not parquet_available():
+            return None, None, "GeoParquet requer o pyarrow (pip install pyarrow)"
+        if not stream.seekable():
+            # O Parquet é lido a partir do rodapé: copiar o corpo (para disco, se for grande)
+            spooled = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+            shutil.copyfileobj(stream, spooled)
+            spooled.seek(0)
+            stream = spooled
+    return stream, fmt, None
+
+class ImportProgress:
+    """Contagens e erros de linha de uma importação em curso"""
+
+    def __init__(self):
+        self.count = 0
+        self.invalid = 0
+        self.errors = []
+        self.truncated = False
+        self.error = None  # erro que interrompeu a leitura do ficheiro
+
+    def summary(self):
+        summary = {"count": self.count, "invalid": self.invalid, "errors": self.errors, "truncated": self.truncated}
+        if self.error:
+            summary["error"] = self.error
+        return summary
+
+def valid_points(rows, progress):
+    """Pontos válidos das linhas lidas, registando os erros e parando em MAX_IMPORT_POINTS"""
+    try:
+        for row, point, error in rows:
+            if error is not None:
+                progress.invalid += 1
+                if len(progress.errors) < MAX_IMPORT_ERRORS:
+                    progress.errors.append({"row": row, "error": error})
+                continue
+            if progress.count >= MAX_IMPORT_POINTS:
+                progress.truncated = True
+                return
+            progress.count += 1
+            yield point
+    except (ValueError, csv.Error) as e:
+        progress.error = str(e)
+
+def import_stream(first_point, points, progress):
+    """Resposta JSON gerada à medida que os pontos são lidos"""
+    yield '{"points": [' + json.dumps(first_point)
+    batch = []
+    for point in points:
+        batch.append(json.dumps(point))
+        if len(batch) >= EXPORT_CHUNK_ROWS:
+            yield ',' + ','.join(batch)
+            batch = []
+    if batch:
+        yield ',' + ','.join(batch)
+    summary = progress.summary()
+    summary["success"] = progress.error is None
+    yield '], ' + json.dumps(summary)[1:]
 
 @app.route('/api/import-points', methods=['POST'])
 def import_points():
-    """Importa pontos de um arquivo CSV"""
-    if 'file' not in request.files:
-        return jsonify({"error": "Nenhum arquivo enviado"}), 400
-    
-    file = request.files['file']
-    
-    if file.filename == '':
-        return jsonify({"error": "Nenhum arquivo selecionado"}), 400
+    """Importa pontos de um ficheiro CSV, GeoJSON ou GeoParquet, lido e devolvido em streaming
+
+    Aceita o ficheiro num formulário (campo `file`) ou diretamente no corpo do
+    pedido. As linhas inválidas não interrompem a importação: são contadas e
+    devolvidas em `errors` (linha e motivo).
+    """
+    stream, fmt, error = upload_source()
+    if error:
+        return jsonify({"error": error}), 400
     
-    if not file.filename.endswith('.csv'):
-        return jsonify({"error": "Arquivo deve ser CSV"}), 400
+    progress = ImportProgress()
+    points = valid_points(read_points(stream, fmt, first_id=int(time.time() * 1000)), progress)
     
-    try:
-        # Ler CSV
-        stream = io.StringIO(file.stream.read().decode("UTF8"), newline=None)
-        csv_reader = csv.DictReader(stream)
-        
-        points = []
-        base_id = int(time.time() * 1000)
-        for idx, row in enumerate(csv_reader):
-            try:
-                point_id = row.get('id', '').strip()
-                if point_id and point_id.isdigit():
-                    point_id = int(point_id)
-                else:
-                    point_id = base_id + idx
-                
-                point = {
-                    'id': point_id,
-                    'lat': float(row.get('lat', 0)),
-                    'lng': float(row.get('lng', 0))
-                }
-                points.append(point)
-            except (ValueError, KeyError) as e:
-                print(f"Erro ao processar linha: {row}, erro: {e}")
-                continue
-        
-        if not points:
-            return jsonify({"error": "Nenhum ponto válido encontrado no CSV"}), 400
-        
-        return jsonify({
-            "success": True,
-            "points": points,
-            "count": len(points)
-        })
+    # Ler até ao primeiro ponto válido: um ficheiro sem pontos (ou ilegível) ainda pode dar 400
+    first_point = next(points, None)
+    if first_point is None:
+        stream.close()
+        message = progress.error or "Nenhum ponto válido encontrado no ficheiro"
+        return jsonify({"error": message, **progress.summary()}), 400
     
-    except Exception as e:
-        return jsonify({"error": f"Erro ao processar CSV: {str(e)}"}), 500
+    response = app.response_class(
+        stream_with_context(import_stream(first_point, points, progress)), mimetype='application/json'
+    )
+    response.call_on_close(stream.close)
+    return response
 
 if __name__ == '__main__':
     print("Carregando dados de censos...")
     load_census_data()
+    if ISOCHRONE_BACKEND == 'local':
+        get_walking_graph()
     print("Servidor iniciando em http://localhost:5000")
     app.run(debug=True, port=5000)
 
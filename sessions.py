@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+Sessões de planeamento com recálculo incremental
+
+Uma sessão guarda as estações de um plano e, para cada estação e banda, a
+população atribuída a cada subsecção (a partição pela estação mais próxima).
+Quando uma estação é acrescentada, movida ou removida, só mudam as regiões
+das estações que se sobrepõem às suas zonas antiga e nova, e apenas dentro
+dessas zonas: só essas subsecções são recalculadas. O tempo de cada edição
+depende da dimensão da alteração e não do número de estações do plano.
+
+Com vários processos (workers do gunicorn), o estado das sessões fica numa
+base de dados SQLite partilhada (SessionStore): qualquer worker continua uma
+sessão criada noutro, e cada um só relê uma sessão quando outro a alterou.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+
+import numpy as np
+import shapely
+
+from population_engine import band_rings, closer_halfplanes, polygonal
+
+
+class PlanningSession:
+    """Rede de estações mantida no servidor, com a população atribuída por subsecção"""
+
+    # Estado gravado em SessionStore (as subsecções não: cada processo já as tem carregadas)
+    STATE = ('ranges', 'census_key', 'census_version', 'order', 'info', 'xy', 'rings', 'outer', 'contributions',
+             '_next_order', 'revision')
+
+    def __init__(self, tree, block_geoms, block_areas, block_values, ranges=None, census_key=(), census_version=None):
+        self.tree = tree
+        self.block_geoms = block_geoms
+        self.block_areas = block_areas
+        self.block_values = block_values
+        self.ranges = ranges  # intervalos (segundos) das bandas, para identificar os resultados
+        self.census_key = census_key  # identifica as subsecções usadas (partições carregadas)
+        self.census_version = census_version  # dados de censos com que a sessão foi calculada
+        self.lock = threading.Lock()
+        self.version = None      # versão gravada em SessionStore (muda a cada gravação, em qualquer processo)
+
+        self.order = {}          # id -> número de ordem (desempate entre estações coincidentes)
+        self.info = {}           # id -> dados da estação devolvidos nos resultados (lat, lng...)
+        self.xy = {}             # id -> coordenadas no CRS métrico
+        self.rings = {}          # id -> anéis disjuntos de cada banda
+        self.outer = {}          # id -> união das zonas de todas as bandas
+        self.contributions = {}  # id -> [(subsecções, pessoas, frações da área)] por banda
+        self._next_order = 0
+        self.revision = 0        # muda a cada alteração (identifica o estado nas caches)
+        self._coverage = None
+
+    def __len__(self):
+        return len(self.order)
+
+    def state(self):
+        """Estado da sessão sem as subsecções, para ser restaurado noutro processo"""
+        return {name: getattr(self, name) for name in self.STATE}
+
+    @classmethod
+    def from_state(cls, state, tree, block_geoms, block_areas, block_values):
+        """Sessão restaurada de `state()`, com as subsecções do processo atual"""
+        session = cls(tree, block_geoms, block_areas, block_values)
+        for name in cls.STATE:
+            setattr(session, name, state[name])
+        return session
+
+    def upsert(self, station_id, xy, band_zones, info=None):
+        """Acrescenta ou move uma estação; devolve o que foi recalculado"""
+        band_zones = np.asarray(band_zones, dtype=object).reshape(1, -1)
+        old_outer = self.outer.get(station_id)
+        if station_id not in self.order:
+            self.order[station_id] = self._next_order
+            self._next_order += 1
+        self.info[station_id] = info or {}
+        self.xy[station_id] = np.asarray(xy, dtype=float)
+        self.rings[station_id] = band_rings(band_zones)[0]
+        self.outer[station_id] = shapely.union_all(band_zones[0])
+        self.revision += 1
+        return self._update(station_id, old_outer)
+
+    def load(self, stations):
+        """Carrega várias estações numa sessão vazia, calculando cada uma uma única vez
+
+        `stations` é uma lista de (id, coordenadas, zonas, dados).
+        """
+        for station_id, xy, band_zones, info in stations:
+            band_zones = np.asarray(band_zones, dtype=object).reshape(1, -1)
+            self.order.setdefault(station_id, len(self.order))
+            self.info[station_id] = info or {}
+            self.xy[station_id] = np.asarray(xy, dtype=float)
+            self.rings[station_id] = band_rings(band_zones)[0]
+            self.outer[station_id] = shapely.union_all(band_zones[0])
+        self._next_order = len(self.order)
+        for station_id in self.order:
+            self.contributions[station_id] = self._contributions(station_id)
+        self.revision += 1
+        return {"stations": len(self.order), "blocks": int(sum(len(b) for c in self.contributions.values() for b, _, _ in c))}
+
+    def rebind(self, tree, block_geoms, block_areas, block_values, census_key=()):
+        """Passa a usar outras subsecções (ex.: mais partições) e recalcula todas as estações"""
+        self.tree = tree
+        self.block_geoms = block_geoms
+        self.block_areas = block_areas
+        self.block_values = block_values
+        self.census_key = census_key
+        for station_id in self.order:
+            self.contributions[station_id] = self._contributions(station_id)
+        self.revision += 1
+
+    def remove(self, station_id):
+        """Remove uma estação; devolve o que foi recalculado"""
+        old_outer = self.outer.pop(station_id)
+        for state in (self.order, self.info, self.xy, self.rings, self.contributions):
+            del state[station_id]
+        self.revision += 1
+        return self._update(None, old_outer)
+
+    def populations(self):
+        """Identificadores (por ordem de inserção) e população de cada banda (estações x bandas)"""
+        ids = sorted(self.order, key=self.order.get)
+        totals = np.array([[people.sum() for _, people, _ in self.contributions[i]] for i in ids])
+        return ids, totals
+
+    def coverage(self):
+        """Estação a que cada subsecção coberta é atribuída: a que tem a maior fração da sua área
+
+        Devolve, por ordem das subsecções: índices, ids das estações, banda com a
+        maior fração dessa estação e fração total da área coberta pela estação.
+        """
+        if self._coverage is not None and self._coverage[0] == self.revision:
+            return self._coverage[1]
+
+        ids = sorted(self.order, key=self.order.get)
+        rows = [
+            (blocks, np.full(len(blocks), s), np.full(len(blocks), band), fractions)
+            for s, station_id in enumerate(ids)
+            for band, (blocks, _, fractions) in enumerate(self.contributions[station_id])
+        ]
+        if not sum(len(row[0]) for row in rows):
+            result = (np.empty(0, dtype=np.int64), [], np.empty(0, dtype=np.int64), np.empty(0))
+        else:
+            blocks, stations, bands, fractions = (np.concatenate(column) for column in zip(*rows))
+            pairs, pair_of = np.unique(np.column_stack([blocks, stations]), axis=0, return_inverse=True)
+            pair_of = pair_of.ravel()
+            totals = np.bincount(pair_of, weights=fractions)
+            # Banda com a maior fração de cada par (subsecção, estação)
+            order = np.lexsort((-fractions, pair_of))
+            pair_band = bands[order[np.r_[True, np.diff(pair_of[order]) != 0]]]
+            # Par com a maior fração de cada subsecção (desempate pela ordem de inserção)
+            order = np.lexsort((pairs[:, 1], -totals, pairs[:, 0]))
+            best = order[np.r_[True, np.diff(pairs[order, 0]) != 0]]
+            result = (pairs[best, 0], [ids[s] for s in pairs[best, 1]], pair_band[best], totals[best])
+        self._coverage = (self.revision, result)
+        return result
+
+    def _update(self, changed_id, old_outer):
+        """Recalcula a estação alterada e, nas outras que ela toca, só as subsecções das zonas antiga e nova"""
+        changed_area = [geom for geom in (old_outer, self.outer.get(changed_id)) if geom is not None]
+        changed_area = shapely.union_all(changed_area)
+        touched = self.tree.query(changed_area, predicate='intersects')
+
+        others = [i for i in self.order if i != changed_id]
+        outers = np.array([self.outer[i] for i in others], dtype=object)
+        affected = [others[k] for k in np.flatnonzero(shapely.intersects(outers, changed_area))] if others else []
+
+        if changed_id is not None:
+            self.contributions[changed_id] = self._contributions(changed_id)
+        for station_id in affected:
+            recomputed = self._contributions(station_id, touched)
+            merged = []
+            for (blocks, people, fractions), (new_blocks, new_people, new_fractions) in zip(self.contributions[station_id], recomputed):
+                keep = ~np.isin(blocks, touched)
+                merged.append((
+                    np.concatenate([blocks[keep], new_blocks]),
+                    np.concatenate([people[keep], new_people]),
+                    np.concatenate([fractions[keep], new_fractions])
+                ))
+            self.contributions[station_id] = merged
+
+        return {"stations": len(affected) + (changed_id is not None), "blocks": int(len(touched))}
+
+    def _regions(self, station_id):
+        """Região de cada banda da estação: o seu anel menos as partes mais próximas de outras estações"""
+        rings = self.rings[station_id]
+        others = [i for i in self.order if i != station_id]
+        if not others:
+            return rings
+
+        outers = np.array([self.outer[i] for i in others], dtype=object)
+        neighbours = [others[k] for k in np.flatnonzero(shapely.intersects(outers, self.outer[station_id]))]
+        if not neighbours:
+            return rings
+
+        # Índices locais pela ordem de inserção, para desempatar como no cálculo completo
+        local = sorted([station_id] + neighbours, key=self.order.get)
+        station_xy = np.array([self.xy[i] for i in local])
+        i_pos = local.index(station_id)
+        j_pos = np.array([local.index(j) for j in neighbours])
+        minx, miny, maxx, maxy = shapely.total_bounds([self.outer[i] for i in local])
+        extent = 2 * max(maxx - minx, maxy - miny, 1.0)
+        halfplanes = closer_halfplanes(station_xy, np.full(len(j_pos), i_pos), j_pos, extent)
+
+        regions = rings.copy()
+        for band in range(len(rings)):
+            neighbour_rings = np.array([self.rings[j][band] for j in neighbours], dtype=object)
+            claimed = shapely.intersection(neighbour_rings, halfplanes)
+            regions[band] = shapely.difference(rings[band], shapely.union_all(claimed))
+        return polygonal(regions)
+
+    def _contributions(self, station_id, blocks=None):
+        """População de cada subsecção em cada banda da estação (restrita a `blocks`, se indicado)"""
+        regions = self._regions(station_id)
+        region_idx, block_idx = self.tree.query(regions, predicate='intersects')
+        if blocks is not None:
+            inside = np.isin(block_idx, blocks)
+            region_idx, block_idx = region_idx[inside], block_idx[inside]
+
+        areas = shapely.area(shapely.intersection(regions[region_idx], self.block_geoms[block_idx]))
+        total = self.block_areas[block_idx]
+        fractions = np.divide(areas, total, out=np.ones_like(areas), where=total > 0)
+        people = self.block_values[block_idx] * fractions
+
+        keep = areas > 0
+        return [
+            (block_idx[selected], people[selected], fractions[selected])
+            for selected in (keep & (region_idx == band) for band in range(len(regions)))
+        ]
+
+
+class SessionStore:
+    """Sessões partilhadas entre processos: estado em SQLite e uma cópia em memória em cada processo
+
+    Cada gravação dá à sessão uma nova versão. Um processo usa a sua cópia
+    enquanto a versão gravada for a mesma, e relê o estado quando outro
+    processo a alterou. As gravações são condicionais: se a versão gravada
+    mudou desde a leitura, `save` devolve False e a edição deve ser repetida.
+    Sem `path`, as sessões ficam só na memória do processo.
+    """
+
+    # Verificar o limite de tamanho apenas a cada N gravações
+    EVICTION_INTERVAL = 100
+
+    def __init__(self, memory, restore, path=None, max_entries=10000, ttl=None):
+        self.memory = memory
+        self.restore = restore  # estado -> PlanningSession (None se já não puder ser restaurada)
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reloads = 0
+        self.conflicts = 0
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self._connection() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS sessions ("
+                    "id TEXT PRIMARY KEY, version TEXT NOT NULL, state BLOB NOT NULL, accessed REAL NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS sessions_accessed ON sessions (accessed)")
+
+    def _connection(self):
+        # Uma ligação por thread e por processo, como em cache.DiskCache
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, session_id):
+        """Sessão atual (a cópia deste processo ou o estado gravado por outro) ou None se não existe ou expirou"""
+        local = self.memory.get(session_id)
+        if not self.path:
+            return local
+
+        now = time.time()
+        conn = self._connection()
+        row = conn.execute("SELECT version, accessed FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None or (self.ttl and row[1] + self.ttl < now):
+            if row is not None:
+                with conn:
+                    conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self.memory.delete(session_id)
+            self.misses += 1
+            return None
+        version = row[0]
+        with conn:
+            conn.execute("UPDATE sessions SET accessed = ? WHERE id = ?", (now, session_id))
+        self.hits += 1
+        if local is not None and local.version == version:
+            return local
+
+        state = conn.execute("SELECT state FROM sessions WHERE id = ? AND version = ?", (session_id, version)).fetchone()
+        session = self.restore(pickle.loads(state[0])) if state is not None else None
+        if session is None:
+            self.memory.delete(session_id)
+            return None
+        self.reloads += 1
+        session.version = version
+        self.memory.set(session_id, session)
+        return session
+
+    def add(self, session_id, session):
+        """Grava uma sessão nova"""
+        session.version = uuid.uuid4().hex
+        if self.path:
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO sessions (id, version, state, accessed) VALUES (?, ?, ?, ?)",
+                    (session_id, session.version, pickle.dumps(session.state(), pickle.HIGHEST_PROTOCOL), time.time())
+                )
+            self._written()
+        self.memory.set(session_id, session)
+
+    def save(self, session_id, session, base_version):
+        """Grava uma sessão alterada, se ninguém a gravou desde `base_version`; senão descarta a cópia e devolve False"""
+        version = uuid.uuid4().hex
+        if self.path:
+            conn = self._connection()
+            with conn:
+                updated = conn.execute(
+                    "UPDATE sessions SET version = ?, state = ?, accessed = ? WHERE id = ? AND version = ?",
+                    (version, pickle.dumps(session.state(), pickle.HIGHEST_PROTOCOL), time.time(), session_id, base_version)
+                ).rowcount
+            if not updated:
+                self.conflicts += 1
+                self.discard(session_id)
+                return False
+            self._written()
+        session.version = version
+        self.memory.set(session_id, session)
+        return True
+
+    def discard(self, session_id):
+        """Esquece a cópia deste processo (alterada sem ser gravada); o estado gravado é relido no próximo pedido"""
+        if self.path:
+            self.memory.delete(session_id)
+
+    def delete(self, session_id):
+        self.memory.delete(session_id)
+        if self.path:
+            conn = self._connection()
+            with conn:
+                conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def _written(self):
+        self._writes += 1
+        if self._writes % self.EVICTION_INTERVAL == 0:
+            self.evict()
+
+    def evict(self):
+        """Remove as sessões expiradas e as menos usadas acima do limite"""
+        conn = self._connection()
+        with conn:
+            if self.ttl:
+                conn.execute("DELETE FROM sessions WHERE accessed < ?", (time.time() - self.ttl,))
+            count = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            excess = count - self.max_entries
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM sessions WHERE id IN (SELECT id FROM sessions ORDER BY accessed LIMIT ?)",
+                    (excess,)
+                )
+                self.evictions += excess
+
+    def __len__(self):
+        if not self.path:
+            return len(self.memory)
+        return self._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def stats(self):
+        stats = {"memory": self.memory.stats()}
+        if self.path:
+            stats["disk"] = {
+                "path": self.path,
+                "entries": len(self),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "reloads": self.reloads,
+                "conflicts": self.conflicts
+            }
+        return stats
@@ -5,12 +5,21 @@
 source venv/bin/activate
 
 # Verificar se os dados foram processados
-if [ ! -f "data/census_data.geojson" ]; then
+if [ ! -f "data/census_data.geojson" ] && [ ! -d "data/shards" ]; then
     echo "Processando dados de censos..."
     python3 process_data.py
 fi
 
-# Iniciar servidor
-echo "Iniciando servidor em http://localhost:5000"
-python3 server.py
+# Iniciar servidor ("./start.sh prod" para vários workers com gunicorn,
+# "./start.sh async" para o ponto de entrada ASGI com chamadas ao ORS assíncronas)
+if [ "$1" = "prod" ]; then
+    echo "Iniciando servidor de produção em http://localhost:5000"
+    gunicorn -c gunicorn.conf.py wsgi:app
+elif [ "$1" = "async" ]; then
+    echo "Iniciando servidor (ASGI) em http://localhost:5000"
+    uvicorn asgi:app --port 5000
+else
+    echo "Iniciando servidor em http://localhost:5000"
+    python3 server.py
+fi
 
@@ -6,6 +6,7 @@ const EVORA_ZOOM = 13;
 // Raio em metros
 const RADIUS_5MIN = 417;  // ~5 minutos a pé
 const RADIUS_10MIN = 833; // ~10 minutos a pé
+const BATCH_MAX_LOCATIONS = 500; // localizações por pedido em lote (MAX_BATCH_LOCATIONS no servidor)
 
 // Estado da aplicação
 let map;
@@ -15,6 +16,15 @@ let isochroneLayers = [];
 let stationIsochroneLayers = {}; // Mapear station.id -> array de camadas
 let isUpdating = false;
 
+// Sessão de planeamento no servidor: só as estações alteradas são enviadas e recalculadas
+let populationSession = null; // {id, synced: {station.id: assinatura}}
+
+// Pré-visualização da população enquanto uma estação é arrastada (subsecções simplificadas no servidor;
+// demora quase o mesmo que o cálculo exato, por isso só há um pedido de cada vez)
+let previewRequest = null;  // pedido em curso (um de cada vez)
+let previewPending = false; // a estação mudou de posição durante o pedido em curso
+let previewGeneration = 0;  // muda no fim do arrastamento: respostas atrasadas são ignoradas
+
 // Sistema de undo/redo
 let historyStack = []; // Histórico de estados
 let historyIndex = -1; // Índice atual no histórico
@@ -180,6 +190,7 @@ function restoreState(state, skipSave = false) {
             // Preservar cache se coordenadas não mudaram
             cachePreservation[String(oldStation.id)] = {
                 isochrones: oldStation.isochrones,
+                isochroneId: oldStation.isochroneId,
                 cachedLat: oldStation.cachedLat,
                 cachedLng: oldStation.cachedLng,
                 isochroneError: oldStation.isochroneError
@@ -385,10 +396,12 @@ function createStationMarker(station) {
             stations[stationIndex].lat = newLat;
             stations[stationIndex].lng = newLng;
         }
+        previewPopulation(station.id);
     });
     
     marker.on('dragend', async function(e) {
         isUpdating = false;
+        endPopulationPreview();
         const newLat = e.target.getLatLng().lat;
         const newLng = e.target.getLatLng().lng;
         
@@ -425,6 +438,7 @@ function createStationMarker(station) {
         // Limpar cache e recriar isócronas
         removeStationIsochrones(currentStation.id);
         currentStation.isochrones = null;
+        currentStation.isochroneId = null;
         currentStation.cachedLat = null;
         currentStation.cachedLng = null;
         currentStation.isochroneError = null;
@@ -598,6 +612,7 @@ async function createIsochrones(station, forceRefresh = false) {
         // Guardar geometrias das isócronas na estação para cálculo de população
         // E também guardar as coordenadas para verificar cache no futuro
         station.isochrones = data.isochrones || [];
+        station.isochroneId = data.isochrone_id || null; // referência às isócronas guardadas no servidor
         station.cachedLat = station.lat;
         station.cachedLng = station.lng;
         station.isochroneError = null; // Limpar erro anterior se houver
@@ -606,6 +621,7 @@ async function createIsochrones(station, forceRefresh = false) {
         const stationIndex = stations.findIndex(s => s.id === station.id);
         if (stationIndex !== -1) {
             stations[stationIndex].isochrones = station.isochrones;
+            stations[stationIndex].isochroneId = station.isochroneId;
             stations[stationIndex].cachedLat = station.cachedLat;
             stations[stationIndex].cachedLng = station.cachedLng;
             stations[stationIndex].isochroneError = null;
@@ -622,12 +638,14 @@ async function createIsochrones(station, forceRefresh = false) {
         
         // Não criar círculos de fallback - mostrar erro
         station.isochrones = null;
+        station.isochroneId = null;
         station.isochroneError = error.message || 'Erro ao obter isócronas';
         
         // Atualizar também no array stations
         const stationIndex = stations.findIndex(s => s.id === station.id);
         if (stationIndex !== -1) {
             stations[stationIndex].isochrones = null;
+            stations[stationIndex].isochroneId = null;
             stations[stationIndex].isochroneError = station.isochroneError;
         }
         
@@ -670,6 +688,51 @@ async function createIsochrones(station, forceRefresh = false) {
     }
 }
 
+// Obter isócronas de várias estações num único pedido (ex.: após importar CSV)
+// As isócronas ficam em cache na estação e são desenhadas pelo updateMap
+async function prefetchIsochrones(stationList) {
+    const pending = stationList.filter(s => !hasValidCache(s));
+    if (pending.length === 0) {
+        return;
+    }
+    
+    try {
+        // Pedidos de até BATCH_MAX_LOCATIONS estações (o servidor recusa lotes maiores)
+        for (let start = 0; start < pending.length; start += BATCH_MAX_LOCATIONS) {
+            const batch = pending.slice(start, start + BATCH_MAX_LOCATIONS);
+            const response = await fetch('http://localhost:5000/api/isochrones/batch', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({
+                    locations: batch.map(s => ({ id: s.id, lat: s.lat, lng: s.lng })),
+                    ranges: [300, 600]
+                })
+            });
+            
+            if (!response.ok) {
+                throw new Error('Erro ao obter isócronas em lote');
+            }
+            
+            const data = await response.json();
+            data.results.forEach((result, index) => {
+                const station = batch[index];
+                if (result.isochrones && result.isochrones.length >= 2) {
+                    station.isochrones = result.isochrones;
+                    station.isochroneId = result.isochrone_id || null;
+                    station.cachedLat = station.lat;
+                    station.cachedLng = station.lng;
+                    station.isochroneError = null;
+                }
+            });
+        }
+    } catch (error) {
+        // As estações sem isócronas são pedidas individualmente pelo updateMap
+        console.warn('Erro ao obter isócronas em lote:', error);
+    }
+}
+
 // Remover isócronas de uma estação específica
 function removeStationIsochrones(stationId) {
     // Remover apenas as camadas desta estação
@@ -706,6 +769,149 @@ function removeStationIsochrones(stationId) {
     }
 }
 
+// Dados de uma estação enviados ao servidor para o cálculo de população
+// Com isócronas guardadas no servidor basta a referência; a geometria só segue com `inline`
+function stationPayload(s, inline = false) {
+    const hasIsochrones = s.isochrones && !s.isochroneError && Array.isArray(s.isochrones) && s.isochrones.length >= 2;
+    const payload = { id: s.id, lat: s.lat, lng: s.lng, isochrones: null };
+    if (hasIsochrones && s.isochroneId && !inline) {
+        payload.isochrone_id = s.isochroneId;
+    } else if (hasIsochrones) {
+        payload.isochrones = s.isochrones;  // Enviar isócronas apenas se disponíveis e sem erro
+    }
+    return payload;
+}
+
+// Assinatura de uma estação: muda quando a posição ou as isócronas mudam
+function payloadSignature(p) {
+    const iso = p.isochrone_id || (p.isochrones ? p.isochrones.map(f => JSON.stringify(f.geometry.coordinates).length) : null);
+    return JSON.stringify([p.lat, p.lng, iso]);
+}
+
+// POST com as estações por referência; se o servidor já não tiver algumas isócronas (409),
+// repete o pedido enviando a geometria dessas estações
+async function postStations(url, payload, makeBody) {
+    const request = (stationList) => fetch(url, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify(makeBody(stationList))
+    });
+    
+    const response = await request(payload);
+    if (response.status !== 409) {
+        return response;
+    }
+    
+    const missing = new Set((await response.json()).missing_isochrone_ids || []);
+    return request(payload.map(p => {
+        const station = stations.find(s => String(s.id) === String(p.id));
+        return (station && missing.has(p.isochrone_id)) ? stationPayload(station, true) : p;
+    }));
+}
+
+// Sincronizar as estações com a sessão do servidor e devolver os totais
+async function syncPopulationSession(payload) {
+    const signatures = Object.fromEntries(payload.map(p => [String(p.id), payloadSignature(p)]));
+    
+    if (populationSession) {
+        const upsert = payload.filter(p => populationSession.synced[String(p.id)] !== signatures[String(p.id)]);
+        const remove = Object.keys(populationSession.synced).filter(id => !(id in signatures));
+        
+        const response = (upsert.length === 0 && remove.length === 0)
+            ? await fetch(`http://localhost:5000/api/sessions/${populationSession.id}`)
+            : await postStations(`http://localhost:5000/api/sessions/${populationSession.id}/edits`, upsert,
+                stationList => ({ upsert: stationList, remove: remove }));
+        
+        if (response.ok) {
+            populationSession.synced = signatures;
+            return await response.json();
+        }
+        // Sessão expirada (ou servidor reiniciado): criar uma nova com todas as estações
+        populationSession = null;
+    }
+    
+    const response = await postStations('http://localhost:5000/api/sessions', payload,
+        stationList => ({ stations: stationList }));
+    
+    if (!response.ok) {
+        throw new Error('Erro ao calcular população');
+    }
+    
+    const data = await response.json();
+    populationSession = { id: data.session_id, synced: signatures };
+    return data;
+}
+
+// Estimativa rápida com a estação arrastada na posição atual (círculos em vez de isócronas)
+function previewPopulation(stationId) {
+    if (previewRequest) {
+        previewPending = true;
+        return;
+    }
+    const generation = previewGeneration;
+    const payload = stations.map(s => s.id === stationId
+        ? { id: s.id, lat: s.lat, lng: s.lng, isochrones: null }
+        : stationPayload(s));
+    
+    previewRequest = postStations('http://localhost:5000/api/population-in-isochrones', payload,
+        stationList => ({ points: stationList, precision: 'preview' }))
+        .then(response => response.ok ? response.json() : null)
+        .then(data => {
+            if (data && generation === previewGeneration) {
+                applyPopulation(data);
+                document.querySelector('.stats-section').classList.add('preview');
+            }
+        })
+        .catch(error => console.warn('Erro na pré-visualização da população:', error))
+        .finally(() => {
+            previewRequest = null;
+            if (previewPending && generation === previewGeneration) {
+                previewPending = false;
+                previewPopulation(stationId);
+            }
+        });
+}
+
+// Terminar a pré-visualização; os valores exatos chegam com calculatePopulation()
+function endPopulationPreview() {
+    previewGeneration++;
+    previewPending = false;
+}
+
+// Atualizar a população das estações e os totais com a resposta do servidor
+function applyPopulation(data) {
+    stations = stations.map(station => {
+        // Comparar IDs convertendo ambos para string para garantir correspondência
+        const pointData = data.points.find(p => {
+            const pId = String(p.id);
+            const sId = String(station.id);
+            return pId === sId;
+        });
+        
+        if (pointData) {
+            // Garantir que os valores são números
+            return {
+                ...station,
+                population_5min: Number(pointData.population_5min) || 0,
+                population_10min: Number(pointData.population_10min) || 0,
+                population_total: Number(pointData.population_total) || 0
+            };
+        }
+        // Se não encontrou, manter valores existentes ou zerar
+        return {
+            ...station,
+            population_5min: Number(station.population_5min) || 0,
+            population_10min: Number(station.population_10min) || 0,
+            population_total: Number(station.population_total) || 0
+        };
+    });
+    
+    updateSidebarStats(data);
+    updateSidebar(); // Atualizar sidebar para mostrar valores atualizados
+}
+
 // Calcular população
 async function calculatePopulation() {
     if (stations.length === 0) {
@@ -720,56 +926,8 @@ async function calculatePopulation() {
     }
     
     try {
-        const response = await fetch('http://localhost:5000/api/population-in-isochrones', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                points: stations.map(s => ({
-                    id: s.id,
-                    lat: s.lat,
-                    lng: s.lng,
-                    isochrones: (s.isochrones && !s.isochroneError && Array.isArray(s.isochrones) && s.isochrones.length >= 2) ? s.isochrones : null  // Enviar isócronas apenas se disponíveis e sem erro
-                }))
-            })
-        });
-        
-        if (!response.ok) {
-            throw new Error('Erro ao calcular população');
-        }
-        
-        const data = await response.json();
-        
-        // Atualizar dados das estações
-        stations = stations.map(station => {
-            // Comparar IDs convertendo ambos para string para garantir correspondência
-            const pointData = data.points.find(p => {
-                const pId = String(p.id);
-                const sId = String(station.id);
-                return pId === sId;
-            });
-            
-            if (pointData) {
-                // Garantir que os valores são números
-                return {
-                    ...station,
-                    population_5min: Number(pointData.population_5min) || 0,
-                    population_10min: Number(pointData.population_10min) || 0,
-                    population_total: Number(pointData.population_total) || 0
-                };
-            }
-            // Se não encontrou, manter valores existentes ou zerar
-            return {
-                ...station,
-                population_5min: Number(station.population_5min) || 0,
-                population_10min: Number(station.population_10min) || 0,
-                population_total: Number(station.population_total) || 0
-            };
-        });
-        
-        updateSidebarStats(data);
-        updateSidebar(); // Atualizar sidebar para mostrar valores atualizados
+        const data = await syncPopulationSession(stations.map(stationPayload));
+        applyPopulation(data);
     } catch (error) {
         console.error('Erro ao calcular população:', error);
         // Em caso de erro, ainda atualizamos a sidebar sem dados de população
@@ -798,6 +956,7 @@ async function calculatePopulation() {
 
 // Atualizar sidebar com estatísticas
 function updateSidebarStats(data) {
+    document.querySelector('.stats-section').classList.remove('preview');
     document.getElementById('total-population').textContent = formatNumber(data.total_population);
     document.getElementById('total-pop-5min').textContent = formatNumber(data.total_population_5min);
     document.getElementById('total-pop-10min').textContent = formatNumber(data.total_population_10min);
@@ -908,15 +1067,15 @@ async function exportToCSV() {
     }
 }
 
-// Importar pontos de CSV
+// Importar pontos de CSV, GeoJSON ou GeoParquet
 async function importFromCSV(event) {
     const file = event.target.files[0];
     if (!file) {
         return;
     }
     
-    if (!file.name.endsWith('.csv')) {
-        alert('Por favor, selecione um arquivo CSV');
+    if (!/\.(csv|geojson|geojsonl|json|parquet|geoparquet)$/i.test(file.name)) {
+        alert('Por favor, selecione um arquivo CSV, GeoJSON ou GeoParquet');
         return;
     }
     
@@ -941,8 +1100,10 @@ async function importFromCSV(event) {
             saveState();
             
             // Perguntar se quer substituir ou adicionar
+            const skipped = data.invalid ? `\n${data.invalid} linhas inválidas ignoradas` +
+                (data.errors && data.errors.length ? ` (ex.: linha ${data.errors[0].row}: ${data.errors[0].error})` : '') : '';
             const action = confirm(
-                `Encontrados ${data.count} pontos no CSV.\n\n` +
+                `Encontrados ${data.count} pontos no ficheiro.${skipped}\n\n` +
                 'OK = Adicionar aos pontos existentes\n' +
                 'Cancelar = Substituir todos os pontos'
             );
@@ -975,6 +1136,9 @@ async function importFromCSV(event) {
             // Limpar input
             event.target.value = '';
             
+            // Obter as isócronas das novas estações num único pedido
+            await prefetchIsochrones(stations);
+            
             // Atualizar mapa e calcular população
             updateMap();
             updateSidebar();
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Otimização da localização de estações (cobertura máxima)
+
+Para um conjunto de locais candidatos, a matriz esparsa de cobertura guarda,
+para cada candidato e banda de tempo, a fração da área de cada subsecção
+dentro da zona do candidato. A cobertura de uma seleção conta cada
+subsecção uma única vez (a maior fração entre as estações escolhidas), pelo
+que avaliar um candidato é uma operação sobre uma linha da matriz. O
+objetivo é submodular, o que permite o guloso preguiçoso (lazy greedy),
+seguido de uma pesquisa local por trocas.
+"""
+import heapq
+
+import numpy as np
+import scipy.sparse as sp
+
+from population_engine import area_weights
+
+# Ganho mínimo (pessoas) para aceitar uma troca na pesquisa local
+MIN_IMPROVEMENT = 1e-6
+
+
+def grid_candidates(minx, miny, maxx, maxy, spacing):
+    """Centros de uma grelha regular (CRS métrico) dentro do retângulo, como array (n, 2)"""
+    xs = np.arange(minx + spacing / 2, maxx, spacing)
+    ys = np.arange(miny + spacing / 2, maxy, spacing)
+    gx, gy = np.meshgrid(xs, ys)
+    return np.column_stack([gx.ravel(), gy.ravel()])
+
+
+def coverage_matrix(band_zones, tree, block_geoms, block_areas):
+    """Matriz esparsa (candidatos x (bandas * subsecções)) com a fração de cada subsecção coberta
+
+    As colunas da banda `k` são `k * n_subsecções + subsecção`.
+    """
+    band_zones = np.asarray(band_zones, dtype=object)
+    n_candidates, n_bands = band_zones.shape
+    n_blocks = len(block_geoms)
+    zone_idx, block_idx, fractions = area_weights(band_zones.ravel(), tree, block_geoms, block_areas)
+    candidate, band = np.divmod(zone_idx, n_bands)
+    return sp.csr_matrix(
+        (np.minimum(fractions, 1.0), (candidate, band * n_blocks + block_idx)),
+        shape=(n_candidates, n_bands * n_blocks)
+    )
+
+
+class CoverageProblem:
+    """Problema de cobertura máxima sobre uma matriz de cobertura e os valores (pesos) de cada coluna"""
+
+    def __init__(self, matrix, values):
+        self.matrix = sp.csr_matrix(matrix)
+        self.values = np.asarray(values, dtype=float)
+        self._rows = np.repeat(np.arange(self.matrix.shape[0]), np.diff(self.matrix.indptr))
+
+    @property
+    def num_candidates(self):
+        return self.matrix.shape[0]
+
+    def covered(self, selected):
+        """Fração coberta de cada coluna pela seleção (máximo entre as estações escolhidas)"""
+        current = np.zeros(self.matrix.shape[1])
+        for candidate in selected:
+            self.add(current, candidate)
+        return current
+
+    def add(self, current, candidate):
+        start, end = self.matrix.indptr[candidate], self.matrix.indptr[candidate + 1]
+        cols = self.matrix.indices[start:end]
+        np.maximum.at(current, cols, self.matrix.data[start:end])
+
+    def objective(self, current):
+        return float(current @ self.values)
+
+    def gain(self, current, candidate):
+        """Aumento do objetivo ao acrescentar um candidato (uma linha da matriz)"""
+        start, end = self.matrix.indptr[candidate], self.matrix.indptr[candidate + 1]
+        cols = self.matrix.indices[start:end]
+        extra = np.maximum(self.matrix.data[start:end] - current[cols], 0.0)
+        return float(extra @ self.values[cols])
+
+    def all_gains(self, current):
+        """Ganho de todos os candidatos de uma vez (uma passagem pelos valores não nulos da matriz)"""
+        cols = self.matrix.indices
+        extra = np.maximum(self.matrix.data - current[cols], 0.0) * self.values[cols]
+        return np.bincount(self._rows, weights=extra, minlength=self.num_candidates)
+
+    def greedy(self, budget, fixed=()):
+        """Guloso preguiçoso: acrescenta `budget` candidatos aos fixos, sempre o de maior ganho
+
+        Como o objetivo é submodular, o ganho de um candidato só pode descer: os
+        ganhos antigos no heap são limites superiores e só o topo é recalculado.
+        """
+        selected = list(dict.fromkeys(fixed))
+        n_fixed = len(selected)
+        current = self.covered(selected)
+        taken = set(selected)
+
+        heap = [(-gain, candidate) for candidate, gain in enumerate(self.all_gains(current)) if candidate not in taken]
+        heapq.heapify(heap)
+        evaluations = 0
+        while heap and len(selected) - n_fixed < budget:
+            _, candidate = heapq.heappop(heap)
+            gain = self.gain(current, candidate)
+            evaluations += 1
+            if heap and gain < -heap[0][0]:
+                heapq.heappush(heap, (-gain, candidate))
+                continue
+            if gain <= 0:
+                break
+            selected.append(candidate)
+            taken.add(candidate)
+            self.add(current, candidate)
+        return selected, evaluations
+
+    def local_search(self, selected, fixed=(), max_rounds=10):
+        """Pesquisa local por trocas: substitui uma estação não fixa pelo melhor candidato enquanto melhorar"""
+        selected = list(selected)
+        fixed = set(fixed)
+        swaps = 0
+        for _ in range(max_rounds):
+            improved = False
+            for position, candidate in enumerate(selected):
+                if candidate in fixed:
+                    continue
+                others = selected[:position] + selected[position + 1:]
+                current = self.covered(others)
+                loss = self.gain(current, candidate)
+
+                gains = self.all_gains(current)
+                gains[selected] = -np.inf
+                best = int(np.argmax(gains))
+                if gains[best] > loss + MIN_IMPROVEMENT:
+                    selected[position] = best
+                    swaps += 1
+                    improved = True
+            if not improved:
+                break
+        return selected, swaps
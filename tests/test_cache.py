@@ -0,0 +1,67 @@
+import threading
+
+import pytest
+
+from cache import LRUCache, TieredCache
+
+
+def test_get_or_compute_shares_result():
+    cache = TieredCache(LRUCache(8))
+    calls = []
+    assert cache.get_or_compute("k", lambda: calls.append(1) or 42) == 42
+    assert cache.get_or_compute("k", lambda: calls.append(1) or 0) == 42
+    assert len(calls) == 1
+
+
+def test_get_or_compute_error_reaches_coalesced_callers():
+    """Se o cálculo falhar, quem esperava por ele recebe a mesma exceção (e não None)"""
+    cache = TieredCache(LRUCache(8))
+    started = threading.Event()
+    release = threading.Event()
+
+    def compute():
+        started.set()
+        release.wait(5)
+        raise ValueError("falhou")
+
+    outcomes = {}
+
+    def call(name, fn):
+        try:
+            outcomes[name] = cache.get_or_compute("k", fn)
+        except ValueError as e:
+            outcomes[name] = e
+
+    leader = threading.Thread(target=call, args=("leader", compute))
+    leader.start()
+    assert started.wait(5)
+    follower = threading.Thread(target=call, args=("follower", lambda: pytest.fail("cálculo repetido")))
+    follower.start()
+    # Esperar até o segundo pedido estar à espera do cálculo em curso
+    while cache.coalesced == 0:
+        threading.Event().wait(0.001)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert isinstance(outcomes["leader"], ValueError)
+    assert isinstance(outcomes["follower"], ValueError)
+    assert cache.get("k") is None
+    # Depois da falha, um novo pedido volta a calcular
+    assert cache.get_or_compute("k", lambda: 7) == 7
+
+
+def test_lru_weight_budget():
+    """Com max_weight, as entradas menos usadas saem quando o total dos pesos passa o limite"""
+    cache = LRUCache(8, max_weight=10, weight=len)
+    cache.set("a", [0] * 4)
+    cache.set("b", [0] * 4)
+    cache.get("a")
+    cache.set("c", [0] * 4)
+    assert cache.get("b") is None and cache.get("a") is not None
+    assert cache.stats()["weight"] == 8
+    # Uma entrada acima do limite fica sozinha
+    cache.set("d", [0] * 20)
+    assert len(cache) == 1 and cache.get("d") is not None
+    cache.delete("d")
+    assert cache.stats()["weight"] == 0
@@ -0,0 +1,46 @@
+import io
+import json
+import os
+
+import pytest
+
+# Sem caches em disco nem ficheiros criados pelo servidor durante os testes
+os.environ.setdefault("ISOCHRONE_CACHE_DISK", "")
+os.environ.setdefault("TILE_CACHE_DISK", "")
+
+import server  # noqa: E402
+from point_io import parquet_chunks  # noqa: E402
+
+POINTS = [
+    {"id": 1, "lat": "38.5", "lng": "-7.9", "population_5min": "12"},
+    {"id": "b", "lat": 38.6, "lng": -7.8}
+]
+
+
+def test_export_geojson_coordinates_are_numbers():
+    """Coordenadas enviadas como texto são exportadas como números (GeoJSON válido)"""
+    response = server.app.test_client().post("/api/export-points?format=geojson", json={"points": POINTS})
+    assert response.status_code == 200
+    features = json.loads(response.get_data())["features"]
+    assert features[0]["geometry"]["coordinates"] == [-7.9, 38.5]
+    assert features[0]["properties"]["population_5min"] == 12.0
+
+
+def test_export_rejects_invalid_values():
+    client = server.app.test_client()
+    for point in ({"lat": "abc", "lng": 0}, {"lat": float("nan"), "lng": 0}, {"lat": 1, "lng": 2, "population_5min": "x"}):
+        assert client.post("/api/export-points?format=parquet", json={"points": [point]}).status_code == 400
+
+
+def test_parquet_schema_is_fixed_before_null_batches():
+    """Um primeiro bloco só com nulos numa coluna não fixa o tipo dessa coluna"""
+    pq = pytest.importorskip("pyarrow.parquet")
+    rows = [
+        {"id": None, "lat": 38.5, "lng": -7.9, "population_5min": None},
+        {"id": 7, "lat": 38.6, "lng": -7.8, "population_5min": 3.5}
+    ]
+    data = b"".join(parquet_chunks(rows, ["id", "lat", "lng", "population_5min"], chunk_rows=1))
+    table = pq.read_table(io.BytesIO(data))
+    assert table.column("id").to_pylist() == [None, "7"]
+    assert table.column("population_5min").to_pylist() == [None, 3.5]
+    assert "geo" in {key.decode() for key in table.schema.metadata}
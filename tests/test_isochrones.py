@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+# Sem caches em disco nem ficheiros criados pelo servidor durante os testes
+os.environ.setdefault("ISOCHRONE_CACHE_DISK", "")
+os.environ.setdefault("TILE_CACHE_DISK", "")
+
+import server  # noqa: E402
+
+
+@pytest.mark.parametrize("body", [
+    {"lat": "abc", "lng": -7.9},
+    {"lat": 38.5, "lng": [1]},
+    {"lat": True, "lng": -7.9},
+    {"lat": 38.5, "lng": float("inf")},
+    [38.5, -7.9]
+])
+def test_isochrones_reject_invalid_coordinates(body):
+    """Coordenadas que não são números dão 400 antes de chegarem à cache (e não 500)"""
+    response = server.app.test_client().post("/api/isochrones", json=body)
+    assert response.status_code == 400
+
+
+def test_batch_rejects_too_many_locations(monkeypatch):
+    monkeypatch.setattr(server, "MAX_BATCH_LOCATIONS", 3)
+    client = server.app.test_client()
+    locations = [{"lat": 38.5, "lng": -7.9 + k / 1000} for k in range(4)]
+    response = client.post("/api/isochrones/batch", json={"locations": locations, "backend": "circle"})
+    assert response.status_code == 400
+    assert "máximo 3" in response.get_json()["error"]
+    response = client.post("/api/isochrones/batch", json={"locations": locations[:3], "backend": "circle"})
+    assert response.status_code == 200 and len(response.get_json()["results"]) == 3
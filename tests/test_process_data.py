@@ -0,0 +1,49 @@
+import json
+import os
+
+import geopandas as gpd
+import shapely
+
+import process_data
+
+
+def census(codes):
+    """Subsecções quadradas em coordenadas métricas; a posição e a população dependem só do código BGRI2021"""
+    parish, block = (int(code[4:6]) for code in codes), (int(code[-2:]) for code in codes)
+    return gpd.GeoDataFrame({
+        "BGRI2021": codes,
+        "DTMN21": [code[:4] for code in codes],
+        "N_INDIVIDUOS": [int(code[-2:]) + 1 for code in codes]
+    }, geometry=[shapely.box(b * 100, p * 100, b * 100 + 90, p * 100 + 90) for p, b in zip(parish, block)],
+        crs=process_data.METRIC_CRS)
+
+
+def test_insert_recomputes_only_its_chunk(tmp_path, monkeypatch):
+    """Uma subsecção nova só altera o bloco da sua freguesia, e uma execução sem alterações não reescreve os dados"""
+    monkeypatch.chdir(tmp_path)
+    codes = [f"0705{parish:02d}001{block:02d}" for parish in (1, 2, 3) for block in range(3)]
+    census(codes).to_file("census.gpkg", driver="GPKG")
+    process_data.process_census_data(["census.gpkg"], workers=1, chunk_size=5)
+    with open(process_data.MANIFEST_FILE, encoding="utf-8") as f:
+        assert len(json.load(f)["inputs"]["census.gpkg"]["chunks"]) == 3
+
+    with open(process_data.MANIFEST_FILE, encoding="utf-8") as f:
+        before = [chunk["hash"] for chunk in json.load(f)["inputs"]["census.gpkg"]["chunks"]]
+    chunk_mtimes = {content: os.stat(process_data.chunk_file(content)).st_mtime_ns for content in before}
+
+    census(codes[:1] + ["07050100199"] + codes[1:]).to_file("census.gpkg", driver="GPKG")
+    process_data.process_census_data(["census.gpkg"], workers=1, chunk_size=5)
+    with open(process_data.MANIFEST_FILE, encoding="utf-8") as f:
+        manifest = json.load(f)
+    assert manifest["chunks_built"] == 1
+    chunks = manifest["inputs"]["census.gpkg"]["chunks"]
+    assert [chunk["rows"] for chunk in chunks] == [4, 3, 3]
+    # Os blocos das outras freguesias são os mesmos ficheiros da cache, sem serem reescritos
+    assert [chunk["hash"] for chunk in chunks[1:]] == before[1:]
+    assert all(os.stat(process_data.chunk_file(content)).st_mtime_ns == chunk_mtimes[content] for content in before[1:])
+    assert not os.path.exists(process_data.chunk_file(before[0]))
+
+    store_mtime = os.stat("data/census_data.arrow").st_mtime_ns
+    os.utime("census.gpkg")
+    process_data.process_census_data(["census.gpkg"], workers=1, chunk_size=5)
+    assert os.stat("data/census_data.arrow").st_mtime_ns == store_mtime
@@ -0,0 +1,51 @@
+import numpy as np
+import shapely
+
+from cache import LRUCache
+from sessions import PlanningSession, SessionStore
+
+
+def census():
+    """Subsecções de 100 m numa grelha de 10 x 10, com 10 pessoas cada"""
+    x, y = (v.ravel() for v in np.meshgrid(np.arange(0, 1000, 100.0), np.arange(0, 1000, 100.0)))
+    geoms = shapely.box(x, y, x + 100, y + 100)
+    return shapely.STRtree(geoms), geoms, shapely.area(geoms), np.full(len(geoms), 10.0)
+
+
+def zones(x, y):
+    return [shapely.Point(x, y).buffer(150), shapely.Point(x, y).buffer(300)]
+
+
+def worker_store(path, data):
+    """Um SessionStore por processo, todos com a mesma base de dados"""
+    return SessionStore(LRUCache(8), lambda state: PlanningSession.from_state(state, *data), str(path))
+
+
+def test_sessions_continue_in_another_process(tmp_path):
+    """Uma sessão criada num worker é editada noutro, de forma incremental, e as gravações concorrentes não se perdem"""
+    data = census()
+    first, second = worker_store(tmp_path / "sessions.sqlite", data), worker_store(tmp_path / "sessions.sqlite", data)
+
+    session = PlanningSession(*data, ranges=[300, 600])
+    session.load([(1, (300, 300), zones(300, 300), {}), (2, (600, 600), zones(600, 600), {})])
+    first.add("s", session)
+
+    other = second.get("s")
+    assert other is not session and other.populations()[1].tolist() == session.populations()[1].tolist()
+    base = other.version
+    other.upsert(2, (700, 500), zones(700, 500))
+    assert second.save("s", other, base)
+
+    # O primeiro worker relê o estado gravado pelo segundo
+    current = first.get("s")
+    assert current.version == other.version
+    assert current.populations()[1].tolist() == other.populations()[1].tolist()
+
+    # Uma edição feita sobre uma versão antiga não é gravada
+    stale = session
+    stale.upsert(1, (200, 200), zones(200, 200))
+    assert not first.save("s", stale, base)
+    assert first.get("s").version == other.version
+
+    first.delete("s")
+    assert second.get("s") is None
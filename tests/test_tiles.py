@@ -0,0 +1,34 @@
+import os
+
+import numpy as np
+import pytest
+import shapely
+
+# Sem caches em disco nem ficheiros criados pelo servidor durante os testes
+os.environ.setdefault("ISOCHRONE_CACHE_DISK", "")
+os.environ.setdefault("TILE_CACHE_DISK", "")
+
+import server  # noqa: E402
+from tiles import encode_mvt  # noqa: E402
+
+mapbox_vector_tile = pytest.importorskip("mapbox_vector_tile")
+
+
+def test_coverage_properties_keep_value_types():
+    """Ids numéricos das estações continuam inteiros no mosaico (e não texto)"""
+    rows = [
+        {"station": 5, "band": "5min", "fraction": np.float64(0.25), "population": 12.0},
+        {"station": "norte", "band": "10min", "fraction": 1.0, "population": np.int64(3), "new": np.bool_(True)},
+        {"station": np.int64(7), "band": "5min", "fraction": float("nan"), "population": None},
+    ]
+    geoms = np.array([shapely.box(0, 0, 100, 100), shapely.box(200, 200, 300, 300), shapely.box(400, 0, 500, 90)])
+    tile = encode_mvt("coverage", geoms, server.tile_properties(rows))
+
+    features = mapbox_vector_tile.decode(tile)["coverage"]["features"]
+    props = [feature["properties"] for feature in features]
+    assert props[0]["station"] == 5 and type(props[0]["station"]) is int
+    assert props[0]["fraction"] == 0.25
+    assert props[1]["station"] == "norte"
+    assert props[1]["new"] is True
+    assert props[2]["station"] == 7 and type(props[2]["station"]) is int
+    assert "fraction" not in props[2] and "population" not in props[2]
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Mosaicos vetoriais (esquema XYZ em Web Mercator) das subsecções
+
+Cada mosaico leva as geometrias que o intersectam, recortadas ao seu
+retângulo (com uma margem), em coordenadas do mosaico (0..extent),
+simplificadas à escala do nível de zoom e arredondadas à grelha inteira.
+Há dois formatos:
+
+- Mapbox Vector Tile (protobuf), escrito aqui diretamente: o formato tem
+  poucas mensagens e assim não é preciso mais uma dependência;
+- GeoJSON em WGS84, com as coordenadas da mesma grelha e o número de casas
+  decimais que distingue um ponto dessa grelha no nível de zoom.
+"""
+import json
+import math
+import struct
+
+import numpy as np
+import shapely
+from shapely.geometry import mapping
+from shapely.geometry.polygon import orient
+
+from census_shards import simplify_coverage
+from population_engine import polygonal
+from projection import WGS84, get_transformer, transform_geometries
+
+WEB_MERCATOR = 'EPSG:3857'
+MERCATOR_HALF_WIDTH = 20037508.342789244
+TILE_EXTENT = 4096
+
+
+def tile_count(z):
+    return 1 << z
+
+
+def valid_tile(z, x, y):
+    return z >= 0 and 0 <= x < tile_count(z) and 0 <= y < tile_count(z)
+
+
+def tile_bounds(z, x, y):
+    """Retângulo do mosaico em Web Mercator (minx, miny, maxx, maxy)"""
+    size = 2 * MERCATOR_HALF_WIDTH / tile_count(z)
+    minx = -MERCATOR_HALF_WIDTH + x * size
+    maxy = MERCATOR_HALF_WIDTH - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def tile_latitude(z, y):
+    """Latitude (graus) do centro do mosaico"""
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 0.5) / tile_count(z)))))
+
+
+def tile_range(bounds, z):
+    """Mosaicos (x0, y0, x1, y1, inclusive) que cobrem um retângulo em WGS84 (minx, miny, maxx, maxy)"""
+    n = tile_count(z)
+
+    def column(lng):
+        return min(max(int((lng + 180) / 360 * n), 0), n - 1)
+
+    def row(lat):
+        lat = min(max(lat, -85.0511), 85.0511)
+        return min(max(int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n), 0), n - 1)
+
+    minx, miny, maxx, maxy = bounds
+    return column(minx), row(maxy), column(maxx), row(miny)
+
+
+def tile_area(z, x, y, crs, buffer=0, extent=TILE_EXTENT):
+    """Polígono do mosaico (com `buffer` unidades de margem) no CRS indicado"""
+    minx, miny, maxx, maxy = tile_bounds(z, x, y)
+    margin = buffer * (maxx - minx) / extent
+    box = shapely.box(minx - margin, miny - margin, maxx + margin, maxy + margin)
+    # Densificar os lados antes de reprojetar para o polígono continuar a envolver o mosaico
+    box = shapely.segmentize(box, max_segment_length=(maxx - minx) / 16)
+    return transform_geometries([box], src_crs=WEB_MERCATOR, dst_crs=crs)[0]
+
+
+def coordinate_decimals(z, extent=TILE_EXTENT):
+    """Casas decimais (graus) que distinguem os pontos da grelha do mosaico no nível `z`"""
+    return max(0, math.ceil(-math.log10(360 / (tile_count(z) * extent))))
+
+
+def oriented(geoms):
+    """Anel exterior no sentido direto e buracos no inverso (área positiva pela fórmula do agrimensor)"""
+    if hasattr(shapely, 'orient_polygons'):
+        return shapely.orient_polygons(geoms)
+    return np.array([
+        shapely.multipolygons([orient(part) for part in shapely.get_parts(geom)])
+        if shapely.get_type_id(geom) == 6 else orient(geom)
+        for geom in geoms
+    ], dtype=object)
+
+
+def tile_geometries(geoms, crs, z, x, y, extent=TILE_EXTENT, buffer=64, tolerance=4.0):
+    """Geometrias em coordenadas inteiras do mosaico (y para baixo), recortadas e simplificadas
+
+    `buffer` e `tolerance` estão em unidades do mosaico. Devolve as posições
+    das geometrias que ficam com área e essas geometrias.
+    """
+    minx, miny, maxx, maxy = tile_bounds(z, x, y)
+    scale = extent / (maxx - minx)
+    transformer = get_transformer(str(crs), WEB_MERCATOR)
+
+    def to_tile(coords):
+        mx, my = transformer.transform(coords[:, 0], coords[:, 1])
+        return np.column_stack([(mx - minx) * scale, (maxy - my) * scale])
+
+    geoms = shapely.transform(np.asarray(geoms, dtype=object), to_tile)
+    geoms = shapely.clip_by_rect(geoms, -buffer, -buffer, extent + buffer, extent + buffer)
+    if tolerance > 0:
+        geoms = simplify_coverage(geoms, tolerance)
+    geoms = polygonal(shapely.set_precision(geoms, 1.0))
+    kept = np.flatnonzero(shapely.area(geoms) > 0)
+    return kept, geoms[kept]
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if not value:
+            out.append(byte)
+            return bytes(out)
+        out.append(byte | 0x80)
+
+
+def _uint_field(number, value):
+    return _varint(number << 3) + _varint(value)
+
+
+def _bytes_field(number, payload):
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _varints(values):
+    """Inteiros sem sinal em varint, todos de uma vez; devolve os bytes e o fim de cada valor nesses bytes"""
+    values = np.asarray(values, dtype=np.uint64)
+    groups = (values[:, None] >> (np.arange(10, dtype=np.uint64) * np.uint64(7))) & np.uint64(0x7F)
+    # Grupos de 7 bits de cada valor (pelo menos um), com o bit de continuação em todos menos o último
+    used = groups != 0
+    length = np.where(used.any(axis=1), 10 - np.argmax(used[:, ::-1], axis=1), 1)
+    position = np.arange(10)
+    groups[position < (length - 1)[:, None]] |= np.uint64(0x80)
+    return groups[position < length[:, None]].astype(np.uint8).tobytes(), np.cumsum(length)
+
+
+def _zigzag(values):
+    return (values << 1) ^ (values >> 63)
+
+
+def _value(value):
+    """Mensagem Value de um atributo (texto, inteiro ou real)"""
+    if isinstance(value, str):
+        return _bytes_field(1, value.encode())
+    if isinstance(value, bool):
+        return _uint_field(7, int(value))
+    if float(value).is_integer():
+        return _uint_field(6, int(_zigzag(np.int64(value))))
+    return _varint(3 << 3 | 1) + struct.pack('<d', float(value))
+
+
+def _geometry_commands(geoms):
+    """Comandos MoveTo / LineTo / ClosePath dos (multi)polígonos, com deslocamentos em zigzag
+
+    Devolve os comandos de todas as geometrias seguidos e, para cada geometria,
+    a posição onde começam (mais o total no fim).
+    """
+    parts, part_geom = shapely.get_parts(geoms, return_index=True)
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    valid = shapely.get_num_coordinates(rings) >= 4
+    rings, ring_geom = rings[valid], part_geom[ring_part[valid]]
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+    # Sem o ponto de fecho de cada anel
+    closing = np.r_[coord_ring[1:] != coord_ring[:-1], True]
+    coords, coord_ring = coords[~closing].astype(np.int64), coord_ring[~closing]
+    counts = np.bincount(coord_ring, minlength=len(rings))
+
+    # Deslocamentos em relação ao ponto anterior da mesma geometria (o cursor começa em 0, 0)
+    previous = np.vstack([np.zeros((1, 2), dtype=np.int64), coords[:-1]])
+    coord_geom = ring_geom[coord_ring]
+    previous[np.r_[True, coord_geom[1:] != coord_geom[:-1]]] = 0
+    deltas = _zigzag(coords - previous)
+
+    # Cada anel: MoveTo(1), x, y, LineTo(n - 1), pares x, y, ClosePath(1)
+    sizes = 2 * counts + 3
+    starts = np.r_[0, np.cumsum(sizes)]
+    commands = np.empty(starts[-1], dtype=np.int64)
+    commands[starts[:-1]] = 1 | 1 << 3
+    commands[starts[:-1] + 3] = 2 | (counts - 1) << 3
+    commands[starts[1:] - 1] = 7 | 1 << 3
+    local = np.arange(len(coords)) - np.r_[0, np.cumsum(counts)][coord_ring]
+    position = starts[coord_ring] + 1 + 2 * local + (local > 0)
+    commands[position] = deltas[:, 0]
+    commands[position + 1] = deltas[:, 1]
+    return commands, starts[np.searchsorted(ring_geom, np.arange(len(geoms) + 1))]
+
+
+def encode_mvt(layer, geoms, properties, extent=TILE_EXTENT):
+    """Mosaico Mapbox Vector Tile (versão 2) com uma camada de polígonos; vazio se não houver geometrias"""
+    if not len(geoms):
+        return b''
+    commands, geom_starts = _geometry_commands(oriented(geoms))
+    payload, ends = _varints(commands)
+    byte_starts = np.r_[0, ends][geom_starts]
+
+    keys, values, features = {}, {}, []
+    for k, props in enumerate(properties):
+        tags = []
+        for key, value in props.items():
+            tags += [keys.setdefault(key, len(keys)), values.setdefault(_value(value), len(values))]
+        feature = b''.join([
+            _bytes_field(2, b''.join(_varint(tag) for tag in tags)),
+            _uint_field(3, 3),
+            _bytes_field(4, payload[byte_starts[k]:byte_starts[k + 1]])
+        ])
+        features.append(_bytes_field(2, feature))
+    message = b''.join([
+        _uint_field(15, 2),
+        _bytes_field(1, layer.encode()),
+        *features,
+        *(_bytes_field(3, key.encode()) for key in keys),
+        *(_bytes_field(4, value) for value in values),
+        _uint_field(5, extent)
+    ])
+    return _bytes_field(3, message)
+
+
+def encode_geojson(geoms, properties, z, x, y, extent=TILE_EXTENT):
+    """FeatureCollection em WGS84 com as geometrias do mosaico (coordenadas da grelha, arredondadas)"""
+    minx, miny, maxx, maxy = tile_bounds(z, x, y)
+    scale = (maxx - minx) / extent
+    decimals = coordinate_decimals(z, extent)
+    transformer = get_transformer(WEB_MERCATOR, WGS84)
+
+    def to_lnglat(coords):
+        lng, lat = transformer.transform(minx + coords[:, 0] * scale, maxy - coords[:, 1] * scale)
+        return np.round(np.column_stack([lng, lat]), decimals)
+
+    features = []
+    if len(geoms):
+        for geom, props in zip(oriented(shapely.transform(geoms, to_lnglat)), properties):
+            features.append({"type": "Feature", "geometry": mapping(geom), "properties": props})
+    return json.dumps({"type": "FeatureCollection", "features": features}, separators=(',', ':')).encode()
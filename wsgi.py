@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+"""
+Ponto de entrada de produção (WSGI), com os dados carregados antes do fork
+
+Com `preload_app = True` (gunicorn.conf.py), este módulo é importado uma única
+vez no processo principal: os dados de censos, o índice espacial e a rede
+pedonal são carregados antes de o gunicorn criar os workers, que partilham
+essas páginas de memória por copy-on-write. O ficheiro Arrow é lido com
+memória mapeada, pelo que as colunas numéricas ficam na cache de páginas do
+sistema operativo, partilhada por todos os processos.
+"""
+import gc
+
+import server
+from server import app
+
+print("Carregando dados de censos (antes de criar os workers)...")
+server.ensure_census_loaded()
+if server.ISOCHRONE_BACKEND == 'local':
+    server.get_walking_graph()
+
+# Retirar os objetos já carregados das gerações do garbage collector: as recolhas
+# nos workers deixam de lhes tocar, evitando a cópia das páginas partilhadas
+gc.freeze()